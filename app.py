@@ -1,3 +1,6 @@
+import time
+# when the process started, /metrics reports the time to the first response from it
+started = time.time()
 import dash
 import dash_bootstrap_components as dbc
 from data.private import VALID_USERNAME_PASSWORD_PAIRS
@@ -38,6 +38,7 @@ uint32_t zacetna_ferment = 0;
 uint32_t trenutna_ferment = 0;
 uint32_t ciljni_cas;
 uint32_t time_left = 0;
+bool binary_mode = false;       //true = podatki se pošiljajo v binarnih okvirjih
 
 /****************** Makroti **********************/
 #define MAIN_ADDRESS LOW        //Nivo pina za glavni naslov pri i2c
@@ -47,6 +48,15 @@ uint32_t time_left = 0;
 #define HEATER_PIN 9            //Številka digitalnega pina za rele grelec
 #define HUMIDITY_PIN 8          //Številka digitalnega pina za rele vlažilec
 
+/* Binarni okvir: SYNC | tip | dolžina | podatki | crc16 (ccitt, 0xFFFF) tipa, dolžine in podatkov
+   podatki (little endian): t0..t3, h0..h3 (int16, vrednost*100, -32768 = nan) | f0..f3, he0, mo0 (biti, lsb)
+   | time_left (uint32 s) | tH, hH, tT, hT (int16, vrednost*100) | stanje (uint8: 0 stop, 1 start, 2 pause) */
+#define SYNC_BYTE 0xA5
+#define FRAME_DATA 0x01
+#define DATA_PAYLOAD_SIZE 30
+#define BINARY_LAYOUT "4.4.4.1.1"  //temperatura.vlaga.ventilatorji.grelci.vlažilci
+#define NAN_VALUE -32768
+
 
 /************************************************/
 
@@ -317,7 +327,11 @@ uint8_t serial_comunication(uint16_t cikel_ms, uint32_t perioda_ms, uint8_t init
                                   +h_target+zelena_vlaga+sep
                                   +state+fermentation_state);
 
-          Serial.println(sporocilo);
+          if(binary_mode){
+            send_binary_data();
+          }else{
+            Serial.println(sporocilo);
+          }
         stevec = 0;
       }else{
         stevec++;
@@ -343,34 +357,20 @@ uint8_t serial_read(uint16_t cikel_ms, uint32_t perioda_ms, uint8_t init_s, uint
   }else{
     if(stevec >= stevec_cilj){
       String parametri = Serial.readString();
-      if(parametri != NULL){
-        /*Head parsing*/
-        String head = parametri.substring(0,parametri.indexOf(sep));
-
-        /*Parameters parsing*/
-        if(parametri.indexOf(sep)!= -1){
-          int star_poz = parametri.indexOf(sep);
-          int nov_poz = parametri.indexOf(sep,parametri.indexOf(sep)+1);
-          String temp_string1 = "none", temp_string2 = "none";
-          int i = 0;
-          while(star_poz != -1){
-            temp_string1 = parametri.substring(star_poz+1,nov_poz);
-            star_poz = nov_poz;
-            nov_poz = parametri.indexOf(sep,star_poz+1);
-
-            if(i == 0){
-              temp_string2 = temp_string1;
-              i++;
-            }else{
-              assign_values(temp_string2, temp_string1, head);
-              i--;
-            }
-          }
-        }else{
-          assign_values("none", "none", head);
+      /*Ukazi so ločeni z novo vrstico, gostitelj jih lahko pošlje več naenkrat*/
+      int zacetek = 0;
+      while(zacetek < (int)parametri.length()){
+        int konec = parametri.indexOf('\n', zacetek);
+        if(konec == -1){
+          konec = parametri.length();
         }
-        Serial.println("info|done");
-    }
+        String ukaz = parametri.substring(zacetek, konec);
+        ukaz.trim();
+        if(ukaz.length() > 0){
+          process_command(ukaz);
+        }
+        zacetek = konec + 1;
+      }
       stevec = 0;
     }else{
       stevec++;
@@ -378,6 +378,53 @@ uint8_t serial_read(uint16_t cikel_ms, uint32_t perioda_ms, uint8_t init_s, uint
   }
 }
 
+/*Ukaz: glava|oznaka|vrednost|...|seq|n. Odgovor info|done|n pove gostitelju, kateri ukaz je izveden,
+  ponovljen ukaz (ista številka, odgovor se je izgubil) se ne izvede še enkrat*/
+void process_command(String ukaz){
+  static long zadnji_seq = -1;
+  String sep = "|";
+  String head = ukaz.substring(0, ukaz.indexOf(sep) == -1 ? ukaz.length() : ukaz.indexOf(sep));
+  String seq = "";
+  int seq_poz = ukaz.lastIndexOf("|seq|");
+  if(seq_poz != -1){
+    seq = ukaz.substring(seq_poz + 5);
+    ukaz = ukaz.substring(0, seq_poz);
+  }
+  if(seq.length() > 0 && seq.toInt() == zadnji_seq){
+    Serial.println("info|done|" + seq);
+    return;
+  }
+
+  /*Parameters parsing*/
+  if(ukaz.indexOf(sep)!= -1){
+    int star_poz = ukaz.indexOf(sep);
+    int nov_poz = ukaz.indexOf(sep,star_poz+1);
+    String temp_string1 = "none", temp_string2 = "none";
+    int i = 0;
+    while(star_poz != -1){
+      temp_string1 = ukaz.substring(star_poz+1,nov_poz);
+      star_poz = nov_poz;
+      nov_poz = ukaz.indexOf(sep,star_poz+1);
+
+      if(i == 0){
+        temp_string2 = temp_string1;
+        i++;
+      }else{
+        assign_values(temp_string2, temp_string1, head);
+        i--;
+      }
+    }
+  }else{
+    assign_values("none", "none", head);
+  }
+  if(seq.length() > 0){
+    zadnji_seq = seq.toInt();
+    Serial.println("info|done|" + seq);
+  }else{
+    Serial.println("info|done");
+  }
+}
+
 uint8_t on_condition_setup(uint16_t cikel_ms, uint32_t perioda_ms, uint8_t init_s, uint8_t zacetni_pogoj){
 
   static uint32_t stevec_cilj;
@@ -608,7 +655,7 @@ uint8_t stej_cas(uint16_t cikel_ms, uint32_t perioda_ms, uint8_t init_s, uint8_t
         if(millis()>=ciljni_cas){
           ciljni_cas = 0;
           Serial.println("info|Time is up. Fermentation stopped.");
-          assign_values("", "", "stop\n");
+          assign_values("", "", "stop");
         }
 
 
@@ -641,7 +688,7 @@ int assign_values(String oznaka, String vrednost, String head){
       histereza_vlaga = vrednost.toFloat();
     }
   }
-  if(head == "stop\n"){
+  if(head == "stop"){
     fermentation_state = "stop";
     temp = temp + "info|Stop state assigned";
     ferment_time = 0.0;
@@ -660,14 +707,23 @@ int assign_values(String oznaka, String vrednost, String head){
     }
     system_on_off = true;
   }
-  if(head == "pause\n"){
+  if(head == "pause"){
     fermentation_state = "pause";
     temp = temp + "info|Pause state assigned";
     trenutna_ferment = ciljni_cas - millis();
     system_on_off = false;
     izklp_sistema();
   }
-  if(head == "resume\n"){
+  if(head == "proto"){
+    /*Binarni način samo, če se gostitelj in arduino ujemata v številu kanalov*/
+    binary_mode = (oznaka == "bin" && vrednost == BINARY_LAYOUT);
+    if(binary_mode){
+      temp = temp + "info|proto|bin";
+    }else{
+      temp = temp + "info|proto|text";
+    }
+  }
+  if(head == "resume"){
     fermentation_state = "start";
     temp = temp + "info|Resume state assigned";
     ferment_time = ((trenutna_ferment)/1000.0)/60.0;
@@ -679,6 +735,65 @@ int assign_values(String oznaka, String vrednost, String head){
   return 0;
 }
 
+uint16_t crc16(const uint8_t *data, uint8_t length){
+  uint16_t crc = 0xFFFF;
+  for(uint8_t i=0;i<length;i++){
+    crc ^= (uint16_t)data[i] << 8;
+    for(uint8_t j=0;j<8;j++){
+      if(crc & 0x8000){
+        crc = (crc << 1) ^ 0x1021;
+      }else{
+        crc = crc << 1;
+      }
+    }
+  }
+  return crc;
+}
+
+void put_int16(uint8_t *buffer, uint8_t &pozicija, float vrednost){
+  int16_t v = NAN_VALUE;
+  if(!isnan(vrednost)){
+    v = (int16_t)lroundf(vrednost*100);
+  }
+  buffer[pozicija++] = v & 0xFF;
+  buffer[pozicija++] = (v >> 8) & 0xFF;
+}
+
+void send_binary_data(){
+  uint8_t okvir[DATA_PAYLOAD_SIZE + 5];
+  uint8_t pozicija = 0;
+  okvir[pozicija++] = SYNC_BYTE;
+  okvir[pozicija++] = FRAME_DATA;
+  okvir[pozicija++] = DATA_PAYLOAD_SIZE;
+  put_int16(okvir, pozicija, temperatura1);
+  put_int16(okvir, pozicija, temperatura2);
+  put_int16(okvir, pozicija, temperatura3);
+  put_int16(okvir, pozicija, temperatura4);
+  put_int16(okvir, pozicija, vlaga1);
+  put_int16(okvir, pozicija, vlaga2);
+  put_int16(okvir, pozicija, vlaga3);
+  put_int16(okvir, pozicija, vlaga4);
+  okvir[pozicija++] = on_fan0 | (on_fan1 << 1) | (on_fan2 << 2) | (on_fan3 << 3) | (on_heater << 4) | (on_humidity << 5);
+  for(uint8_t i=0;i<4;i++){
+    okvir[pozicija++] = (time_left >> (8*i)) & 0xFF;
+  }
+  put_int16(okvir, pozicija, histereza_temp);
+  put_int16(okvir, pozicija, histereza_vlaga);
+  put_int16(okvir, pozicija, zel_temp);
+  put_int16(okvir, pozicija, zelena_vlaga);
+  if(fermentation_state == "start"){
+    okvir[pozicija++] = 1;
+  }else if(fermentation_state == "pause"){
+    okvir[pozicija++] = 2;
+  }else{
+    okvir[pozicija++] = 0;
+  }
+  uint16_t crc = crc16(okvir + 1, pozicija - 1);
+  okvir[pozicija++] = crc & 0xFF;
+  okvir[pozicija++] = (crc >> 8) & 0xFF;
+  Serial.write(okvir, pozicija);
+}
+
 void izklp_sistema(){
   digitalWrite(HUMIDITY_PIN, LOW);
   digitalWrite(FANS_PIN, LOW);
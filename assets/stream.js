@@ -0,0 +1,102 @@
+// new measurements are pushed by the server (/stream/<chamber>) instead of polling. the figure of the
+// temperature graph carries its graph state in layout.meta: for every new figure one event stream is
+// opened that extends both graphs and updates the status elements in place; when the stream asks for
+// a redraw the hidden graph-refresh button gets clicked and dash sends new figures. streams are closed by
+// the server after a while ("reconnect") and opened again with the state as far as it got
+(function () {
+    var source = null;
+    var meta = null;
+    var state = null;
+    var retryAt = 0;
+
+    function graph(id) {
+        return document.querySelector("#" + id + " .js-plotly-plot");
+    }
+
+    function close() {
+        if (source) {
+            source.close();
+            source = null;
+        }
+    }
+
+    function showStatus(status) {
+        Object.keys(status).forEach(function (id) {
+            var element = document.getElementById(id);
+            var value = status[id];
+            if (!element) {
+                return;
+            }
+            if (Array.isArray(value)) {
+                for (var i = 0; i < element.children.length && i < value.length; i++) {
+                    element.children[i].className = value[i] ? "square-indicator-true" : "square-indicator-false";
+                }
+            } else {
+                element.textContent = value === null ? "" : String(value);
+            }
+        });
+    }
+
+    function onMessage(event) {
+        var message = JSON.parse(event.data);
+        if (message.status) {
+            showStatus(message.status);
+        }
+        if (message.extend) {
+            ["temperature", "humidity"].forEach(function (id, i) {
+                var gd = graph(id);
+                var traces = message.extend[i].x.map(function (x, j) { return j; });
+                if (gd) {
+                    Plotly.extendTraces(gd, message.extend[i], traces, message.max_points);
+                }
+            });
+            state.last_time = message.last_time;
+        }
+        if (message.reconnect) {
+            close();
+            connect();
+        }
+        if (message.redraw) {
+            close();
+            state = null;
+            var button = document.getElementById("graph-refresh");
+            if (button) {
+                button.click();
+            }
+        }
+    }
+
+    function connect() {
+        source = new EventSource("/stream/" + encodeURIComponent(state.chamber) + "?state="
+                                 + encodeURIComponent(JSON.stringify(state)));
+        source.onmessage = onMessage;
+        source.onerror = function () {
+            // reconnect with the state as far as it got, not with the url of the first connection
+            close();
+            retryAt = Date.now() + 5000;
+        };
+    }
+
+    function watch() {
+        var gd = graph("temperature");
+        var current = gd && gd.layout ? gd.layout.meta : null;
+        if (!current || !current.chamber) {
+            if (!gd) {
+                close();
+                meta = null;
+                state = null;
+            }
+            return;
+        }
+        if (current !== meta) {
+            close();
+            meta = current;
+            state = JSON.parse(JSON.stringify(current));
+            connect();
+        } else if (!source && state && Date.now() > retryAt) {
+            connect();
+        }
+    }
+
+    setInterval(watch, 250);
+})();
@@ -2,7 +2,10 @@ import dash_core_components as dcc
 import dash_html_components as html
 from dash.dependencies import Input, Output
 from app import app
-from pages import graph, landing
+from pages import graph, landing, overview, metrics, export
+
+# for wsgi servers: gunicorn index:server
+server = app.server
 
 app.layout = html.Div([
     dcc.Location(id='url', refresh=False),
@@ -14,7 +17,11 @@ app.layout = html.Div([
               Input('url', 'pathname'))
 def display_page(pathname):
     if pathname == '/graph':
-        return graph.layout
+        return graph.graph_page.get_layout()
+    elif pathname is not None and pathname.startswith('/graph/'):
+        return graph.graph_page.get_layout(pathname[len('/graph/'):])
+    elif pathname == '/overview':
+        return overview.layout()
     else:
         return landing.layout
 
@@ -0,0 +1,81 @@
+import hashlib
+import flask
+import numpy as np
+from app import app, auth
+from pages.graph import chamber_manager
+from scripts.export import FORMATS, bin_size, parse_range, stream_bin, stream_text
+
+# /export?chamber=<name>&start=<time>&end=<time>&channels=t0,h0&format=csv|ndjson|bin streams the rows with
+# start < time <= end (iso times or epoch microseconds, open ended when left out) of the chosen channels
+# (all stored ones by default). the end is fixed to the newest row when left out and sent back in
+# X-Export-End, so a resumed download asks for the same rows. bin exports answer byte ranges (Range,
+# If-Range with the ETag); a text download resumes with start set to the time of the last complete line
+
+
+def parse_time(value):
+    if value is None or value == "":
+        return None
+    if value.isdigit():
+        return int(value)
+    return int(np.datetime64(value, "us").astype(np.int64))
+
+
+def bad_request(message):
+    return flask.Response(message + "\n", status=400, mimetype="text/plain")
+
+
+def export():
+    arguments = flask.request.args
+    fermentor = chamber_manager.get(arguments.get("chamber"))
+    if fermentor is None:
+        return flask.Response("Unknown chamber\n", status=404, mimetype="text/plain")
+    format = arguments.get("format", "csv")
+    if format not in FORMATS:
+        return bad_request("format must be one of " + ", ".join(FORMATS))
+    channels = arguments.get("channels")
+    channels = channels.split(",") if channels else list(fermentor.stored_names)
+    unknown = [name for name in channels if name not in fermentor.stored_index]
+    if unknown:
+        return bad_request("unknown channels: " + ", ".join(unknown))
+    try:
+        start = parse_time(arguments.get("start"))
+        end = parse_time(arguments.get("end"))
+    except ValueError as e:
+        return bad_request("bad time: " + str(e))
+    if end is None:
+        end = fermentor.last_time()
+    channel_index = [fermentor.stored_index[name] for name in channels]
+
+    headers = {"X-Export-End": "" if end is None else str(end),
+               "Content-Disposition": "attachment; filename={}-{}-{}.{}".format(fermentor.name, start or "start",
+                                                                               end or "end", format)}
+    if format != "bin":
+        headers["Accept-Ranges"] = "none"
+        parts = fermentor.export_parts(start, end)
+        return flask.Response(stream_text(parts, channels, channel_index, format), mimetype=FORMATS[format],
+                              headers=headers)
+
+    # counted and streamed from the same parts, the etag changes with the chunk index so a range resumed
+    # after retention rewrote a chunk gets the whole new body instead of a splice
+    parts = list(fermentor.export_parts(start, end))
+    rows = sum(rows for rows, load in parts)
+    size = bin_size(channels, rows)
+    version = fermentor.retention.store.index_mtime
+    etag = hashlib.sha1(repr((fermentor.name, start, end, channels, rows, version)).encode()).hexdigest()[:16]
+    headers.update({"Accept-Ranges": "bytes", "ETag": '"{}"'.format(etag)})
+    byte_range = parse_range(flask.request.headers.get("Range"), size)
+    if_range = flask.request.headers.get("If-Range")
+    if if_range is not None and if_range.strip('"') != etag:
+        byte_range = None
+    if byte_range is False:
+        headers["Content-Range"] = "bytes */{}".format(size)
+        return flask.Response(status=416, headers=headers)
+    first, last = byte_range or (0, size - 1)
+    headers["Content-Length"] = str(last + 1 - first)
+    if byte_range is not None:
+        headers["Content-Range"] = "bytes {}-{}/{}".format(first, last, size)
+    return flask.Response(stream_bin(parts, channels, channel_index, rows, first, last),
+                          status=206 if byte_range is not None else 200, mimetype=FORMATS[format], headers=headers)
+
+
+app.server.add_url_rule("/export", "export", auth.auth_wrapper(export))
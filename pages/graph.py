@@ -1,26 +1,26 @@
-from app import app
+import os
+import dash
+import json
+import flask
+from app import app, auth
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_bootstrap_components as dbc
 from dash.dependencies import Input, Output, State
-import plotly.graph_objects as go
-import pandas as pd
-from scripts.fermentor import Fermentor
+import numpy as np
+from scripts.chamber_manager import ChamberManager, load_chamber_config
 from snippets import header
 import datetime
 import time
-import cProfile, pstats
 import pprint
+from scripts.render_cache import RenderCache
+from scripts.alarms import alarm_summary
 
 class Graph_page:
-    def __init__(self, app):
-        self.profiler = cProfile.Profile()
+    def __init__(self, app, chamber_manager):
         self.app = app
-        #self.fermentor = Fermentor(serial_port_name='/dev/ttyACM0')
-        self.fermentor = Fermentor()
+        self.chamber_manager = chamber_manager
         
-        self.auto_scale = True
-        self.update_shapes = True
         self.config = {
             'modeBarButtonsToRemove': ['toggleSpikelines', 'hoverCompareCartesian', 'lasso2d', 'hoverClosestCartesian', 'autoScale2d', 'resetScale2d'],
             'displaylogo': False,
@@ -31,48 +31,62 @@ class Graph_page:
         self.trace_names = ["back-top-left","front-bottom-left","front-top-right","back-bottom-right"]
         
         self.temperature_range_tolerance = 5
-        self.temperature_ranges = None
         self.range_y_temperature = [0, 110]
-        self.temperature_columns = [x for x in self.fermentor.in_names["temperature"]]
+        self.temperature_columns = None # set by init_columns
         self.temperature_delta = 5
         self.humidity_range_tolerance = 5
-        self.humidity_ranges = None
         self.range_y_humidity = [0, 100]
-        self.humidity_columns = [x for x in self.fermentor.in_names["humidity"]]
+        self.humidity_columns = None
         self.humidity_delta = 5
-        self.time_delta = datetime.timedelta(minutes=10, seconds=0)
-        self.time_offset = self.time_delta/5
-        self.range_x_time = [datetime.datetime.utcnow() - self.time_offset,
-                             datetime.datetime.utcnow() + self.time_offset - self.time_delta]
-        
-        self.init_ranges()
-        data = self.init_data()
+        self.average_columns = None
+        # points per trace at most, longer windows are drawn from the rollups (two points, min and max, per
+        # bucket); figures whose traces can hold more than webgl_points are drawn with webgl (scattergl), svg
+        # stalls low-end browsers long before that
+        self.points_per_trace = 3000
+        self.webgl_points = 1000
+        self.time_options = [("1min", "1 min"), ("10min", "10 min"), ("30min", "30 min"), ("1h", "1 h"),
+                             ("12h", "12 h"), ("1d", "1 d"), ("7d", "7 d"), ("14d", "14 d"), ("1mo", "1 mo"),
+                             ("3mo", "3 mo"), ("disable auto-scale", "0 disable")]
+        # figures are computed once per chamber, view and new sample, whatever number of clients polls;
+        # what a client is looking at lives in its own graph-state store
+        self.render_cache = RenderCache()
+        self.keepalive_interval = 15
+        # a stream holds a server thread while it is open, it ends after stream_seconds and the client opens
+        # a new one right away, so a worker is never taken for good by open tabs
+        self.stream_seconds = 60
+        self.open_streams = 0
 
-        figure_temperature, figure_humidity = self.init_graphs(data)
-        self.layout = None
-        self.init_layout(figure_temperature, figure_humidity)
         self.init_callbacks()
 
-    def init_ranges(self):
-        target_temp = self.fermentor.params["temperature"]["target"]["current"]
-        hyst_temp = self.fermentor.params["temperature"]["hysteresis"]["current"]
-        self.temperature_ranges = [target_temp - hyst_temp - self.temperature_range_tolerance,
+    def init_columns(self):
+        # channel names of the graphs, from the default chamber once the chambers are built
+        if self.temperature_columns is not None:
+            return
+        default_fermentor = self.chamber_manager.get()
+        humidity_columns = [x for x in default_fermentor.in_names["humidity"]]
+        temperature_columns = [x for x in default_fermentor.in_names["temperature"]]
+        # the average trace is the derived channel stored at ingest, computed here only without one
+        self.average_columns = {column: average for columns, average in [(temperature_columns, "t_avg"),
+                                                                         (humidity_columns, "h_avg")]
+                                for column in columns if average in default_fermentor.stored_index}
+        self.humidity_columns = humidity_columns
+        self.temperature_columns = temperature_columns
+
+    def init_ranges(self, fermentor):
+        target_temp = fermentor.params["temperature"]["target"]["current"]
+        hyst_temp = fermentor.params["temperature"]["hysteresis"]["current"]
+        temperature_ranges = [target_temp - hyst_temp - self.temperature_range_tolerance,
                                    target_temp - hyst_temp,
                                    target_temp + hyst_temp,
                                    target_temp + hyst_temp + self.temperature_range_tolerance]
                                    
-        target_humid = self.fermentor.params["humidity"]["target"]["current"]
-        hyst_humid = self.fermentor.params["humidity"]["hysteresis"]["current"]
-        self.humidity_ranges = [target_humid - hyst_humid - self.humidity_range_tolerance,
+        target_humid = fermentor.params["humidity"]["target"]["current"]
+        hyst_humid = fermentor.params["humidity"]["hysteresis"]["current"]
+        humidity_ranges = [target_humid - hyst_humid - self.humidity_range_tolerance,
                                    target_humid - hyst_humid,
                                    target_humid + hyst_humid,
                                    target_humid + hyst_humid + self.humidity_range_tolerance]
-
-    def filter_results(self, df):
-        #df = df.iloc[::5] %choose every fifth element
-        max_time = df["time"].max()
-        cutoff_time = max_time - self.time_delta
-        return df[df["time"] > cutoff_time]
+        return temperature_ranges, humidity_ranges
 
     def draw_horizontal_band(self, fig, yrange=(0, 100), fillcolor="red", opacity=0.2):
         fig['layout']['shapes'].append(
@@ -115,9 +129,10 @@ class Graph_page:
         return fig
         
     def init_graph(self, df, columns, ranges=None, dash=None, color=None, y_axis_range=None):
+        import plotly.graph_objects as go  # not needed until the first graph is drawn
         fig = go.Figure()
         fig.update_layout(uirevision=True)
-        fig.update_xaxes(autorange=False)
+        fig.update_xaxes(autorange=False, type="date") # x values are sent as epoch milliseconds
         fig.update_layout(yaxis_range=y_axis_range, margin={'t': 10, 'b': 10}, height=400)
         return fig
     def draw_line(self, fig, x, y, name='default', mode='lines+markers', opacity = 1, type ='scatter', color='red', dash='solid'):
@@ -132,54 +147,111 @@ class Graph_page:
             'type': 'scatter'
          })
 
-    def draw_lines(self, fig, df, columns, dash=None, color=None):
-        if self.time_delta < datetime.timedelta(minutes=11):
+    def trace_xy(self, df, column):
+        # rollup buckets are drawn as their min and max so spikes stay visible on long windows
+        if column + "_min" not in df:
+            return df['time'].values, df[column].values
+        x = np.repeat(df['time'].values, 2)
+        y = np.column_stack((df[column + "_min"].values, df[column + "_max"].values)).ravel()
+        return x, y
+
+    def trace_arrays(self, df, columns):
+        # x/y of every trace of a graph: one per sensor followed by the average, in the short form they are
+        # sent in (epoch milliseconds, values to two decimals)
+        traces = [self.trace_xy(df, column) for column in columns]
+        average = self.average_columns.get(columns[0])
+        if average in df:
+            traces.append((df['time'].values, df[average].values))
+        else:
+            traces.append((df['time'].values, df[columns].mean(axis=1).values))
+        return [(x.astype("datetime64[ms]").astype(np.int64), np.round(y.astype(np.float64), 2)) for x, y in traces]
+
+    def column_extremes(self, df, columns):
+        if columns[0] + "_min" in df:
+            return df[[x + "_min" for x in columns]].min().min(), df[[x + "_max" for x in columns]].max().max()
+        return df[columns].min().min(), df[columns].max().max()
+
+    def window_extremes(self, fermentor, data, time_delta):
+        # [(min, max) of the temperatures, (min, max) of the humidities] over the window, kept up to date by
+        # the fermentor sample by sample; the drawn data only stands in while there is nothing stored
+        stats = fermentor.window_stats(time_delta)
+        extremes = []
+        for group, columns in [("temperature", self.temperature_columns), ("humidity", self.humidity_columns)]:
+            if stats[group] is None:
+                extremes.append(None if data is None else self.column_extremes(data, columns))
+            else:
+                extremes.append(stats[group][:2])
+        return extremes
+
+    def draw_lines(self, fig, df, columns, time_delta, dash=None, color=None, webgl=False):
+        if time_delta < datetime.timedelta(minutes=11):
             mode = 'lines+markers'
         else:
             mode = 'lines'
+        import plotly.graph_objects as go
+        scatter = go.Scattergl if webgl else go.Scatter
         fig['data'] = [] # delete current lines
+        traces = self.trace_arrays(df, columns)
         for i in range(len(columns)):
-            neki=go.Scatter(x=df['time'],
-                       y=df[columns[i]],
-                       mode=mode,
-                       opacity=0.3,
-                       line=dict(dash=dash[i],
-                                 color=color[i], ),
-                       name=self.trace_names[i]
+            x, y = traces[i]
+            neki=scatter(x=x,
+                    y=y,
+                    mode=mode,
+                    opacity=0.3,
+                    line=dict(dash=dash[i],
+                              color=color[i], ),
+                    name=self.trace_names[i]
             ).to_plotly_json()
             fig['data'].append(neki)
             pass
-        avg_df = df[columns].mean(axis=1)
+        x, y = traces[-1]
         fig['data'].append(
-            go.Scatter(x=df['time'],
-                       y=avg_df,
-                       mode=mode,
-                       opacity=1,
-                       line=dict(dash='solid',
-                                 color=color[0], ),
-                       name="average"
+            scatter(x=x,
+                    y=y,
+                    mode=mode,
+                    opacity=1,
+                    line=dict(dash='solid',
+                              color=color[0], ),
+                    name="average"
             ).to_plotly_json(),
         )
         return fig
 
-    def init_data(self):
-        df = pd.DataFrame(self.fermentor.measurements.copy() + self.fermentor.measurements_unsaved.copy())
+    def extend_lines(self, df, columns):
+        # extendData update appending the new rows to every trace drawn by draw_lines
+        traces = self.trace_arrays(df, columns)
+        update = {'x': [], 'y': []}
+        for x, y in traces:
+            update['x'].append(x.tolist())
+            update['y'].append(y.tolist())
+        return update
+
+    def window_start(self, fermentor, time_delta):
+        last_time = fermentor.last_time()
+        if last_time is None:
+            return None
+        return last_time - time_delta // datetime.timedelta(microseconds=1)
+
+    def init_data(self, fermentor, time_delta, resolution=None, since=None):
+        # the whole window, or only what came after `since`, read by binary search on the time index
+        import pandas as pd  # not needed until the first graph is drawn
+        columns = self.temperature_columns + self.humidity_columns + sorted(set(self.average_columns.values()))
+        if since is not None:
+            return pd.DataFrame(fermentor.read(since, None, columns, resolution))
+        df = pd.DataFrame(fermentor.read(self.window_start(fermentor, time_delta), None, columns, resolution))
         if df.empty:
-            df = pd.DataFrame([self.fermentor.create_empty_data_block()])
+            df = pd.DataFrame([fermentor.create_empty_data_block()])
             df['time'] = datetime.datetime.now()
-        df = self.filter_results(df)
         return df
 
     def init_graphs(self, data):
         figure_temperature = self.init_graph(data, self.temperature_columns,
                                               color=self.colors_temperature,
                                               dash=self.dashes,
-                                              ranges=self.temperature_ranges,
                                               y_axis_range=self.range_y_temperature)
         figure_humidity = self.init_graph(data, self.humidity_columns,
                                            color=self.colors_humidity,
                                            dash=self.dashes,
-                                           ranges=self.humidity_ranges,
                                            y_axis_range=self.range_y_humidity)
         return figure_temperature, figure_humidity
     
@@ -192,15 +264,272 @@ class Graph_page:
                 elements.append(html.Div(className="square-indicator-false"))
         return elements
     
-    def update_parameters(self, temperature_target, temperature_hysteresis, humidity_target, humidity_hysteresis):
-        self.fermentor.update_parameters(temperature_target, humidity_target, temperature_hysteresis, humidity_hysteresis)
-        self.fermentor.send_parameters()
-        self.init_ranges()
-        self.update_shapes = True
+    def update_parameters(self, fermentor, temperature_target, temperature_hysteresis, humidity_target, humidity_hysteresis):
+        fermentor.update_parameters(temperature_target, humidity_target, temperature_hysteresis, humidity_hysteresis)
+        fermentor.send_parameters()
         return ""
-            
-    def init_layout(self, figure_temperature, figure_humidity):
-        self.layout = \
+
+    def view(self, time_radio):
+        # time window and auto scaling picked with the time radio, nothing of it is kept on the page object
+        time_radio = time_radio.split()
+        if time_radio[1] == "min":
+            time_delta = datetime.timedelta(minutes=int(time_radio[0]))
+        if time_radio[1] == "h":
+            time_delta = datetime.timedelta(hours=int(time_radio[0]))
+        if time_radio[1] == "d":
+            time_delta = datetime.timedelta(days=int(time_radio[0]))
+        if time_radio[1] == "mo":
+            time_delta = datetime.timedelta(days=31 * int(time_radio[0]))
+        if time_radio[1] == "disable":
+            return datetime.timedelta(days=90), False
+        return time_delta, True
+
+    def graph_config(self, auto_scale):
+        return dict(self.config, displayModeBar=not auto_scale)
+
+    def last_time(self, df):
+        return int(df["time"].values[-1].astype("datetime64[us]").astype(np.int64))
+
+    def max_points(self, df, resolution, time_delta):
+        # number of points a trace holds for the whole window, extendData trims everything older
+        if resolution is not None:
+            buckets = int(time_delta.total_seconds() // resolution) + 1
+            return [2 * buckets] * len(self.trace_names) + [buckets]
+        times = df["time"].values.astype("datetime64[us]").astype(np.int64)
+        count = len(times)
+        if count > 1 and times[-1] > times[0]:
+            rate = (count - 1) / (times[-1] - times[0])
+            count = max(count, int(rate * (time_delta // datetime.timedelta(microseconds=1))) + 1)
+        return [count] * (len(self.trace_names) + 1)
+
+    def graph_state_fits(self, fermentor, graph_state, last_time, time_delta, auto_scale):
+        # appended points have to stay inside the axis ranges set by the last full redraw
+        if not auto_scale or last_time is None:
+            return True
+        if last_time > graph_state["range_x"][1]:
+            return False
+        extremes = self.window_extremes(fermentor, None, time_delta)
+        for group_extremes, y_range in zip(extremes, [graph_state["range_y_temperature"],
+                                                      graph_state["range_y_humidity"]]):
+            if group_extremes is not None and (group_extremes[0] < y_range[0] or group_extremes[1] > y_range[1]):
+                return False
+        return True
+
+    def render(self, fermentor, time_radio, resolution, temperature_ranges, humidity_ranges):
+        # full figures of one view, built from scratch so the result can be shared by every client
+        self.init_columns()
+        time_delta, auto_scale = self.view(time_radio)
+        data = self.init_data(fermentor, time_delta, resolution)
+        figure_temperature, figure_humidity = [figure.to_plotly_json() for figure in self.init_graphs(None)]
+        # decided on what the traces hold once the window is full, extendData does not switch the trace type
+        max_points = self.max_points(data, resolution, time_delta)
+        webgl = max(max_points) > self.webgl_points
+        figure_temperature = self.draw_lines(figure_temperature,
+                                              data,
+                                              self.temperature_columns,
+                                              time_delta,
+                                              self.dashes,
+                                              self.colors_temperature,
+                                              webgl)
+        figure_humidity = self.draw_lines(figure_humidity,
+                                          data,
+                                          self.humidity_columns,
+                                          time_delta,
+                                          self.dashes,
+                                          self.colors_humidity,
+                                          webgl)
+
+        #handle all automatic scaling
+        range_x_time = [None, None]
+        range_y_temperature = self.range_y_temperature
+        range_y_humidity = self.range_y_humidity
+        if auto_scale:
+            range_x_max_time = data["time"].max() + time_delta / 5
+            range_x_min_time = range_x_max_time - time_delta
+            (min_temperature, max_temperature), (min_humidity, max_humidity) = self.window_extremes(fermentor, data, time_delta)
+            range_y_max_temperature = max_temperature + self.temperature_delta
+            range_y_min_temperature = min_temperature - self.temperature_delta
+            range_y_max_humidity = max_humidity + self.humidity_delta
+            range_y_min_humidity = min_humidity - self.humidity_delta
+            range_y_humidity = [float(range_y_min_humidity), float(range_y_max_humidity)]
+            range_y_temperature = [float(range_y_min_temperature), float(range_y_max_temperature)]
+            range_x_time = [range_x_min_time, range_x_max_time]
+            figure_humidity['layout']['xaxis']['range']=range_x_time
+            figure_humidity['layout']['yaxis']['range']=range_y_humidity
+            figure_temperature['layout']['xaxis']['range']=range_x_time
+            figure_temperature['layout']['yaxis']['range']=range_y_temperature
+        else:
+            # the whole history, zooming is left to the mode bar
+            for figure in [figure_temperature, figure_humidity]:
+                figure['layout']['xaxis']['autorange'] = True
+                figure['layout']['yaxis'] = {'autorange': True}
+
+        #update range rectangles
+        figure_temperature = self.draw_acceptable_ranges(figure_temperature, temperature_ranges)
+        figure_humidity = self.draw_acceptable_ranges(figure_humidity, humidity_ranges)
+
+        last_time = self.last_time(data)
+        if resolution is not None and len(data) > 1:
+            last_time = self.last_time(data.iloc[:-1]) # the newest bucket is sent again once complete
+        graph_state = {
+            "chamber": fermentor.name,
+            "window": time_radio,
+            "bands": [temperature_ranges, humidity_ranges],
+            "resolution": resolution,
+            "last_time": last_time,
+            "max_points": max_points,
+            "range_x": [None if x is None else np.datetime64(x, "us").astype(np.int64).item() for x in range_x_time],
+            "range_y_temperature": range_y_temperature,
+            "range_y_humidity": range_y_humidity,
+        }
+        figure_temperature['layout']['meta'] = graph_state # picked up by the event stream of the client
+        return figure_temperature, figure_humidity, graph_state
+
+    def render_update(self, fermentor, time_radio, resolution, since):
+        # extendData updates with everything after `since`, shared by the clients that are equally far behind
+        time_delta, auto_scale = self.view(time_radio)
+        data = self.init_data(fermentor, time_delta, resolution, since=since)
+        if resolution is not None:
+            data = data.iloc[:-1] # the newest bucket is still filling up
+        if data.empty:
+            return None, None, None
+        return self.last_time(data), self.extend_lines(data, self.temperature_columns), \
+            self.extend_lines(data, self.humidity_columns)
+
+    def resolution(self, fermentor, time_radio, version):
+        time_delta, auto_scale = self.view(time_radio)
+        return self.render_cache.get(fermentor.name, version, ("resolution", time_radio),
+                                     lambda: fermentor.select_resolution(self.window_start(fermentor, time_delta),
+                                                                         None, self.points_per_trace, 2))
+
+    def graph_update(self, fermentor, graph_state, version):
+        # what a client showing graph_state needs for the data up to `version`: None when the figures have
+        # to be redrawn, else the new last time (None if nothing new) and the extendData updates of both graphs
+        self.init_columns()
+        time_delta, auto_scale = self.view(graph_state["window"])
+        resolution = self.resolution(fermentor, graph_state["window"], version)
+        #full redraw only when the window, the range bands or the axis ranges change
+        if graph_state["bands"] != list(self.init_ranges(fermentor)) or graph_state["resolution"] != resolution:
+            return None
+        since = graph_state["last_time"]
+        update = self.render_cache.get(
+            fermentor.name, version, ("update", graph_state["window"], resolution, since),
+            lambda: self.render_update(fermentor, graph_state["window"], resolution, since))
+        if not self.graph_state_fits(fermentor, graph_state, update[0], time_delta, auto_scale):
+            return None
+        return update
+
+    def status(self, fermentor):
+        # everything next to the graphs by element id, indicator rows as lists of states
+        current_data = fermentor.current_data
+        in_names = fermentor.in_names
+        status = {
+            "countdown-time": str(current_data[in_names["time_left"][0]]),
+            "current-time": current_data[in_names["time"][0]].strftime("%Y-%m-%d %H:%M:%S"),
+            "heater-indicator-row": [bool(current_data[x]) for x in in_names["heater"]],
+            "fans-indicator-row": [bool(current_data[x]) for x in in_names["fan"]],
+            "humidifier-indicator-row": [bool(current_data[x]) for x in in_names["moisturizer"]],
+            "current-state": current_data[in_names["state"][0]] if fermentor.ready else fermentor.connection_status(),
+            "command-status": fermentor.command_status(),
+            "alarm-status": alarm_summary(fermentor.alarm_state),
+        }
+        for key in ["temperature_target", "temperature_hysteresis", "humidity_target", "humidity_hysteresis"]:
+            value = current_data[in_names[key][0]]
+            status["output-" + key.replace("_", "-")] = None if value != value else value
+        return status
+
+    def update_graphs(self, fermentor, time_radio, graph_state):
+        time_delta, auto_scale = self.view(time_radio)
+        version = fermentor.data_version
+        extend_temperature = dash.no_update
+        extend_humidity = dash.no_update
+
+        update = None
+        if graph_state is not None and graph_state["window"] == time_radio:
+            update = self.graph_update(fermentor, graph_state, version)
+        if update is None:
+            resolution = self.resolution(fermentor, time_radio, version)
+            temperature_ranges, humidity_ranges = self.init_ranges(fermentor)
+            key = ("figures", time_radio, resolution, str([temperature_ranges, humidity_ranges]))
+            figure_temperature, figure_humidity, graph_state = self.render_cache.get(
+                fermentor.name, version, key,
+                lambda: self.render(fermentor, time_radio, resolution, temperature_ranges, humidity_ranges))
+        else:
+            figure_temperature = dash.no_update
+            figure_humidity = dash.no_update
+            last_time, update_temperature, update_humidity = update
+            if last_time is not None:
+                max_points = {'x': graph_state["max_points"], 'y': graph_state["max_points"]}
+                indices = list(range(len(self.trace_names) + 1))
+                extend_temperature = [update_temperature, indices, max_points]
+                extend_humidity = [update_humidity, indices, max_points]
+                graph_state["last_time"] = last_time
+            else:
+                graph_state = dash.no_update
+
+        status = self.status(fermentor)
+        heater_indicator_row = self.update_indicator_row(status["heater-indicator-row"])
+        fans_indicator_row = self.update_indicator_row(status["fans-indicator-row"])
+        humidifier_indicator_row = self.update_indicator_row(status["humidifier-indicator-row"])
+        config = self.graph_config(auto_scale)
+        return figure_temperature, figure_humidity, config, config, status["countdown-time"], status["current-time"], \
+               heater_indicator_row, fans_indicator_row, humidifier_indicator_row, \
+               status["output-temperature-target"], status["output-temperature-hysteresis"], \
+               status["output-humidity-target"], status["output-humidity-hysteresis"], status["current-state"], \
+               status["command-status"], status["alarm-status"], extend_temperature, extend_humidity, graph_state
+
+    def stream_events(self, fermentor, graph_state):
+        # server sent events for one client: the status whenever anything changed and extendData updates for
+        # new rows; "redraw" ends the stream, the client then asks for new figures (and a new stream);
+        # "reconnect" ends it after stream_seconds, the client opens a new stream from where it got
+        versions = None
+        end = time.monotonic() + self.stream_seconds
+        self.open_streams += 1
+        try:
+            while True:
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    yield "data: " + json.dumps({"reconnect": True}) + "\n\n"
+                    return
+                new_versions = fermentor.wait_for_change(versions, min(self.keepalive_interval, remaining))
+                if new_versions == versions:
+                    yield ": keepalive\n\n"
+                    continue
+                data_changed = versions is None or new_versions[0] != versions[0]
+                versions = new_versions
+                event = {"status": self.status(fermentor)}
+                if data_changed:
+                    update = self.graph_update(fermentor, graph_state, versions[0])
+                    if update is None:
+                        event["redraw"] = True
+                    elif update[0] is not None:
+                        graph_state["last_time"] = update[0]
+                        event["last_time"] = update[0]
+                        event["extend"] = [update[1], update[2]]
+                        event["max_points"] = {'x': graph_state["max_points"], 'y': graph_state["max_points"]}
+                yield "data: " + json.dumps(event) + "\n\n"
+                if event.get("redraw"):
+                    return
+        finally:
+            self.open_streams -= 1
+
+    def stream(self, chamber):
+        fermentor = self.chamber_manager.get(chamber)
+        if fermentor is None:
+            return flask.Response("Unknown chamber", status=404)
+        try:
+            graph_state = json.loads(flask.request.args["state"])
+        except (KeyError, ValueError):
+            return flask.Response("Missing graph state", status=400)
+        return flask.Response(self.stream_events(fermentor, graph_state), mimetype="text/event-stream",
+                              headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    def get_layout(self, chamber=None):
+        fermentor = self.chamber_manager.get(chamber)
+        if fermentor is None:
+            return dbc.Container([header.layout, html.H2("Unknown chamber: " + str(chamber))], fluid=True)
+        figure_temperature, figure_humidity = self.init_graphs(None)
+        return \
             dbc.Container([
                 header.layout,
                 dbc.Row([
@@ -210,19 +539,7 @@ class Graph_page:
                             dbc.Label("Never", id="current-time"),
                             dcc.RadioItems(
                                 id="time-radio",
-                                options=[
-                                    {'label': '1min', 'value': '1 min'},
-                                    {'label': '10min', 'value': '10 min'},
-                                    {'label': '30min', 'value': '30 min'},
-                                    {'label': '1h', 'value': '1 h'},
-                                    {'label': '12h', 'value': '12 h'},
-                                    {'label': '1d', 'value': '1 d'},
-                                    {'label': '7d', 'value': '7 d'},
-                                    {'label': '14d', 'value': '14 d'},
-                                    {'label': '1mo', 'value': '1 mo'},
-                                    {'label': '3mo', 'value': '3 mo'},
-                                    {'label': 'disable auto-scale', 'value': '0 disable'},
-                                    ],
+                                options=[{'label': label, 'value': value} for label, value in self.time_options],
                                 value='5 min',
                                 labelStyle={'display': 'inline-block'}
                             ),
@@ -241,11 +558,9 @@ class Graph_page:
                             html.Div(id="time_select"),
                             ], className="graph-wrapper text-center",
                         ),
-                        dcc.Interval(
-                            id='interval-component',
-                            interval=5*1000, # in milliseconds
-                            n_intervals=0
-                        ),
+                        # new data is pushed over /stream/<chamber> (assets/stream.js), which clicks this
+                        # when the figures have to be redrawn
+                        html.Button(id='graph-refresh', n_clicks=0, style={'display': 'none'}),
                     ], lg=9, md=12),
                     dbc.Col([
                         html.Div([
@@ -255,14 +570,14 @@ class Graph_page:
                                         dbc.Label("Target temperature:", className="target-wrapper-label"),
                                         html.Br(),
                                         dcc.Input(id='input-temperature-target', className="parameter-input", type='number',
-                                                  value=str(self.fermentor.params["temperature"]["target"]["current"])),
+                                                  value=str(fermentor.params["temperature"]["target"]["current"])),
                                         dbc.Label("00", id='output-temperature-target', className="parameter-output"),
                                     ], className="text-center"),
                                     dbc.Col([
                                         dbc.Label("Temperature hysteresis:", className="target-wrapper-label"),
                                         html.Br(),
                                         dcc.Input(id='input-temperature-hysteresis', className="parameter-input", type='number',
-                                                  value=str(self.fermentor.params["temperature"]["hysteresis"]["current"])),
+                                                  value=str(fermentor.params["temperature"]["hysteresis"]["current"])),
                                         dbc.Label("00", id='output-temperature-hysteresis', className="parameter-output"),
                                     ], className="text-center"),
                                 ]),
@@ -271,14 +586,14 @@ class Graph_page:
                                         dbc.Label("Target humidity:", className="target-wrapper-label"),
                                         html.Br(),
                                         dcc.Input(id='input-humidity-target', className="parameter-input", type='number',
-                                                  value=str(self.fermentor.params["humidity"]["target"]["current"])),
+                                                  value=str(fermentor.params["humidity"]["target"]["current"])),
                                         dbc.Label("00", id='output-humidity-target', className="parameter-output"),
                                     ], className="text-center"),
                                     dbc.Col([
                                         dbc.Label("Humidity hysteresis:", className="target-wrapper-label"),
                                         html.Br(),
                                         dcc.Input(id='input-humidity-hysteresis', className="parameter-input", type='number',
-                                                  value=str(self.fermentor.params["humidity"]["hysteresis"]["current"])),
+                                                  value=str(fermentor.params["humidity"]["hysteresis"]["current"])),
                                         dbc.Label("00", id='output-humidity-hysteresis', className="parameter-output"),
                                     ], className="text-center")
                                 ]),
@@ -286,7 +601,8 @@ class Graph_page:
                                     dbc.Col([
                                         dbc.Button("Update parameters", id='input-update-parameters', color="dark",
                                                    className="button-custom"),
-                                        html.Div(id="output-update-parameters")
+                                        html.Div(id="output-update-parameters"),
+                                        dbc.Label("", id="command-status")
                                     ], className="text-center")
                                 ])
                             ], className="target-wrapper"),
@@ -325,23 +641,30 @@ class Graph_page:
                                         dbc.Label("", id="current-state"),
                                     ])
                                 ], className="text-center"),
+                                dbc.Row([
+                                    dbc.Col([
+                                        dbc.Label("Alarms:", className="target-wrapper-label"),
+                                        html.Br(),
+                                        dbc.Label("", id="alarm-status"),
+                                    ])
+                                ], className="text-center"),
                             ], className="target-wrapper"),
                         ], className="graph-wrapper"),
                         html.Div([
                             dbc.Label("Heater"),
                             html.Br(),
                             html.Div([
-                                html.Div(className="square-indicator-false") for x in self.fermentor.in_names["heater"]
+                                html.Div(className="square-indicator-false") for x in fermentor.in_names["heater"]
                             ], id= "heater-indicator-row"),
                             dbc.Label("Fans"),
                             html.Br(),
                             html.Div([
-                                html.Div(className="square-indicator-false") for x in self.fermentor.in_names["fan"]
+                                html.Div(className="square-indicator-false") for x in fermentor.in_names["fan"]
                             ], id= "fans-indicator-row"),
                             dbc.Label("Humidifier"),
                             html.Br(),
                             html.Div([
-                                html.Div(className="square-indicator-false") for x in self.fermentor.in_names["moisturizer"]
+                                html.Div(className="square-indicator-false") for x in fermentor.in_names["moisturizer"]
                             ], id= "humidifier-indicator-row"),
                         ], className="graph-wrapper"),
                     ], lg=3, md=12),
@@ -355,6 +678,8 @@ class Graph_page:
                 html.Div(id='none4', style = {'display':'none'}),
                 html.Div(id='none5', style = {'display':'none'}),
                 html.Div(id='none6', style = {'display':'none'}),
+                dcc.Store(id='graph-state'),
+                dcc.Store(id='chamber', data=fermentor.name),
             ],fluid=True)
 
     def init_callbacks(self):
@@ -365,10 +690,11 @@ class Graph_page:
             State('input-temperature-hysteresis', "value"),
             State('input-humidity-target', "value"),
             State('input-humidity-hysteresis', "value"),
+            State('chamber', "data"),
         )
-        def update_parameters(n_clicks, temperature_target, temperature_hysteresis, humidity_target, humidity_hysteresis):
+        def update_parameters(n_clicks, temperature_target, temperature_hysteresis, humidity_target, humidity_hysteresis, chamber):
             if n_clicks:
-                return self.update_parameters(temperature_target, temperature_hysteresis, humidity_target, humidity_hysteresis)
+                return self.update_parameters(self.chamber_manager.get(chamber), temperature_target, temperature_hysteresis, humidity_target, humidity_hysteresis)
 
         @app.callback(Output('temperature', 'figure'),
                       Output('humidity', 'figure'),
@@ -384,90 +710,22 @@ class Graph_page:
                       Output('output-humidity-target', 'children'),
                       Output('output-humidity-hysteresis', 'children'),
                       Output('current-state', 'children'),
-                      Input('interval-component', 'n_intervals'),
+                      Output('command-status', 'children'),
+                      Output('alarm-status', 'children'),
+                      Output('temperature', 'extendData'),
+                      Output('humidity', 'extendData'),
+                      Output('graph-state', 'data'),
+                      Input('graph-refresh', 'n_clicks'),
                       Input('time-radio', 'value'),
-                      State('temperature', 'figure'),
-                      State('humidity', 'figure'),
+                      State('graph-state', 'data'),
+                      State('chamber', 'data'),
                       )
-        def update_graphs(n, time_radio, figure_temperature, figure_humidity):
-
-            time_radio = time_radio.split()
-            if time_radio[1] == "min":
-                self.time_delta = datetime.timedelta(minutes=int(time_radio[0]))
-            if time_radio[1] == "h":
-                self.time_delta = datetime.timedelta(hours=int(time_radio[0]))
-            if time_radio[1] == "d":
-                self.time_delta = datetime.timedelta(days=int(time_radio[0]))
-            if time_radio[1] == "mo":
-                self.time_delta = datetime.timedelta(days=31 * int(time_radio[0]))
-            if time_radio[1] == "disable":
-                self.time_delta = datetime.timedelta(days=90)
-                self.auto_scale = False
-            else:
-                self.auto_scale = True
-                self.time_offset = self.time_delta / 5
-
-            data = self.init_data()
-            
-            #refresh lines
-            start = time.time()
-
-            figure_temperature = self.draw_lines(figure_temperature,
-                                                  data,
-                                                  self.temperature_columns,
-                                                  self.dashes,
-                                                  self.colors_temperature)
-            figure_humidity = self.draw_lines(figure_humidity,
-                                              data,
-                                              self.humidity_columns,
-                                              self.dashes,
-                                              self.colors_humidity)
-
-            #handle all automatic scaling
-            if self.auto_scale:
-                self.config['displayModeBar']=False
-                range_x_max_time = data["time"].max() + self.time_offset
-                range_x_min_time = range_x_max_time - self.time_delta
-                range_y_max_temperature = data[self.temperature_columns].max().max() + self.temperature_delta
-                range_y_min_temperature = data[self.temperature_columns].min().min() - self.temperature_delta
-                range_y_max_humidity = data[self.humidity_columns].max().max() + self.humidity_delta
-                range_y_min_humidity = data[self.humidity_columns].min().min() - self.humidity_delta
-                self.range_y_humidity = [range_y_min_humidity, range_y_max_humidity]
-                self.range_y_temperature = [range_y_min_temperature, range_y_max_temperature]
-                self.range_x_time = [range_x_min_time, range_x_max_time]
-                figure_humidity['layout']['xaxis']['range']=self.range_x_time
-                figure_humidity['layout']['yaxis']['range']=self.range_y_humidity
-                figure_temperature['layout']['xaxis']['range']=self.range_x_time
-                figure_temperature['layout']['yaxis']['range']=self.range_y_temperature
-            else:
-                self.config['displayModeBar']=True
-            
-            #update range rectangles
-            if self.update_shapes:
-                figure_temperature = self.draw_acceptable_ranges(figure_temperature, self.temperature_ranges)
-                figure_humidity = self.draw_acceptable_ranges(figure_humidity, self.humidity_ranges)
-                self.update_shapes = False
-            
-            #update times
-            countdown_time = self.fermentor.current_data[self.fermentor.in_names["time_left"][0]]
-            countdown_string = str(countdown_time)
-            current_time = self.fermentor.current_data[self.fermentor.in_names["time"][0]]
-            current_string = current_time.strftime("%Y-%m-%d %H:%M:%S")
-            
-            #update indicators
-            heater_indicator_row = self.update_indicator_row(self.fermentor.current_data[x] for x in self.fermentor.in_names["heater"])
-            fans_indicator_row = self.update_indicator_row(self.fermentor.current_data[x] for x in self.fermentor.in_names["fan"])
-            humidifier_indicator_row = self.update_indicator_row(self.fermentor.current_data[x]for x in self.fermentor.in_names["moisturizer"])
-            end = time.time()
-            return figure_temperature, figure_humidity, self.config, self.config, countdown_string, current_string, \
-                   heater_indicator_row, fans_indicator_row, humidifier_indicator_row, \
-                   self.fermentor.current_data[self.fermentor.in_names["temperature_target"][0]],\
-                   self.fermentor.current_data[self.fermentor.in_names["temperature_hysteresis"][0]],\
-                   self.fermentor.current_data[self.fermentor.in_names["humidity_target"][0]],\
-                   self.fermentor.current_data[self.fermentor.in_names["humidity_hysteresis"][0]],\
-                   self.fermentor.current_data[self.fermentor.in_names["state"][0]]
-
+        def update_graphs(n, time_radio, graph_state, chamber):
+            if "graph-refresh.n_clicks" in [x["prop_id"] for x in dash.callback_context.triggered]:
+                graph_state = None # the stream has already extended the figures past the stored state
+            return self.update_graphs(self.chamber_manager.get(chamber), time_radio, graph_state)
 
+        self.app.server.add_url_rule("/stream/<chamber>", "stream", auth.auth_wrapper(self.stream))
 
         @self.app.callback(
             Output("none0", "children"),
@@ -477,42 +735,50 @@ class Graph_page:
             State('input-temperature-hysteresis', "value"),
             State('input-humidity-target', "value"),
             State('input-humidity-hysteresis', "value"),
+            State('chamber', "data"),
         )
-        def button_start(n_clicks, n_minutes, temperature_target, temperature_hysteresis, humidity_target, humidity_hysteresis):
+        def button_start(n_clicks, n_minutes, temperature_target, temperature_hysteresis, humidity_target, humidity_hysteresis, chamber):
             if n_clicks:
-                message = self.fermentor.start_fermentation(n_minutes)
+                message = self.chamber_manager.get(chamber).start_fermentation(n_minutes)
                 return message
             return ""
             
         @self.app.callback(
             Output("none1", "children"),
-            Input("button-stop", "n_clicks")
+            Input("button-stop", "n_clicks"),
+            State('chamber', "data"),
         )
-        def button_stop(n_clicks):
+        def button_stop(n_clicks, chamber):
             if n_clicks:
-                message = self.fermentor.stop_fermentation()
+                message = self.chamber_manager.get(chamber).stop_fermentation()
                 return message
             return ""
             
         @self.app.callback(
             Output("none2", "children"),
-            Input("button-pause", "n_clicks")
+            Input("button-pause", "n_clicks"),
+            State('chamber', "data"),
         )
-        def button_pause(n_clicks):
+        def button_pause(n_clicks, chamber):
             if n_clicks:
-                message = self.fermentor.pause_fermentation()
+                message = self.chamber_manager.get(chamber).pause_fermentation()
                 return message
             return ""
             
         @self.app.callback(
             Output("none3", "children"),
-            Input("button-resume", "n_clicks")
+            Input("button-resume", "n_clicks"),
+            State('chamber', "data"),
         )
-        def button_resume(n_clicks):
+        def button_resume(n_clicks, chamber):
             if n_clicks:
-                message = self.fermentor.resume_fermentation()
+                message = self.chamber_manager.get(chamber).resume_fermentation()
                 return message
             return ""
 
-graph_page = Graph_page(app)
-layout = graph_page.layout
+# the chambers are configured (serial port discovery) and started in the background, the server answers
+# before they exist. FERMENTOR_DAEMON=1: the chambers run in scripts.acquisition_daemon and this process
+# only reads them
+chamber_manager = ChamberManager(load_chamber_config, daemon=bool(os.environ.get("FERMENTOR_DAEMON")))
+chamber_manager.start(background=True)
+graph_page = Graph_page(app, chamber_manager)
@@ -0,0 +1,78 @@
+import time
+import flask
+import app as application
+from app import app, auth
+from pages.graph import chamber_manager, graph_page
+from scripts.metrics import Registry, SamplingProfiler, render
+
+# /metrics: prometheus text with the web process metrics and those of every chamber (labelled by chamber,
+# workers send theirs every few seconds). /metrics/profile?action=start|stop[&chamber=name] switches the
+# sampling profiler of the web process (or of a chamber worker) on and off, stop returns the collapsed stacks.
+# /alarms: json of the active alarms and newest alarm events of every chamber
+
+web_metrics = Registry()
+callback_seconds = web_metrics.histogram("callback_seconds", "Dash callbacks by their first output")
+web_metrics.counter("render_cache_hits_total", "Graph renders served from the shared cache",
+                    lambda: graph_page.render_cache.hits)
+web_metrics.counter("render_cache_misses_total", "Graph renders computed", lambda: graph_page.render_cache.misses)
+web_metrics.gauge("event_streams", "Open server sent event streams", lambda: graph_page.open_streams)
+web_metrics.gauge("first_response_seconds", "Seconds from process start to the first answered request",
+                  lambda: {} if first_response[0] is None else first_response[0])
+profiler = SamplingProfiler()
+first_response = [None]
+
+
+@app.server.before_request
+def start_timer():
+    flask.g.request_start = time.perf_counter()
+
+
+@app.server.after_request
+def time_callback(response):
+    if first_response[0] is None:
+        first_response[0] = time.time() - application.started
+    if flask.request.path.endswith("_dash-update-component") and "request_start" in flask.g:
+        body = flask.request.get_json(silent=True) or {}
+        outputs = body.get("outputs")
+        output = outputs[0] if isinstance(outputs, list) and outputs else outputs
+        name = "{}.{}".format(output["id"], output["property"]) if isinstance(output, dict) else body.get("output")
+        callback_seconds.observe(time.perf_counter() - flask.g.request_start, callback=str(name))
+    return response
+
+
+def metrics():
+    snapshots = [({}, web_metrics.snapshot())]
+    for name, chamber in chamber_manager.chambers.items():
+        snapshots.append(({"chamber": name}, chamber.metrics.snapshot()))
+        snapshots.append(({"chamber": name}, chamber.worker_metrics))
+    return flask.Response(render(snapshots), mimetype="text/plain; version=0.0.4")
+
+
+def alarms():
+    # active alarms and the newest alarm events of every chamber
+    return flask.jsonify({name: chamber.alarm_state for name, chamber in chamber_manager.chambers.items()})
+
+
+def profile():
+    action = flask.request.args.get("action")
+    chamber = flask.request.args.get("chamber")
+    if chamber is not None:
+        fermentor = chamber_manager.chambers.get(chamber)
+        if fermentor is None:
+            return flask.Response("Unknown chamber\n", status=404, mimetype="text/plain")
+        if action == "start":
+            return flask.Response(fermentor.start_profiler() + "\n", mimetype="text/plain")
+        if action == "stop":
+            return flask.Response(fermentor.stop_profiler(), mimetype="text/plain")
+    elif action == "start":
+        profiler.start()
+        return flask.Response("profiler started\n", mimetype="text/plain")
+    elif action == "stop":
+        return flask.Response(profiler.stop(), mimetype="text/plain")
+    return flask.Response("use ?action=start or ?action=stop, &chamber=<name> for a chamber worker\n", status=400,
+                          mimetype="text/plain")
+
+
+app.server.add_url_rule("/metrics", "metrics", auth.auth_wrapper(metrics))
+app.server.add_url_rule("/metrics/profile", "profile", auth.auth_wrapper(profile))
+app.server.add_url_rule("/alarms", "alarms", auth.auth_wrapper(alarms))
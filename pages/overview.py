@@ -0,0 +1,95 @@
+import dash_core_components as dcc
+import dash_html_components as html
+import dash_bootstrap_components as dbc
+import dash
+from dash.dependencies import Input, Output, State
+import numpy as np
+import datetime
+
+from app import app
+from snippets import header
+from pages.graph import chamber_manager, graph_page
+from scripts.alarms import alarm_summary
+
+time_delta = datetime.timedelta(hours=12)
+points_per_trace = 1000
+
+
+def average(fermentor, key):
+    return np.mean([fermentor.current_data[x] for x in fermentor.in_names[key]])
+
+
+def chamber_row(name, fermentor):
+    if not fermentor.ready:
+        # nothing to show before the chamber sent its current data
+        return html.Tr([html.Td(dcc.Link(name, href='/graph/' + name)), html.Td(fermentor.connection_status())]
+                       + [html.Td("")] * 6)
+    return html.Tr([
+        html.Td(dcc.Link(name, href='/graph/' + name)),
+        html.Td(fermentor.connection_status()),
+        html.Td(fermentor.current_data[fermentor.in_names["state"][0]]),
+        html.Td(alarm_summary(fermentor.alarm_state)),
+        html.Td("{:.1f}".format(average(fermentor, "temperature"))),
+        html.Td("{:.1f}".format(average(fermentor, "humidity"))),
+        html.Td(str(fermentor.current_data[fermentor.in_names["time_left"][0]])),
+        html.Td(fermentor.current_data[fermentor.in_names["time"][0]].strftime("%Y-%m-%d %H:%M:%S")),
+    ])
+
+
+def ready_chambers():
+    return {name: fermentor for name, fermentor in chamber_manager.chambers.items() if fermentor.ready}
+
+
+def overview_version():
+    return [[name, fermentor.data_version] for name, fermentor in ready_chambers().items()]
+
+
+def overview_figure(version):
+    # shared by every client until a chamber gets new rows
+    return graph_page.render_cache.get("overview", str(version), "figure", render_overview)
+
+
+def render_overview():
+    # average temperature of every chamber on one graph
+    import plotly.graph_objects as go  # not needed until the first graph is drawn
+    fig = go.Figure()
+    for name, fermentor in ready_chambers().items():
+        columns = fermentor.query(datetime.datetime.utcnow() - time_delta, None, fermentor.in_names["temperature"],
+                                  points_per_trace)
+        temperature = np.mean([columns[x] for x in fermentor.in_names["temperature"]], axis=0)
+        fig.add_trace(go.Scatter(x=columns["time"], y=temperature, mode='lines', name=name))
+    fig.update_layout(uirevision=True, margin={'t': 10, 'b': 10}, height=400, yaxis_title="temperature")
+    return fig
+
+
+def layout():
+    version = overview_version()
+    return \
+    dbc.Container([
+        header.layout,
+        dbc.Row([
+            dbc.Col([
+                html.Div([
+                    dbc.Table(id="overview-table", bordered=False, hover=True),
+                    dcc.Graph(id="overview-graph", figure=overview_figure(version), config={'displaylogo': False}),
+                    dcc.Store(id="overview-version", data=version),
+                    dcc.Interval(id='overview-interval', interval=5*1000, n_intervals=0),
+                ], className="graph-wrapper text-center"),
+            ]),
+        ]),
+    ], fluid=True)
+
+
+@app.callback(Output('overview-table', 'children'),
+              Output('overview-graph', 'figure'),
+              Output('overview-version', 'data'),
+              Input('overview-interval', 'n_intervals'),
+              State('overview-version', 'data'))
+def update_overview(n, shown_version):
+    head = html.Thead(html.Tr([html.Th(x) for x in ["Chamber", "Connection", "State", "Alarms", "Temperature", "Humidity",
+                                                    "Time to finish", "Last update"]]))
+    body = html.Tbody([chamber_row(name, fermentor) for name, fermentor in chamber_manager.chambers.items()])
+    version = overview_version()
+    if version == shown_version:
+        return [head, body], dash.no_update, dash.no_update
+    return [head, body], overview_figure(version), version
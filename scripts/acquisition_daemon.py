@@ -0,0 +1,112 @@
+import os
+import sys
+import time
+import argparse
+import threading
+import multiprocessing
+from multiprocessing.connection import Listener
+from scripts.chamber_manager import create_fermentor, run_command, load_chamber_config
+from scripts.shared_state import SharedRing, shared_name, control_address, control_key
+
+# python -m scripts.acquisition_daemon [--config data/chambers.json]
+# runs the chambers (serial port, parser, storage) outside the web server: one process per chamber publishes
+# its newest rows and current data / parameters / command log through shared memory (scripts.shared_state)
+# and takes commands on a local socket. web processes started with FERMENTOR_DAEMON=1 only attach, so the
+# dashboard can run in several workers. every open graph holds a thread with its event stream (for up to a
+# minute, then the browser reconnects), so use threaded workers:
+#   FERMENTOR_DAEMON=1 gunicorn -w 4 --threads 16 index:server
+HEARTBEAT_INTERVAL = 1.0
+
+
+def serve_chamber(config):
+    # the port is only read once the rows it brings can be published
+    fermentor = create_fermentor(config, start_engine=False)
+    ring = SharedRing(shared_name(config["name"]), len(fermentor.stored_names), create=True)
+    # the engine thread and the command threads both publish, the ring has a single writer at a time
+    publish_lock = threading.Lock()
+
+    def publish_state():
+        state = {"current_data": fermentor.current_data.copy(), "params": fermentor.params,
+                 "commands": list(fermentor.command_log.values()), "alarms": fermentor.alarm_state}
+        with publish_lock:
+            ring.publish_state(state)
+
+    def publish(times, values):
+        with publish_lock:
+            ring.publish(times, values)
+        publish_state()
+    fermentor.listeners.append(publish)
+    fermentor.command_listeners.append(lambda commands: publish_state())
+    fermentor.alarm_listeners.append(lambda state: publish_state())
+
+    def beat():
+        while True:
+            ring.beat()
+            fermentor.check_silence()
+            time.sleep(HEARTBEAT_INTERVAL)
+    publish_state()
+    threading.Thread(target=beat, daemon=True).start()
+    fermentor.engine.start()
+
+    def serve_connection(connection):
+        try:
+            while True:
+                name, args, kwargs = connection.recv()
+                result = run_command(fermentor, name, args, kwargs)
+                publish_state()
+                connection.send((result, fermentor.params))
+        except (EOFError, OSError):
+            connection.close()
+
+    address = control_address(config)
+    if os.name == "posix" and os.path.exists(address):
+        os.remove(address)
+    listener = Listener(address, authkey=control_key(config, create=True))
+    print("chamber", config["name"], "serving", shared_name(config["name"]), "and", address)
+    try:
+        while True:
+            try:
+                connection = listener.accept()
+            except Exception as e:
+                print("control connection refused:", e)
+                continue
+            threading.Thread(target=serve_connection, args=(connection,), daemon=True).start()
+    finally:
+        listener.close()
+        ring.close()
+        fermentor.close()
+
+
+def start_chamber(config):
+    process = multiprocessing.Process(target=serve_chamber, name="chamber-" + config["name"], args=(config,))
+    process.start()
+    print("chamber", config["name"], "started on", config["serial_port_name"], "pid", process.pid)
+    return process
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="run the chambers and publish them to the web processes")
+    parser.add_argument("--config", default="data/chambers.json")
+    arguments = parser.parse_args(arguments)
+
+    configs = load_chamber_config(arguments.config)
+    processes = {config["name"]: start_chamber(config) for config in configs}
+    try:
+        while True:
+            time.sleep(5)
+            for config in configs:
+                if not processes[config["name"]].is_alive():
+                    print("chamber", config["name"], "died, restarting")
+                    processes[config["name"]] = start_chamber(config)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.join(timeout=10)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
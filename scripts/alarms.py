@@ -0,0 +1,209 @@
+import os
+import json
+import collections
+import numpy as np
+
+# alarms evaluated on every stored batch in the ingest thread, a constant amount of work per sample
+# (stale and heater_stuck are also checked on a timer by check_silence, a dead link sends no batches):
+#   <group>_band     warning, the group average left the target +- hysteresis band (green on the graph)
+#   <group>_range    critical, it left the band widened by the tolerance (yellow on the graph)
+#   <group>_disagree warning, the sensors of the group are further apart than the disagreement limit
+#   stale_<channel>  warning, a sensor repeated the same value (or sent nothing) for stale_seconds
+#   heater_stuck     critical, the heater did not switch for heater_seconds while the fermentation runs
+# band and disagreement conditions have to hold for hold_seconds before they are raised. raised and
+# cleared events go to a small event log (the newest log_size in memory, all of them appended to
+# alarms.jsonl in the data directory), the dashboard only reads the active set and the newest events
+
+DEFAULTS = {
+    "tolerance": {"temperature": 5, "humidity": 5},
+    "disagreement": {"temperature": 10, "humidity": 15},
+    "hold_seconds": 60,
+    "stale_seconds": 600,
+    "heater_seconds": 3600,
+    "log_size": 200,
+}
+GROUP_CHANNELS = {"temperature": ("t_avg", "t_spread"), "humidity": ("h_avg", "h_spread")}
+LOG_COMPACT_LINES = 10000
+
+
+class AlarmEngine():
+    # every alarm is a boolean condition over the samples, raised once it held for its hold time in a row.
+    # all conditions of a batch are evaluated together as one (alarms, samples) matrix, and the run each
+    # one is in carries over to the next batch
+    def __init__(self, in_names, stored_index, data_directory=None, **config):
+        self.config = {key: dict(value) if isinstance(value, dict) else value for key, value in DEFAULTS.items()}
+        for key, value in config.items():
+            if isinstance(value, dict):
+                self.config[key].update(value)
+            else:
+                self.config[key] = value
+        self.in_names = in_names
+        self.stored_index = stored_index
+        self.stale_names = [name for group in GROUP_CHANNELS for name in in_names[group]]
+        self.stale_index = [stored_index[name] for name in self.stale_names]
+        hold = self.config["hold_seconds"]
+        alarms = [(group + suffix, level, hold) for group in GROUP_CHANNELS
+                  for suffix, level in [("_band", "warning"), ("_range", "critical"), ("_disagree", "warning")]]
+        alarms += [("stale_" + name, "warning", self.config["stale_seconds"]) for name in self.stale_names]
+        alarms += [("heater_stuck", "critical", self.config["heater_seconds"])]
+        self.names = [name for name, level, seconds in alarms]
+        self.levels = [level for name, level, seconds in alarms]
+        self.hold = np.array([int(seconds * 1000000) for name, level, seconds in alarms], dtype=np.int64)
+        # start of the current run of every condition (-1 while it is false) and whether it is raised
+        self.since = np.full(len(alarms), -1, dtype=np.int64)
+        self.raised = np.zeros(len(alarms), dtype=bool)
+        self.last_values = np.full(len(self.stale_names), np.nan, dtype=np.float32)
+        self.last_time = None
+        self.heater = None
+        self.heater_switched = None
+        self.active = collections.OrderedDict()
+        self.events = collections.deque(maxlen=self.config["log_size"])
+        self.log_path = None if data_directory is None else os.path.join(data_directory, "alarms.jsonl")
+        self.log_lines = 0
+        self.load_log()
+
+    def load_log(self):
+        # the newest events and the alarms still raised when the process stopped
+        if self.log_path is None or not os.path.isfile(self.log_path):
+            return
+        with open(self.log_path, "r", encoding="utf8") as f:
+            lines = f.readlines()
+        self.log_lines = len(lines)
+        for line in lines:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            self.events.append(event)
+            if event["event"] == "raised":
+                self.active[event["alarm"]] = event
+            else:
+                self.active.pop(event["alarm"], None)
+        for name, event in self.active.items():
+            if name in self.names:
+                self.raised[self.names.index(name)] = True
+                self.since[self.names.index(name)] = event["since"]
+
+    def write_log(self, events):
+        if self.log_path is None:
+            return
+        if self.log_lines + len(events) > LOG_COMPACT_LINES:
+            # only the newest events are kept on disk too
+            temporary_path = self.log_path + ".tmp"
+            with open(temporary_path, "w", encoding="utf8") as f:
+                f.writelines(json.dumps(event) + "\n" for event in self.events)
+            os.replace(temporary_path, self.log_path)
+            self.log_lines = len(self.events)
+            return
+        with open(self.log_path, "a", encoding="utf8") as f:
+            f.writelines(json.dumps(event) + "\n" for event in events)
+        self.log_lines += len(events)
+
+    def group_columns(self, group, values):
+        # average and spread of a group, the derived channels when the chamber stores them
+        average, spread = GROUP_CHANNELS[group]
+        if average in self.stored_index and spread in self.stored_index:
+            return values[self.stored_index[average]], values[self.stored_index[spread]]
+        rows = values[[self.stored_index[name] for name in self.in_names[group]]]
+        return np.nanmean(rows, axis=0), np.nanmax(rows, axis=0) - np.nanmin(rows, axis=0)
+
+    def update(self, times, values, params, current_data):
+        # new events of one stored batch
+        times = np.asarray(times, dtype=np.int64)
+        count = len(times)
+        if count == 0:
+            return []
+        running = params["state"]["current"] != "stop"
+        # the heater only comes with the newest message of the batch
+        heater = current_data[self.in_names["heater"][0]]
+        if heater != self.heater or self.heater_switched is None:
+            self.heater = heater
+            self.heater_switched = int(times[-1])
+        flags = np.empty((len(self.names), count), dtype=bool)
+        measured = np.empty((len(self.names), count), dtype=np.float64)
+        row = 0
+        with np.errstate(invalid="ignore"):
+            for group in GROUP_CHANNELS:
+                average, spread = self.group_columns(group, values)
+                hysteresis = params[group]["hysteresis"]["current"]
+                distance = np.abs(average - params[group]["target"]["current"])
+                flags[row] = running & (distance > hysteresis)
+                flags[row + 1] = running & (distance > hysteresis + self.config["tolerance"][group])
+                flags[row + 2] = spread > self.config["disagreement"][group]
+                measured[row:row + 2] = average
+                measured[row + 2] = spread
+                row += 3
+            sensors = values[self.stale_index]
+            previous = np.concatenate((self.last_values[:, None], sensors[:, :-1]), axis=1)
+            flags[row:row + len(sensors)] = (sensors == previous) | np.isnan(sensors)
+            measured[row:row + len(sensors)] = sensors
+            self.last_values = sensors[:, -1].copy()
+            flags[-1] = running and self.heater_switched != times[-1]
+            measured[-1] = (times - self.heater_switched) / 1e6
+        # start of the run of true flags every sample is in, taken from the last batch when it began there
+        indices = np.arange(count)
+        breaks = np.maximum.accumulate(np.where(flags, -1, indices), axis=1)
+        starts = times[np.minimum(breaks + 1, count - 1)]
+        carried = np.where(self.since >= 0, self.since, times[0])
+        starts = np.where(breaks < 0, carried[:, None], starts)
+        raised = flags & (times - starts >= self.hold[:, None])
+        changes = np.diff(np.concatenate((self.raised[:, None], raised), axis=1).astype(np.int8), axis=1)
+        self.since = np.where(flags[:, -1], starts[:, -1], -1)
+        self.raised = raised[:, -1].copy()
+        self.last_time = int(times[-1])
+        events = [self.record(alarm, int(times[index]), raised[alarm, index], float(measured[alarm, index]),
+                              int(starts[alarm, index])) for alarm, index in zip(*np.nonzero(changes))]
+        if events:
+            events.sort(key=lambda event: event["time"])
+            self.write_log(events)
+        return events
+
+    def check_silence(self, now, params):
+        # new events while no rows arrive: every sensor counts as silent since the last sample (or since the
+        # first check when nothing came yet) and the heater as not switching since its last switch
+        now = int(now)
+        if self.last_time is None:
+            self.last_time = now
+        heater_alarm = len(self.names) - 1
+        stale_first = heater_alarm - len(self.stale_names)
+        starts = [(alarm, self.last_time) for alarm in range(stale_first, heater_alarm)]
+        if params["state"]["current"] != "stop" and self.heater_switched is not None:
+            starts.append((heater_alarm, self.heater_switched))
+        events = []
+        for alarm, start in starts:
+            if self.raised[alarm]:
+                continue
+            if self.since[alarm] >= 0:
+                start = min(start, int(self.since[alarm]))
+            if now - start < self.hold[alarm]:
+                continue
+            self.since[alarm] = start
+            self.raised[alarm] = True
+            value = (now - self.heater_switched) / 1e6 if alarm == heater_alarm else float("nan")
+            events.append(self.record(alarm, now, True, value, start))
+        if events:
+            self.write_log(events)
+        return events
+
+    def record(self, alarm, time, raised, value, since):
+        name = self.names[alarm]
+        event = {"time": time, "alarm": name, "level": self.levels[alarm],
+                 "event": "raised" if raised else "cleared",
+                 "value": None if value != value else round(value, 3),
+                 "since": since if raised else None}
+        if raised:
+            self.active[name] = event
+        else:
+            self.active.pop(name, None)
+        self.events.append(event)
+        return event
+
+    def state(self, count=20):
+        # what the dashboard shows: the raised alarms and the newest events
+        return {"active": list(self.active.values()), "events": list(self.events)[-count:]}
+
+
+def alarm_summary(state):
+    if not state["active"]:
+        return "no alarms"
+    return ", ".join("{} {}".format(event["level"], event["alarm"]) for event in state["active"])
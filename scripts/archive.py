@@ -0,0 +1,227 @@
+import os
+import sys
+import csv
+import json
+import struct
+import threading
+import numpy as np
+
+MAGIC = b"FERMARCH"
+VERSION = 1
+HEADER_ALIGNMENT = 64
+
+
+def record_dtype(channels):
+    return np.dtype([("time", "<i8")] + [(name, "<f4") for name in channels])
+
+
+class MeasurementArchive():
+    # append-only file of fixed-width records (int64 epoch microseconds + one float32 per channel)
+    # behind a small header holding the channel layout, so it can be memory-mapped as a numpy record array
+    def __init__(self, path, channels):
+        self.path = path
+        self.channels = list(channels)
+        self.dtype = record_dtype(self.channels)
+        if os.path.isfile(path) and os.path.getsize(path) > 0:
+            self.header_size = self.read_header()
+            self.truncate_partial_record()
+        else:
+            self.header_size = self.write_header()
+
+    def read_header(self):
+        return read_header(self.path, self.channels)
+
+    def write_header(self):
+        channels = json.dumps(self.channels).encode("utf8")
+        header_size = -(-(20 + len(channels)) // HEADER_ALIGNMENT) * HEADER_ALIGNMENT
+        header = struct.pack("<8sIII", MAGIC, VERSION, header_size, len(channels)) + channels
+        with open(self.path, "wb") as f:
+            f.write(header.ljust(header_size, b"\0"))
+        return header_size
+
+    def truncate_partial_record(self):
+        # a crash in the middle of an append leaves a torn record at the end
+        size = os.path.getsize(self.path)
+        extra = (size - self.header_size) % self.dtype.itemsize
+        if extra:
+            with open(self.path, "r+b") as f:
+                f.truncate(size - extra)
+
+    def __len__(self):
+        return (os.path.getsize(self.path) - self.header_size) // self.dtype.itemsize
+
+    def records(self, start=0, stop=None):
+        count = len(self)
+        stop = count if stop is None else min(stop, count)
+        if stop <= start:
+            return np.zeros(0, dtype=self.dtype)
+        return np.memmap(self.path, dtype=self.dtype, mode="r",
+                         offset=self.header_size + start * self.dtype.itemsize, shape=(stop - start,))
+
+    def columns(self, start=0, stop=None):
+        records = self.records(start, stop)
+        values = np.empty((len(self.channels), len(records)), dtype=np.float32)
+        for i, name in enumerate(self.channels):
+            values[i] = records[name]
+        return np.asarray(records["time"]), values
+
+    def to_records(self, times, values):
+        records = np.empty(len(times), dtype=self.dtype)
+        records["time"] = times
+        for i, name in enumerate(self.channels):
+            records[name] = values[i]
+        return records
+
+    def append(self, times, values, sync=False):
+        with open(self.path, "ab") as f:
+            f.write(self.to_records(times, values).tobytes())
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+
+    def drop_before(self, timestamp):
+        # rewrites the file without the records older than `timestamp`, readers holding a memmap of the old
+        # file keep reading it until they let go
+        records = self.records()
+        first = int(np.searchsorted(records["time"], timestamp, side="left"))
+        if first == 0:
+            return 0
+        temporary_path = self.path + ".tmp"
+        with open(self.path, "rb") as source, open(temporary_path, "wb") as f:
+            f.write(source.read(self.header_size))
+            source.seek(self.header_size + first * self.dtype.itemsize)
+            while True:
+                block = source.read(1 << 20)
+                if not block:
+                    break
+                f.write(block)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.path)
+        return first
+
+    def last_time(self):
+        count = len(self)
+        if count == 0:
+            return None
+        return int(self.records(count - 1)["time"][0])
+
+
+class ArchiveView():
+    # the read side of a MeasurementStore over an archive another process appends to: the values are views of
+    # a read-only memory mapping, so any number of readers share the page cache instead of each holding a
+    # copy (only the times are copied, binary searches need them contiguous). refresh() maps the records
+    # appended since, or the file again once the writer replaced it (drop_before)
+    def __init__(self, path, channels):
+        self.path = path
+        self.channels = list(channels)
+        self.dtype = record_dtype(self.channels)
+        self.identity = None
+        self.header_size = None
+        self.time = np.zeros(0, dtype=np.int64)
+        self.values = np.zeros((len(self.channels), 0), dtype=np.float32)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.time)
+
+    def refresh(self):
+        # True when the view changed
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        identity = (stat.st_dev, stat.st_ino)
+        if identity != self.identity:
+            if stat.st_size < 20:
+                return False
+            self.header_size = read_header(self.path, self.channels)
+        count = max(0, stat.st_size - self.header_size) // self.dtype.itemsize
+        if identity == self.identity and count == len(self.time):
+            return False
+        if count == 0:
+            time = np.zeros(0, dtype=np.int64)
+            values = np.zeros((len(self.channels), 0), dtype=np.float32)
+        else:
+            records = np.memmap(self.path, dtype=self.dtype, mode="r", offset=self.header_size, shape=(count,))
+            time = np.array(records["time"])
+            values = np.ndarray((len(self.channels), count), dtype=np.float32, buffer=records, offset=8,
+                                strides=(4, self.dtype.itemsize))
+        with self.lock:
+            self.identity = identity
+            self.time = time
+            self.values = values
+        return True
+
+    def snapshot(self):
+        with self.lock:
+            return self.time, self.values
+
+    def first_time(self):
+        time = self.time
+        return int(time[0]) if len(time) else None
+
+    def last_time(self):
+        time = self.time
+        return int(time[-1]) if len(time) else None
+
+    def trim(self, before):
+        # the writer drops old records from the file, refresh follows it
+        return 0
+
+
+def read_header(path, channels):
+    # header size of an archive, checked against the expected channel layout
+    with open(path, "rb") as f:
+        magic, version, header_size, channels_size = struct.unpack("<8sIII", f.read(20))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{} is not a measurement archive".format(path))
+        found = json.loads(f.read(channels_size).decode("utf8"))
+    if found != list(channels):
+        raise ValueError("archive channels {} do not match {}".format(found, list(channels)))
+    return header_size
+
+
+def archive_channels(path):
+    # channel layout of an existing archive, for readers that don't know it in advance
+    with open(path, "rb") as f:
+        magic, version, header_size, channels_size = struct.unpack("<8sIII", f.read(20))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{} is not a measurement archive".format(path))
+        return json.loads(f.read(channels_size).decode("utf8"))
+
+
+def read_csv_columns(path, channels):
+    with open(path, "r") as f:
+        reader = csv.reader(f, skipinitialspace=True)
+        header = next(reader, None)
+        columns = list(zip(*reader)) if header is not None else []
+    if not columns:
+        return np.zeros(0, dtype=np.int64), np.zeros((len(channels), 0), dtype=np.float32)
+    # whole columns are converted at once instead of parsing every cell separately
+    times = np.array(columns[header.index("time")], dtype="datetime64[us]").astype(np.int64)
+    values = np.zeros((len(channels), len(times)), dtype=np.float32)
+    for name, column in zip(header, columns):
+        if name in channels:
+            values[channels.index(name)] = np.array(column, dtype=np.float32)
+    return times, values
+
+
+def convert_csv(csv_path, archive_path, channels):
+    times, values = read_csv_columns(csv_path, channels)
+    temporary_path = archive_path + ".tmp"
+    if os.path.isfile(temporary_path):
+        os.remove(temporary_path)
+    archive = MeasurementArchive(temporary_path, channels)
+    archive.append(times, values)
+    os.replace(temporary_path, archive_path)
+    print("Converted {} measurements from {} to {}".format(len(times), csv_path, archive_path))
+    return len(times)
+
+
+if __name__ == "__main__":
+    # python -m scripts.archive data/data.csv data/data.bin
+    csv_path, archive_path = sys.argv[1], sys.argv[2]
+    with open(csv_path, "r") as f:
+        header = next(csv.reader(f, skipinitialspace=True))
+    convert_csv(csv_path, archive_path, [name for name in header if name != "time"])
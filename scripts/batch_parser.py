@@ -0,0 +1,117 @@
+import numpy as np
+
+
+class DataLayout():
+    # everything needed to parse one key order of a data message, resolved once per distinct key order
+    def __init__(self, keys, stored_index, converters):
+        self.keys = keys
+        self.stored_keys = []
+        self.stored_positions = []
+        stored_slots = []
+        self.other = []
+        self.stored_other = []
+        for position, key in enumerate(keys):
+            value_position = 2 + 2 * position
+            if key in stored_index:
+                self.stored_other.append((value_position, key, float))
+                self.stored_keys.append((value_position - 1, key))
+                self.stored_positions.append(value_position)
+                stored_slots.append(stored_index[key])
+            elif key in converters:
+                self.other.append((value_position, key, converters[key]))
+            else:
+                print("UNKNOWN KEY: ", key)
+        self.stored_slots = np.array(stored_slots, dtype=np.intp)
+        self.current_fields = self.other + self.stored_other
+        self.complete = len(stored_slots) == len(stored_index)
+        self.in_order = self.complete and stored_slots == list(range(len(stored_slots)))
+        # np.loadtxt record of a uniform batch: the stored keys as bytes one longer than the key (so a longer
+        # one can't match), then the stored values, parsed as float64 (numpy parses float32 slower, the cast
+        # rounds the same)
+        fields = [("k{}".format(i), "S{}".format(len(key) + 1)) for i, (position, key) in enumerate(self.stored_keys)]
+        self.expected_keys = np.array([tuple(key.encode() for position, key in self.stored_keys)],
+                                      dtype=fields).tobytes()
+        self.record = np.dtype(fields + [("v{}".format(i), np.float64) for i in range(len(self.stored_positions))])
+        self.columns = [position for position, key in self.stored_keys] + self.stored_positions
+
+
+class BatchParser():
+    # parses a batch of "data|key|value|..." lines into a (channels, n) float32 block in one go:
+    # each key order is compiled to a DataLayout once, the stored values of the whole batch are converted
+    # by numpy at once and current_data is only updated from the last line
+    def __init__(self, in_names_reversed, parse_functions, stored_names, current_data):
+        self.stored_names = stored_names
+        self.stored_index = {name: i for i, name in enumerate(stored_names)}
+        self.converters = {name: parse_functions[key] for name, key in in_names_reversed.items()
+                           if name not in self.stored_index and key in parse_functions}
+        self.current_data = current_data
+        self.layouts = {}
+
+    def layout(self, parts):
+        keys = tuple(parts[1::2])
+        layout = self.layouts.get(keys)
+        if layout is None:
+            layout = DataLayout(keys, self.stored_index, self.converters)
+            self.layouts[keys] = layout
+        return layout
+
+    def parse(self, lines):
+        last_parts = lines[-1].split("|")
+        layout = self.layout(last_parts)
+        values = self.parse_uniform(lines, layout)
+        if values is None:
+            values, last = self.parse_mixed(lines)
+        else:
+            last = [(last_parts, layout)]
+        for parts, layout in last:
+            for position, key, converter in layout.current_fields:
+                try:
+                    self.current_data[key] = converter(parts[position])
+                except (ValueError, IndexError):
+                    print("INVALID VALUE: ", key)
+        return values
+
+    def parse_uniform(self, lines, layout):
+        # the arduino always sends the same message, so numpy's loadtxt reads the whole batch in one pass,
+        # provided every line really has the stored keys where the layout has them (the caller only passes
+        # lines starting with "data|")
+        if not layout.complete:
+            return None
+        try:
+            records = np.loadtxt(lines, delimiter="|", comments=None, usecols=layout.columns, dtype=layout.record,
+                                 ndmin=1)
+        except ValueError:
+            return None
+        count = len(records)
+        key_bytes = len(layout.expected_keys)
+        if count != len(lines) or records.view(np.uint8).reshape(count, -1)[:, :key_bytes].tobytes() != \
+                layout.expected_keys * count:
+            return None
+        stored = np.ndarray((len(layout.stored_slots), count), dtype=np.float64, buffer=records, offset=key_bytes,
+                            strides=(8, layout.record.itemsize))
+        if layout.in_order:
+            return stored.astype(np.float32)
+        values = np.empty((len(self.stored_names), count), dtype=np.float32)
+        values[layout.stored_slots] = stored
+        return values
+
+    def parse_mixed(self, lines):
+        # missing channels keep their previous value, like the current_data lookup did per message,
+        # other fields come from the last line of every key order
+        count = len(lines)
+        values = np.full((len(self.stored_names), count + 1), np.nan, dtype=np.float32)
+        values[:, 0] = [self.current_data[name] for name in self.stored_names]
+        last = {}
+        for row, line in enumerate(lines, 1):
+            parts = line.split("|")
+            layout = self.layout(parts)
+            last.pop(layout.keys, None)
+            last[layout.keys] = (parts, layout)
+            for position, slot in zip(layout.stored_positions, layout.stored_slots):
+                try:
+                    values[slot, row] = float(parts[position])
+                except (ValueError, IndexError):
+                    print("INVALID VALUE: ", parts[position - 1])
+        index = np.where(~np.isnan(values), np.arange(count + 1), 0)
+        np.maximum.accumulate(index, axis=1, out=index)
+        return np.take_along_axis(values, index, axis=1)[:, 1:], list(last.values())
@@ -0,0 +1,61 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+from scripts.archive import MeasurementArchive
+from scripts.benchmark_parser import layout_only_fermentor
+from scripts.benchmark_query import fake_history, measure
+
+# python -m scripts.benchmark_graph [--days 100] [--interval 5]
+# builds the graph page figures for every time window option on a chamber with `days` of history, without a
+# browser: figure build time (best of 3), the size of the json the browser receives for both graphs, the
+# points per trace and the trace type (scatter is drawn as svg, scattergl with webgl)
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="graph figure build time and payload per time window")
+    parser.add_argument("--days", type=float, default=100)
+    parser.add_argument("--interval", type=float, default=5)
+    arguments = parser.parse_args(arguments)
+
+    with tempfile.TemporaryDirectory() as directory:
+        fermentor = layout_only_fermentor()
+        stop = int(time.time() * 1000000)
+        times, values = fake_history(fermentor, stop - int(arguments.days * 86400 * 1000000), stop, arguments.interval)
+        MeasurementArchive(os.path.join(directory, "data.bin"), fermentor.stored_names).append(times, values, sync=True)
+        config = os.path.join(directory, "chambers.json")
+        with open(config, "w", encoding="utf8") as f:
+            json.dump([{"name": "benchmark", "serial_port_name": "/dev/nonexistent", "data_directory": directory}], f)
+        os.environ["FERMENTOR_CHAMBERS"] = config
+
+        import plotly.utils
+        from pages.graph import chamber_manager, graph_page
+        chamber = chamber_manager.get("benchmark")
+        while chamber.loading:
+            time.sleep(0.1)
+
+        print("{} measurements ({:.0f} days)".format(len(times), arguments.days))
+        print("{:<20}{:>12}{:>12}{:>10}{:>12}".format("window", "build ms", "payload kB", "points", "type"))
+        try:
+            for label, window in graph_page.time_options:
+                ranges = graph_page.init_ranges(chamber)
+                resolution = graph_page.resolution(chamber, window, chamber.data_version)
+                figures = []
+                duration = measure(lambda: figures.append(graph_page.render(chamber, window, resolution, *ranges)),
+                                   repeat=3)
+                figure_temperature, figure_humidity, graph_state = figures[-1]
+                payload = json.dumps([figure_temperature, figure_humidity], cls=plotly.utils.PlotlyJSONEncoder)
+                traces = figure_temperature["data"] + figure_humidity["data"]
+                print("{:<20}{:>12.1f}{:>12.1f}{:>10}{:>12}".format(
+                    label, duration * 1000, len(payload) / 1000, max(len(trace["x"]) for trace in traces),
+                    ",".join(sorted(set(trace["type"] for trace in traces)))))
+        finally:
+            chamber.process.terminate()
+            chamber.process.join()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,265 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import resource
+import platform
+import threading
+import functools
+import numpy as np
+from scripts.fermentor import Fermentor
+from scripts.fake_serial import FakeSerial
+from scripts.binary_loopback import fake_data
+from scripts.benchmark_parser import layout_only_fermentor
+
+# python -m scripts.benchmark_ingest [--rates 10,100,1000,max] [--channels 4,16] [--seconds 5] [--binary]
+#                                    [--save baseline.json] [--compare baseline.json] [--tolerance 0.25]
+# drives a whole Fermentor (serial engine, parser, segment log, archive flushes) from a FakeSerial for every
+# rate (messages per second, max = as fast as it goes) and channel count (temperature and humidity sensors
+# each) and reports messages/s, latency percentiles per stage, parse queue depth and memory growth.
+# stages: read = written by the fake port -> stamped by the engine, queue = stamped -> handed to the parser,
+# parse = parse and store of one batch (without flushes), flush = update_database, total = written -> stored.
+# --save keeps the results as a json baseline, --compare exits with 1 when a scenario got slower than the
+# baseline by more than the tolerance (throughput, or p95 total latency).
+
+PERCENTILES = [50, 95, 99]
+POOL_SIZE = 1000
+
+
+def now_us():
+    return int(time.time() * 1000000)
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def message_source(num_devices, binary):
+    # a pool of generated messages played in a loop, generating them on the fly would be the bottleneck
+    fermentor = layout_only_fermentor(num_devices)
+    if binary:
+        pool = [fermentor.codec.encode_data(fake_data(fermentor)) for i in range(POOL_SIZE)]
+    else:
+        pool = [fermentor.generate_fake_message() for i in range(POOL_SIZE)]
+    position = [0]
+
+    def next_message():
+        position[0] += 1
+        return pool[position[0] % len(pool)]
+    return next_message
+
+
+def percentiles(values):
+    if len(values) == 0:
+        return {"p" + str(p): None for p in PERCENTILES}
+    values = np.asarray(values, dtype=np.float64)
+    return {"p" + str(p): float(np.percentile(values, p)) for p in PERCENTILES}
+
+
+class IngestProbe():
+    # wraps the stages of one fermentor and its engine, timestamps every data message on its way through
+    def __init__(self, fermentor):
+        self.fermentor = fermentor
+        self.receive = []
+        self.handed = []
+        self.stored = []
+        self.parse = []
+        self.flush = []
+        self.flushing = 0.0
+        self.queue_depth = []
+        self.rss = []
+        self.sampling = False
+        on_lines = fermentor.engine.on_lines
+        store_messages = fermentor.store_messages
+        update_database = fermentor.update_database
+
+        def timed_on_lines(batch):
+            handed = now_us()
+            for timestamp, message in batch:
+                if isinstance(message, bytes) or message.startswith("data|"):
+                    self.receive.append(timestamp)
+                    self.handed.append(handed)
+            on_lines(batch)
+
+        def timed_store_messages(times, messages):
+            flushing = self.flushing
+            start = time.perf_counter()
+            store_messages(times, messages)
+            self.parse.append(time.perf_counter() - start - (self.flushing - flushing))
+            self.stored.extend([now_us()] * len(messages))
+
+        def timed_update_database():
+            start = time.perf_counter()
+            update_database()
+            duration = time.perf_counter() - start
+            self.flush.append(duration)
+            self.flushing += duration
+        fermentor.engine.on_lines = timed_on_lines
+        fermentor.store_messages = timed_store_messages
+        fermentor.update_database = timed_update_database
+
+    def sample(self, interval=0.002):
+        while self.sampling:
+            self.queue_depth.append(self.fermentor.engine.parse_queue.qsize())
+            self.rss.append(rss_bytes())
+            time.sleep(interval)
+
+    def start_sampling(self):
+        self.sampling = True
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+
+    def stop_sampling(self):
+        self.sampling = False
+        self.sampler.join()
+
+
+def wait_for(condition, timeout):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+
+def run_scenario(rate, channels, seconds, binary, max_count=10000000):
+    num_devices = {"temperature": channels, "humidity": channels}
+    count = max_count if rate is None else max(1, int(rate * seconds))
+    source = message_source(num_devices, binary)
+    with tempfile.TemporaryDirectory() as data_directory:
+        factory = functools.partial(FakeSerial, messages=source, rate=rate, count=count, binary=binary,
+                                    autostart=False)
+        fermentor = Fermentor(serial_port_name="fake", data_directory=data_directory, num_devices=num_devices,
+                              binary_protocol=binary, serial_factory=factory)
+        fermentor.engine.verbose = False
+        # handshake first: protocol, parameters and state are sent and acknowledged
+        wait_for(lambda: fermentor.engine.serial is not None and len(fermentor.engine.serial.commands) >= 2
+                 and not fermentor.engine.pending and not fermentor.engine.in_flight, 5)
+        fake = fermentor.engine.serial
+        probe = IngestProbe(fermentor)
+        rss_start = rss_bytes()
+        probe.start_sampling()
+        start = time.perf_counter()
+        fake.start()
+        if rate is None:
+            # as fast as it goes for the given time, then whatever is on its way is drained
+            time.sleep(seconds)
+            fake.count = fake.sent
+        wait_for(lambda: fake.finished.is_set() and len(probe.stored) >= fake.sent, seconds + 60)
+        duration = time.perf_counter() - start
+        probe.stop_sampling()
+        rss_end = rss_bytes()
+        fermentor.close()
+        fake.close()
+
+    n = len(probe.stored)
+    written = np.array(fake.write_times[:n], dtype=np.int64)
+    receive = np.array(probe.receive[:n], dtype=np.int64)
+    handed = np.array(probe.handed[:n], dtype=np.int64)
+    stored = np.array(probe.stored[:n], dtype=np.int64)
+    return {
+        "rate": "max" if rate is None else rate,
+        "channels": channels,
+        "protocol": "bin" if binary else "text",
+        "messages": n,
+        "lost": fake.sent - n,
+        "seconds": duration,
+        "messages_per_second": n / duration if duration else None,
+        "latency_ms": {
+            "read": percentiles((receive - written) / 1000),
+            "queue": percentiles((handed - receive) / 1000),
+            "parse": percentiles(np.array(probe.parse) * 1000),
+            "flush": percentiles(np.array(probe.flush) * 1000),
+            "total": percentiles((stored - written) / 1000),
+        },
+        "batches": len(probe.parse),
+        "flushes": len(probe.flush),
+        "queue_depth": {"max": int(max(probe.queue_depth, default=0)), **percentiles(probe.queue_depth)},
+        "memory": {
+            "rss_start_mb": rss_start / 2 ** 20,
+            "rss_peak_mb": max(probe.rss, default=rss_end) / 2 ** 20,
+            "growth_mb": (rss_end - rss_start) / 2 ** 20,
+            "growth_bytes_per_message": (rss_end - rss_start) / n if n else None,
+        },
+    }
+
+
+def scenario_key(result):
+    return "{}/{}/{}".format(result["protocol"], result["channels"], result["rate"])
+
+
+def print_result(result):
+    latency = result["latency_ms"]
+    print("{:<16}{:>9}{:>11.0f}{:>9.2f}{:>9.2f}{:>9.2f}{:>9.2f}{:>9.2f}{:>7}{:>9.1f}".format(
+        scenario_key(result), result["messages"], result["messages_per_second"] or 0,
+        latency["read"]["p95"] or 0, latency["queue"]["p95"] or 0, latency["parse"]["p95"] or 0,
+        latency["flush"]["p95"] or 0, latency["total"]["p95"] or 0, result["queue_depth"]["max"],
+        result["memory"]["growth_mb"]))
+
+
+def compare(results, baseline, tolerance):
+    # regressions against a saved run: lower throughput at max rate, or higher p95 total latency
+    old = {scenario_key(x): x for x in baseline["results"]}
+    regressions = []
+    for result in results:
+        key = scenario_key(result)
+        if key not in old:
+            continue
+        before = old[key]
+        if result["rate"] == "max" and result["messages_per_second"] < (1 - tolerance) * before["messages_per_second"]:
+            regressions.append("{}: {:.0f} messages/s, baseline {:.0f}".format(
+                key, result["messages_per_second"], before["messages_per_second"]))
+        p95 = result["latency_ms"]["total"]["p95"]
+        p95_before = before["latency_ms"]["total"]["p95"]
+        # a millisecond of slack, timer and scheduler noise dominates the fast scenarios
+        if p95 is not None and p95_before is not None and p95 > (1 + tolerance) * p95_before + 1:
+            regressions.append("{}: p95 total latency {:.2f} ms, baseline {:.2f} ms".format(key, p95, p95_before))
+    return regressions
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="ingest throughput and latency of the whole serial pipeline")
+    parser.add_argument("--rates", default="10,100,1000,max")
+    parser.add_argument("--channels", default="4,16")
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--binary", action="store_true")
+    parser.add_argument("--save")
+    parser.add_argument("--compare")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    arguments = parser.parse_args(arguments)
+
+    rates = [None if x == "max" else float(x) for x in arguments.rates.split(",")]
+    print("{:<16}{:>9}{:>11}{:>9}{:>9}{:>9}{:>9}{:>9}{:>7}{:>9}".format(
+        "scenario", "messages", "msg/s", "read", "queue", "parse", "flush", "total", "queue", "rss"))
+    print("{:<16}{:>9}{:>11}{:>45}{:>7}{:>9}".format("", "", "", "p95 latency [ms]", "max", "+MB"))
+    results = []
+    for channels in [int(x) for x in arguments.channels.split(",")]:
+        for rate in rates:
+            result = run_scenario(rate, channels, arguments.seconds, arguments.binary)
+            results.append(result)
+            print_result(result)
+
+    report = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": sys.version.split()[0],
+              "machine": platform.platform(), "results": results}
+    if arguments.save:
+        with open(arguments.save, "w", encoding="utf8") as f:
+            json.dump(report, f, indent=2)
+        print("saved", arguments.save)
+    if arguments.compare:
+        with open(arguments.compare, "r", encoding="utf8") as f:
+            regressions = compare(results, json.load(f), arguments.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        if regressions:
+            return 1
+        print("no regressions against", arguments.compare)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,157 @@
+import gc
+import sys
+import time
+import datetime
+import tempfile
+import numpy as np
+from scripts.fermentor import Fermentor
+from scripts.batch_parser import BatchParser
+from scripts.measurement_store import datetime_to_epoch_us
+
+# python -m scripts.benchmark_parser [lines] [batch_size]
+# compares the per message parser with the batch parser on generate_fake_message output, once for parsing
+# alone and once for the whole data path (parse, segment log, unsaved store, rollups, parameters, archive).
+# the target is 10x on parsing alone; the ingest ratio is reported but not gated on, its legacy baseline
+# also appends every sample to the segment log on its own. throughput matters when lines queue up, and the
+# serial engine then hands the parser everything queued at once, so the default batch is 1000 lines
+# (smaller batches pay numpy's per call overhead more often, about 10% less at 100)
+PARSE_TARGET = 10
+
+
+def layout_only_fermentor(num_devices=None):
+    # parsing only needs the names and converters, not the serial port or the storage
+    fermentor = Fermentor.__new__(Fermentor)
+    fermentor.init_layout(60, 2, 10, 1, num_devices)
+    return fermentor
+
+
+def storage_fermentor(data_directory):
+    fermentor = layout_only_fermentor()
+    fermentor.data_directory = data_directory
+    fermentor.init_metrics()
+    fermentor.init_storage()
+    fermentor.init_alarms()
+    return fermentor
+
+
+def legacy_parse_message(fermentor, data):
+    # the per message parser this replaced: split, pop, list scan, dict lookups and a lambda per field
+    message_list = data.split('|')
+    head = message_list.pop(0)
+    for i in range(0, len(message_list), 2):
+        key = message_list[i]
+        value = message_list[i + 1]
+        if key in fermentor.all_in_names:
+            fermentor.current_data[key] = fermentor.parse_functions[fermentor.in_names_reversed[key]](value)
+        else:
+            print("UNKNOWN KEY: ", key)
+    return np.array([fermentor.current_data[name] for name in fermentor.raw_names], dtype=np.float32)
+
+
+def legacy_parse(fermentor, lines):
+    return np.array([legacy_parse_message(fermentor, data) for data in lines]).T
+
+
+def legacy_ingest(fermentor, lines):
+    # the per message data path this replaced, every sample stored on its own
+    for data in lines:
+        timestamp = datetime_to_epoch_us(datetime.datetime.utcnow())
+        row = fermentor.derived.compute([timestamp], legacy_parse_message(fermentor, data)[:, None])[:, 0]
+        fermentor.measurements_unsaved.append(timestamp, row)
+        fermentor.log.append(fermentor.archive.to_records([timestamp], row[:, None]).tobytes())
+        fermentor.rollups.add(timestamp, row)
+        fermentor.measurement_unsaved_count += 1
+        fermentor.save_parameters()
+        fermentor.update_parameters(state=fermentor.current_data[fermentor.in_names["state"][0]],
+                                    time_left=fermentor.current_data[fermentor.in_names["time_left"][0]])
+        if fermentor.measurement_unsaved_count == fermentor.measurement_unsaved_limit:
+            fermentor.update_database()
+            fermentor.measurement_unsaved_count = 0
+
+
+def batch_parse(parser, lines, batch_size):
+    blocks = []
+    for start in range(0, len(lines), batch_size):
+        blocks.append(parser.parse(lines[start:start + batch_size]))
+    return np.concatenate(blocks, axis=1)
+
+
+def batch_ingest(fermentor, lines, batch_size):
+    for start in range(0, len(lines), batch_size):
+        timestamp = int(time.time() * 1000000)
+        fermentor.parse_lines([(timestamp, line) for line in lines[start:start + batch_size]])
+
+
+def measure(function, repeat=5):
+    # best of `repeat` runs with the garbage collector off, like timeit
+    best = None
+    for i in range(repeat):
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            result = function()
+            duration = time.perf_counter() - start
+        finally:
+            gc.enable()
+        best = duration if best is None else min(best, duration)
+    return best, result
+
+
+def measure_alternating(functions, repeat=7):
+    # best of `repeat` rounds that run every function in turn, so a slow spell of the machine hits all of them
+    best = [None] * len(functions)
+    results = [None] * len(functions)
+    for i in range(repeat):
+        for j, function in enumerate(functions):
+            duration, results[j] = measure(function, repeat=1)
+            best[j] = duration if best[j] is None else min(best[j], duration)
+    return best, results
+
+
+def stored_values(fermentor):
+    fermentor.update_database()
+    fermentor.log.close()
+    # derived rates follow the receive times, which differ between the two paths
+    return fermentor.archive.columns()[1][:len(fermentor.raw_names)]
+
+
+def main(count=20000, batch_size=1000):
+    lines = [layout_only_fermentor().generate_fake_message() for i in range(count)]
+
+    legacy_fermentor = layout_only_fermentor()
+    fermentor = layout_only_fermentor()
+    parser = BatchParser(fermentor.in_names_reversed, fermentor.parse_functions, fermentor.raw_names,
+                         fermentor.current_data)
+    (legacy_parse_time, batch_parse_time), (legacy_values, batch_values) = measure_alternating(
+        [lambda: legacy_parse(legacy_fermentor, lines), lambda: batch_parse(parser, lines, batch_size)])
+    if not np.array_equal(legacy_values, batch_values):
+        print("MISMATCH between legacy and batch parser")
+        return 1
+
+    with tempfile.TemporaryDirectory() as legacy_directory, tempfile.TemporaryDirectory() as batch_directory:
+        fermentor = storage_fermentor(legacy_directory)
+        legacy_ingest_time, result = measure(lambda: legacy_ingest(fermentor, lines), repeat=1)
+        legacy_values = stored_values(fermentor)
+        fermentor = storage_fermentor(batch_directory)
+        batch_ingest_time, result = measure(lambda: batch_ingest(fermentor, lines, batch_size), repeat=1)
+        batch_values = stored_values(fermentor)
+    if not np.array_equal(legacy_values, batch_values):
+        print("MISMATCH between legacy and batch data path")
+        return 1
+
+    print("{} lines, batches of {}".format(count, batch_size))
+    print("{:<8}{:>16}{:>16}{:>10}".format("", "legacy lines/s", "batch lines/s", "speedup"))
+    for name, legacy_time, batch_time in [("parse", legacy_parse_time, batch_parse_time),
+                                          ("ingest", legacy_ingest_time, batch_ingest_time)]:
+        print("{:<8}{:>16.0f}{:>16.0f}{:>9.1f}x".format(name, count / legacy_time, count / batch_time,
+                                                        legacy_time / batch_time))
+    speedup = legacy_parse_time / batch_parse_time
+    if speedup < PARSE_TARGET:
+        # np.loadtxt tokenizing the lines and converting the values takes nearly all of the batch time
+        print("parse speedup {:.1f}x is short of the {}x target".format(speedup, PARSE_TARGET))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(*[int(x) for x in sys.argv[1:3]]))
@@ -0,0 +1,98 @@
+import sys
+import time
+import datetime
+import tempfile
+import numpy as np
+import pandas as pd
+from scripts.benchmark_parser import layout_only_fermentor
+
+# python -m scripts.benchmark_query [sample_interval_seconds]
+# grows the history of one chamber from 1 day to 6 months and times what a graph refresh reads:
+# the old way (a DataFrame of the whole history, then filtered to the window) against Fermentor.query
+
+HISTORIES = [("1d", 1), ("7d", 7), ("1mo", 31), ("3mo", 92), ("6mo", 183)]
+WINDOWS = [("10 min", datetime.timedelta(minutes=10)), ("1 d", datetime.timedelta(days=1)),
+           ("1 mo", datetime.timedelta(days=31))]
+MAX_POINTS = 2000
+
+
+def fake_history(fermentor, start, stop, interval):
+    times = np.arange(start, stop, int(interval * 1000000), dtype=np.int64)
+    phase = (times - times[0] if len(times) else times) / 3.6e9
+    values = np.empty((len(fermentor.stored_names), len(times)), dtype=np.float32)
+    for i in range(len(fermentor.stored_names)):
+        values[i] = 60 + 10 * np.sin(phase + i) + np.random.normal(0, 0.5, len(times))
+    return times, values
+
+
+def query_fermentor(data_directory):
+    # queries also look for history moved to the day chunks, empty here
+    fermentor = layout_only_fermentor()
+    fermentor.data_directory = data_directory
+    fermentor.init_metrics()
+    fermentor.init_retention()
+    return fermentor
+
+
+def legacy_window(fermentor, time_delta):
+    df = pd.DataFrame(fermentor.measurements.to_columns())
+    cutoff_time = df["time"].max() - time_delta
+    return df[df["time"] > cutoff_time]
+
+
+def query_window(fermentor, time_delta):
+    start = fermentor.last_time() - time_delta // datetime.timedelta(microseconds=1)
+    return pd.DataFrame(fermentor.query(start, None, fermentor.stored_names, MAX_POINTS))
+
+
+def measure(function, repeat=5):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+def main(interval=5.0):
+    with tempfile.TemporaryDirectory() as directory:
+        return run(query_fermentor(directory), interval)
+
+
+def run(fermentor, interval):
+    end = int(time.time() * 1000000)
+    loaded_days = 0
+    print("sample every {}s, query max_points {}, best of 5 in ms".format(interval, MAX_POINTS))
+    print("{:<8}{:>10}".format("history", "rows") + "".join("{:>16}{:>16}".format("legacy " + name, "query " + name)
+                                                               for name, time_delta in WINDOWS))
+    latencies = []
+    for name, days in HISTORIES:
+        # older history is added in front, the newest sample stays where it is
+        start = end - days * 86400 * 1000000
+        stop = end - loaded_days * 86400 * 1000000 if loaded_days else end
+        older_times, older_values = fake_history(fermentor, start, stop, interval)
+        times, values = fermentor.measurements.snapshot()
+        fermentor.measurements.clear()
+        fermentor.rollups.clear()
+        fermentor.measurements.extend(np.concatenate((older_times, times)), np.concatenate((older_values, values), axis=1))
+        times, values = fermentor.measurements.snapshot()
+        fermentor.rollups.extend(times, values)
+        loaded_days = days
+
+        row = "{:<8}{:>10}".format(name, len(fermentor.measurements))
+        query_latencies = []
+        for window_name, time_delta in WINDOWS:
+            legacy = measure(lambda: legacy_window(fermentor, time_delta), repeat=2)
+            query = measure(lambda: query_window(fermentor, time_delta))
+            query_latencies.append(query)
+            row += "{:>16.2f}{:>16.2f}".format(1000 * legacy, 1000 * query)
+        latencies.append(query_latencies)
+        print(row)
+    growth = max(last / first for first, last in zip(latencies[0], latencies[-1]))
+    print("query latency growth from {} to {} history: {:.1f}x".format(HISTORIES[0][0], HISTORIES[-1][0], growth))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(*[float(x) for x in sys.argv[1:2]]))
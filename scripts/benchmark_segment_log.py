@@ -0,0 +1,39 @@
+import sys
+import time
+import tempfile
+import numpy as np
+from scripts.archive import record_dtype
+from scripts.segment_log import SegmentLog
+
+# python -m scripts.benchmark_segment_log [samples]
+# fsync cost per sample for different group commit sizes, measured on the filesystem holding the temp dir
+
+
+def measure(commit_every, samples, payload):
+    with tempfile.TemporaryDirectory() as directory:
+        log = SegmentLog(directory, commit_every=commit_every, commit_interval=3600)
+        start = time.perf_counter()
+        for i in range(samples):
+            log.append(payload)
+        log.close()
+        duration = time.perf_counter() - start
+        return {
+            "commit_every": commit_every,
+            "fsyncs": log.fsync_count,
+            "fsync_per_sample_ms": 1000 * log.fsync_cost_per_sample(),
+            # worst single fsync spread over its group: the upper bound a sample pays
+            "fsync_per_sample_bound_ms": 1000 * log.fsync_max_time / commit_every,
+            "samples_per_second": samples / duration,
+        }
+
+
+if __name__ == "__main__":
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    channels = ["t" + str(i) for i in range(4)] + ["h" + str(i) for i in range(4)]
+    payload = np.zeros(1, dtype=record_dtype(channels)).tobytes()
+    print("{:>12} {:>8} {:>20} {:>20} {:>16}".format("commit_every", "fsyncs", "fsync/sample [ms]",
+                                                     "bound/sample [ms]", "samples/s"))
+    for commit_every in [1, 5, 10, 50, 100]:
+        result = measure(commit_every, samples, payload)
+        print("{commit_every:>12} {fsyncs:>8} {fsync_per_sample_ms:>20.4f} {fsync_per_sample_bound_ms:>20.4f} "
+              "{samples_per_second:>16.0f}".format(**result))
@@ -0,0 +1,120 @@
+import os
+import pty
+import sys
+import tty
+import time
+import select
+import datetime
+import tempfile
+import threading
+import numpy as np
+from scripts.fermentor import Fermentor
+from scripts.binary_protocol import layout_string
+from scripts.serial_engine import split_sequence
+
+# python -m scripts.binary_loopback [samples]
+# plays the arduino on a pseudo terminal: answers the handshake, switches to binary frames when asked
+# for the matching layout, streams frames mixed with text and one corrupted frame, then checks what
+# the fermentor stored. posix only.
+
+
+def fake_data(fermentor):
+    data = fermentor.create_empty_current_data()
+    for name in fermentor.in_names["temperature"]:
+        data[name] = round(np.random.uniform(50, 90), 2)
+    for name in fermentor.in_names["humidity"]:
+        data[name] = round(np.random.uniform(70, 100), 2)
+    for key in ["fan", "heater", "moisturizer"]:
+        for name in fermentor.in_names[key]:
+            data[name] = bool(np.random.randint(0, 2))
+    data[fermentor.in_names["time_left"][0]] = datetime.timedelta(seconds=int(np.random.randint(0, 100000)))
+    data[fermentor.in_names["state"][0]] = "start"
+    return data
+
+
+class FakeArduino():
+    def __init__(self, master, layout):
+        self.master = master
+        self.layout = layout
+        self.binary_mode = False
+        self.commands = []
+        self.thread = threading.Thread(target=self.serial_read, daemon=True)
+
+    def write(self, data):
+        os.write(self.master, data)
+
+    def serial_read(self):
+        while True:
+            readable, writable, failed = select.select([self.master], [], [], 0.1)
+            if not readable:
+                continue
+            try:
+                data = os.read(self.master, 1024).decode()
+            except OSError:
+                return
+            # several commands can be on their way at once
+            for line in data.splitlines():
+                command, sequence = split_sequence(line)
+                self.commands.append(command)
+                if command.startswith("proto|"):
+                    self.binary_mode = command == "proto|bin|" + self.layout
+                    self.write(b"info|proto|bin\r\n" if self.binary_mode else b"info|proto|text\r\n")
+                self.write("info|done|{}\r\n".format(sequence).encode())
+
+
+def main(samples=1000):
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    with tempfile.TemporaryDirectory() as data_directory:
+        fermentor = Fermentor(serial_port_name=os.ttyname(slave), data_directory=data_directory, binary_protocol=True)
+        fermentor.engine.verbose = False
+        arduino = FakeArduino(master, layout_string(fermentor.num_devices))
+        arduino.thread.start()
+        time.sleep(0.5)
+        arduino.write(b"info|Starting scheduler\r\n")
+        deadline = time.time() + 5
+        while fermentor.protocol != "bin" and time.time() < deadline:
+            time.sleep(0.01)
+        print("commands received:", arduino.commands)
+        if fermentor.protocol != "bin":
+            print("NEGOTIATION FAILED")
+            return 1
+
+        data = [fake_data(fermentor) for i in range(samples)]
+        frames = [fermentor.codec.encode_data(x) for x in data]
+        text = (fermentor.generate_fake_message() + "\r\n").encode()
+        print("bytes per sample: text {}, binary {}".format(len(text), len(frames[0])))
+        corrupted = bytearray(frames[0])
+        corrupted[5] ^= 0xFF
+        stream = b"".join(frames[:samples // 2]) + b"info|halfway there\r\n" + bytes(corrupted) \
+            + b"".join(frames[samples // 2:])
+        start = time.perf_counter()
+        for i in range(0, len(stream), 256):
+            arduino.write(stream[i:i + 256])
+        deadline = time.time() + 10
+        while len(fermentor.measurements) + len(fermentor.measurements_unsaved) < samples and time.time() < deadline:
+            time.sleep(0.001)
+        duration = time.perf_counter() - start
+        # the last batches may still be on their way through the parser thread
+        fermentor.engine.stop()
+        fermentor.update_database()
+        fermentor.close()
+
+        times, values = fermentor.archive.columns()
+        expected = np.array([[x[name] for x in data] for name in fermentor.raw_names], dtype=np.float32)
+        last = data[-1]
+        print("{} frames stored in {:.1f} ms, crc errors {}".format(values.shape[1], 1000 * duration,
+                                                                    fermentor.engine.framer.crc_errors))
+        if not np.array_equal(values[:len(fermentor.raw_names)], expected):
+            print("MISMATCH in stored values")
+            return 1
+        if any(fermentor.current_data[name] != last[name] for name in fermentor.codec.switch_names
+               + [fermentor.in_names["time_left"][0], fermentor.in_names["state"][0]]):
+            print("MISMATCH in current data")
+            return 1
+        print("OK")
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(*[int(x) for x in sys.argv[1:2]]))
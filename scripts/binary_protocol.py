@@ -0,0 +1,140 @@
+import struct
+import binascii
+import datetime
+import numpy as np
+from scripts.serial_engine import LineFramer
+
+# frame: sync | type | payload length | payload | crc16 (ccitt, init 0xffff) of type, length and payload
+# data payload, little endian, channel order fixed by num_devices:
+#   temperatures, humidities (int16, value * 100, -32768 = nan) | fans, heaters, moisturizers (bits, lsb first)
+#   | time left (uint32 seconds) | tH, hH, tT, hT (int16, value * 100) | state (uint8, index into STATES)
+SYNC = 0xA5
+SYNC_BYTE = bytes([SYNC])
+FRAME_DATA = 0x01
+HEADER = struct.Struct("<BBB")
+CRC = struct.Struct("<H")
+NAN_VALUE = -32768
+SCALE = 100
+STATES = ["stop", "start", "pause"]
+LAYOUT_KEYS = ["temperature", "humidity", "fan", "heater", "moisturizer"]
+SWITCH_KEYS = ["fan", "heater", "moisturizer"]
+PARAMETER_KEYS = ["temperature_hysteresis", "humidity_hysteresis", "temperature_target", "humidity_target"]
+
+
+def crc16(data):
+    return binascii.crc_hqx(data, 0xFFFF)
+
+
+def layout_string(num_devices):
+    # both sides have to agree on the channel counts before the arduino switches to binary frames
+    return ".".join(str(num_devices[key]) for key in LAYOUT_KEYS)
+
+
+def frame(frame_type, payload):
+    body = bytes([frame_type, len(payload)]) + payload
+    return SYNC_BYTE + body + CRC.pack(crc16(body))
+
+
+class BinaryCodec():
+    def __init__(self, in_names, stored_names):
+        self.sensor_names = in_names["temperature"] + in_names["humidity"]
+        self.switch_names = [name for key in SWITCH_KEYS for name in in_names[key]]
+        self.parameter_names = [name for key in PARAMETER_KEYS for name in in_names[key]]
+        self.time_left_name = in_names["time_left"][0]
+        self.state_name = in_names["state"][0]
+        self.stored_names = stored_names
+        self.switch_bytes = (len(self.switch_names) + 7) // 8
+        self.dtype = np.dtype([(name, "<i2") for name in self.sensor_names]
+                              + [("switches", "u1", (self.switch_bytes,)), (self.time_left_name, "<u4")]
+                              + [(name, "<i2") for name in self.parameter_names]
+                              + [(self.state_name, "u1")])
+        self.payload_size = self.dtype.itemsize
+
+    def encode_data(self, data):
+        record = np.zeros((), dtype=self.dtype)
+        for name in self.sensor_names + self.parameter_names:
+            value = data[name]
+            record[name] = NAN_VALUE if np.isnan(value) else int(round(value * SCALE))
+        switches = np.array([bool(data[name]) for name in self.switch_names], dtype=np.uint8)
+        record["switches"] = np.packbits(switches, bitorder="little") if len(switches) else 0
+        record[self.time_left_name] = int(data[self.time_left_name].total_seconds())
+        record[self.state_name] = STATES.index(data[self.state_name]) if data[self.state_name] in STATES else 0
+        return frame(FRAME_DATA, record.tobytes())
+
+    def fixed_point(self, raw):
+        values = raw.astype(np.float64) / SCALE
+        values[raw == NAN_VALUE] = np.nan
+        return values
+
+    def decode_data(self, bodies):
+        # bodies are type, length and payload of consecutive data frames, decoded together
+        header_size = HEADER.size - 1
+        records = np.frombuffer(b"".join(body[header_size:] for body in bodies), dtype=self.dtype)
+        values = np.array([self.fixed_point(records[name]) for name in self.stored_names], dtype=np.float32)
+        last = records[-1:]
+        current = {name: float(self.fixed_point(last[name])[0]) for name in self.sensor_names + self.parameter_names}
+        last = last[0]
+        switches = np.unpackbits(last["switches"], bitorder="little")
+        for name, switch in zip(self.switch_names, switches):
+            current[name] = bool(switch)
+        current[self.time_left_name] = datetime.timedelta(seconds=int(last[self.time_left_name]))
+        state = int(last[self.state_name])
+        current[self.state_name] = STATES[state] if state < len(STATES) else ""
+        return values, current
+
+
+class FrameDecoder(LineFramer):
+    # splits a byte stream that mixes text lines and binary frames: text lines come out as str,
+    # valid frames as bytes (type, length and payload), a bad crc resynchronizes on the next sync byte
+    def __init__(self, frame_sizes, max_line_length=4096):
+        LineFramer.__init__(self, max_line_length)
+        self.frame_sizes = frame_sizes
+        self.crc_errors = 0
+
+    def feed(self, data):
+        if SYNC not in data and SYNC not in self.buffer:
+            return LineFramer.feed(self, data)
+        self.buffer += data
+        buffer = self.buffer
+        messages = []
+        position = 0
+        while position < len(buffer):
+            if buffer[position] == SYNC:
+                if len(buffer) - position < HEADER.size:
+                    break
+                sync, frame_type, length = HEADER.unpack_from(buffer, position)
+                if self.frame_sizes.get(frame_type) != length:
+                    position += 1
+                    continue
+                end = position + HEADER.size + length + CRC.size
+                if end > len(buffer):
+                    break
+                body = bytes(buffer[position + 1:end - CRC.size])
+                if crc16(body) == CRC.unpack_from(buffer, end - CRC.size)[0]:
+                    messages.append(body)
+                    position = end
+                else:
+                    self.crc_errors += 1
+                    position += 1
+                continue
+            newline = buffer.find(b"\n", position)
+            sync = buffer.find(SYNC_BYTE, position)
+            if sync != -1 and (newline == -1 or sync < newline):
+                # a frame cut into an unfinished text line
+                if buffer[position:sync].strip():
+                    print("INCOMPLETE LINE, dropped", sync - position, "bytes")
+                    self.dropped_bytes += sync - position
+                position = sync
+                continue
+            if newline == -1:
+                break
+            line = buffer[position:newline]
+            position = newline + 1
+            if line.strip():
+                messages.append(line.decode("utf-8", errors="replace").rstrip())
+        del buffer[:position]
+        if len(buffer) > self.max_line_length:
+            print("LINE TOO LONG, dropped", len(buffer), "bytes")
+            self.dropped_bytes += len(buffer)
+            buffer.clear()
+        return messages
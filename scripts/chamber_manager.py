@@ -0,0 +1,407 @@
+import os
+import json
+import time
+import queue
+import threading
+import functools
+import collections
+import multiprocessing
+from multiprocessing.connection import Client
+from serial.tools import list_ports
+from scripts.fermentor import Fermentor
+from scripts.archive import ArchiveView, MeasurementArchive
+from scripts.replay import ReplayEngine
+from scripts.serial_engine import SerialEngine
+from scripts.metrics import Registry
+from scripts.shared_state import SharedRing, shared_name, control_address, control_key
+
+ARDUINO_VENDOR_IDS = [0x2341, 0x2a03, 0x1a86]
+COMMANDS = ["update_parameters", "send_parameters", "start_fermentation", "stop_fermentation",
+            "pause_fermentation", "resume_fermentation", "start_profiler", "stop_profiler", "start_capture",
+            "stop_capture", "control_replay", "metrics_snapshot"]
+METRICS_INTERVAL = 5
+HEARTBEAT_TIMEOUT = 5
+
+
+def discover_chambers():
+    ports = [x for x in list_ports.comports() if x.vid in ARDUINO_VENDOR_IDS or "Arduino" in (x.description or "")]
+    return [{"name": "chamber" + str(i), "serial_port_name": port.device} for i, port in enumerate(ports)]
+
+
+def load_chamber_config(path=None):
+    # [{"name": "chamber0", "serial_port_name": "/dev/ttyACM0", "serial_baud_rate": 9600}, ...]
+    # optional: "binary_protocol": true switches firmware that supports it to binary frames (text by default),
+    # "capture_path": "data/chamber0.capture" records the serial traffic, "replay": {"source":
+    # "data/chamber0.capture", "speed": 100, "anchor": "now"} plays a recording instead of opening the port,
+    # "retention": {"hot_days": 2, "cold_after_days": 90, "cold_action": "downsample"} (scripts.retention),
+    # "derived": [{"name": "t_avg", "function": "mean", "inputs": ["t0", "t1"]}, ...] (scripts.derived),
+    # "alarms": {"hold_seconds": 60, "stale_seconds": 600, "heater_seconds": 3600} (scripts.alarms)
+    path = path or os.environ.get("FERMENTOR_CHAMBERS", "data/chambers.json")
+    if os.path.isfile(path):
+        with open(path, "r", encoding="utf8") as f:
+            chambers = json.load(f)
+    else:
+        chambers = discover_chambers()
+    if not chambers:
+        # single chamber setup keeps its history directly in data/
+        chambers = [{"name": "main", "serial_port_name": "COM3", "data_directory": "data"}]
+    for chamber in chambers:
+        chamber.setdefault("serial_baud_rate", 9600)
+        chamber.setdefault("binary_protocol", False)
+        chamber.setdefault("data_directory", os.path.join("data", chamber["name"]))
+    return chambers
+
+
+def create_fermentor(config, start_engine=True):
+    engine_factory = SerialEngine
+    if config.get("replay"):
+        engine_factory = functools.partial(ReplayEngine, **config["replay"])
+    return Fermentor(serial_port_name=config["serial_port_name"], serial_baud_rate=config["serial_baud_rate"],
+                     data_directory=config["data_directory"], binary_protocol=config["binary_protocol"],
+                     engine_factory=engine_factory, capture_path=config.get("capture_path"),
+                     retention=config.get("retention"), derived=config.get("derived"), alarms=config.get("alarms"),
+                     start_engine=start_engine)
+
+
+def run_command(fermentor, name, args, kwargs):
+    try:
+        return getattr(fermentor, name)(*args, **kwargs) if name in COMMANDS else "UNKNOWN COMMAND"
+    except Exception as e:
+        return "COMMAND FAILED: " + str(e)
+
+
+def run_chamber(config, data_queue, connection):
+    # worker process: owns one serial port and its storage, streams every new sample to the web process.
+    # the port is only read once the listeners are attached and the recovered rows are in the archive the
+    # web process loads on "ready", so no row is published before that or missed by both
+    fermentor = create_fermentor(config, start_engine=False)
+
+    def publish(times, values):
+        data_queue.put(("data", times, values, fermentor.current_data.copy(), fermentor.params))
+    fermentor.listeners.append(publish)
+    fermentor.command_listeners.append(lambda commands: data_queue.put(("commands", commands)))
+    fermentor.alarm_listeners.append(lambda state: data_queue.put(("alarms", state)))
+
+    def publish_metrics():
+        while True:
+            fermentor.check_silence()
+            data_queue.put(("metrics", fermentor.metrics.snapshot()))
+            time.sleep(METRICS_INTERVAL)
+    threading.Thread(target=publish_metrics, daemon=True).start()
+    fermentor.update_database()
+    data_queue.put(("ready", fermentor.current_data.copy(), fermentor.params))
+    data_queue.put(("alarms", fermentor.alarm_state))
+    fermentor.engine.start()
+    while True:
+        name, args, kwargs = connection.recv()
+        result = run_command(fermentor, name, args, kwargs)
+        connection.send((result, fermentor.params))
+
+
+class ChamberProxy(Fermentor):
+    # what the web process sees of a chamber: same layout, stores and commands as a Fermentor,
+    # filled from the worker process instead of a serial port
+    def __init__(self, config, default_temperature_target=60, default_temperature_hysteresis=2,
+                 default_humidity_target=10, default_humidity_hysteresis=1):
+        self.config = config
+        self.name = config["name"]
+        self.data_directory = config["data_directory"]
+        self.init_layout(default_temperature_target, default_temperature_hysteresis,
+                         default_humidity_target, default_humidity_hysteresis, derived=config.get("derived"))
+        self.ready = False
+        # the history is read in the background once the worker has recovered it
+        self.loading = True
+        self.process = None
+        self.connection = None
+        self.connection_lock = threading.Lock()
+        self.data_queue = None
+        self.consumer_thread = None
+        self.restarts = 0
+        self.worker_metrics = []
+        self.alarm_state = {"active": [], "events": []}
+        self.metrics = Registry()
+        self.metrics.gauge("chamber_ready", "1 while the chamber worker is connected", lambda: int(self.ready))
+        self.metrics.gauge("chamber_loading", "1 until the history is loaded", lambda: int(self.loading))
+        self.metrics.counter("chamber_worker_restarts_total", "Chamber workers restarted after dying",
+                             lambda: self.restarts)
+        self.metrics.gauge("rows_in_memory", "Measurements held by the web process",
+                           lambda: len(self.measurements) + len(self.measurements_unsaved))
+        self.init_retention(config.get("retention"))
+        self.retention_interval = 60.0
+
+    def start(self):
+        self.data_queue = multiprocessing.Queue()
+        self.connection, worker_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=run_chamber, name="chamber-" + self.name, daemon=True,
+                                               args=(self.config, self.data_queue, worker_connection))
+        self.process.start()
+        if self.consumer_thread is None:
+            self.consumer_thread = threading.Thread(target=self.consumer_function, daemon=True)
+            self.consumer_thread.start()
+        print("chamber", self.name, "started on", self.config["serial_port_name"], "pid", self.process.pid)
+
+    def consumer_function(self):
+        while True:
+            try:
+                message = self.data_queue.get(timeout=5)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    print("chamber", self.name, "worker died, restarting")
+                    self.ready = False
+                    self.restarts += 1
+                    self.start()
+                continue
+            if message[0] == "ready":
+                self.load_history()
+                self.current_data, self.params = message[1], message[2]
+                self.ready = True
+                self.state_changed()
+            elif message[0] == "metrics":
+                self.worker_metrics = message[1]
+            elif message[0] == "commands":
+                self.command_log = collections.OrderedDict((x["sequence"], x) for x in message[1])
+                self.state_changed()
+            elif message[0] == "alarms":
+                self.alarm_state = message[1]
+                self.state_changed()
+            elif message[0] == "data":
+                self.current_data, self.params = message[3], message[4]
+                self.add_rows(message[1], message[2])
+
+    def add_rows(self, times, values):
+        last_time = self.measurements.last_time()
+        if last_time is not None:
+            keep = times > last_time
+            times, values = times[keep], values[:, keep]
+        self.measurements.extend(times, values)
+        self.index_data(times, values)
+        if time.time() - self.retention_checked > self.retention_interval:
+            # the worker moves old days into chunks, the web process lets go of them afterwards
+            self.retention_checked = time.time()
+            self.trim_history()
+
+    def connection_status(self):
+        if self.loading:
+            return "loading history"
+        return "connected" if self.ready else "offline"
+
+    def load_history(self):
+        # the worker has recovered and flushed everything it had before it reported ready
+        self.loading = True
+        self.state_changed()
+        archive = MeasurementArchive(os.path.join(self.data_directory, "data.bin"), self.stored_names)
+        times, values = archive.columns()
+        self.measurements.clear()
+        self.rollups.clear()
+        self.stats.clear()
+        self.measurements.extend(times, values)
+        self.index_data(times, values)
+        self.loading = False
+
+    def command(self, name, *args, **kwargs):
+        if not self.ready:
+            return "CHAMBER NOT CONNECTED"
+        with self.connection_lock:
+            self.connection.send((name, args, kwargs))
+            result, self.params = self.connection.recv()
+        self.state_changed()
+        return result
+
+    def update_parameters(self, *args, **kwargs):
+        return self.command("update_parameters", *args, **kwargs)
+
+    def send_parameters(self):
+        return self.command("send_parameters")
+
+    def start_fermentation(self, n_minutes):
+        return self.command("start_fermentation", n_minutes)
+
+    def stop_fermentation(self, foo=None):
+        return self.command("stop_fermentation")
+
+    def pause_fermentation(self, foo=None):
+        return self.command("pause_fermentation")
+
+    def resume_fermentation(self, foo=None):
+        return self.command("resume_fermentation")
+
+    def start_profiler(self):
+        return self.command("start_profiler")
+
+    def stop_profiler(self):
+        return self.command("stop_profiler")
+
+    def start_capture(self, path):
+        return self.command("start_capture", path)
+
+    def stop_capture(self):
+        return self.command("stop_capture")
+
+    def control_replay(self, action, *args):
+        return self.command("control_replay", action, *args)
+
+
+class SharedChamber(ChamberProxy):
+    # a chamber run by scripts.acquisition_daemon: rows and state are read from its shared memory, commands
+    # go over its control socket. any number of web processes can attach to the same chamber. the saved rows
+    # are mapped from the daemon's archive and shared by all of them, only the rows the daemon has not
+    # flushed yet are copied out of the ring; rollups and window stats are each process's own
+    def __init__(self, config, *args, **kwargs):
+        super().__init__(config, *args, **kwargs)
+        self.measurements = ArchiveView(os.path.join(self.data_directory, "data.bin"), self.stored_names)
+        self.view_lock = threading.Lock()
+        self.ring = None
+        self.position = 0
+        self.ring_version = None # state version of the ring, state_version counts changes
+        self.poll_interval = 0.05
+
+    def start(self):
+        if self.consumer_thread is None:
+            self.consumer_thread = threading.Thread(target=self.follow_function, daemon=True)
+            self.consumer_thread.start()
+        print("chamber", self.name, "attaching to", shared_name(self.name))
+
+    def attach(self):
+        try:
+            ring = SharedRing(shared_name(self.name))
+        except FileNotFoundError:
+            return False
+        if time.time() - ring.heartbeat() > HEARTBEAT_TIMEOUT:
+            ring.close()
+            return False
+        # the daemon flushes what it recovered before it starts beating, the ring only has to fill the gap
+        self.load_history()
+        self.ring = ring
+        self.position = 0
+        self.ring_version = None
+        return True
+
+    def load_history(self):
+        self.loading = True
+        self.state_changed()
+        with self.view_lock:
+            self.measurements.refresh()
+            self.measurements_unsaved.clear()
+        times, values = self.measurements.snapshot()
+        self.rollups.clear()
+        self.stats.clear()
+        self.index_data(times, values)
+        self.loading = False
+
+    def add_rows(self, times, values):
+        # ring rows the archive does not have yet, they are let go once the daemon flushed them
+        with self.view_lock:
+            if self.measurements.refresh() and self.measurements.last_time() is not None:
+                self.measurements_unsaved.trim(self.measurements.last_time() + 1)
+            last_time = self.last_time()
+            if last_time is not None:
+                keep = times > last_time
+                times, values = times[keep], values[:, keep]
+            self.measurements_unsaved.extend(times, values)
+        self.index_data(times, values)
+        if time.time() - self.retention_checked > self.retention_interval:
+            self.retention_checked = time.time()
+            self.trim_history()
+
+    def snapshots(self):
+        # the mapped archive and the ring rows after it, never with a flush half taken over in between
+        with self.view_lock:
+            return [self.measurements.snapshot(), self.measurements_unsaved.snapshot()]
+
+    def detach(self):
+        print("chamber", self.name, "daemon stopped beating, waiting for it")
+        self.ring.close()
+        self.ring = None
+        self.ready = False
+        self.restarts += 1
+        self.state_changed()
+
+    def follow_function(self):
+        metrics_checked = 0
+        while True:
+            if self.ring is None:
+                if not self.attach():
+                    time.sleep(1)
+                    continue
+            if time.time() - self.ring.heartbeat() > HEARTBEAT_TIMEOUT:
+                # a restarted daemon creates a new block under the same name, attach to that one
+                self.detach()
+                continue
+            if self.ring.written() != self.position:
+                times, values, self.position = self.ring.read_since(self.position)
+                self.add_rows(times, values)
+            if self.ring.state_version() != self.ring_version:
+                state, self.ring_version = self.ring.read_state()
+                if state is not None:
+                    self.current_data, self.params = state["current_data"], state["params"]
+                    self.command_log = collections.OrderedDict((x["sequence"], x) for x in state["commands"])
+                    self.alarm_state = state["alarms"]
+                    self.ready = True
+                    self.state_changed()
+            if self.ready and time.time() - metrics_checked > METRICS_INTERVAL:
+                metrics_checked = time.time()
+                metrics = self.command("metrics_snapshot")
+                self.worker_metrics = metrics if isinstance(metrics, list) else []
+            time.sleep(self.poll_interval)
+
+    def command(self, name, *args, **kwargs):
+        if not self.ready:
+            return "CHAMBER NOT CONNECTED"
+        with self.connection_lock:
+            for attempt in range(2):
+                try:
+                    if self.connection is None:
+                        self.connection = Client(control_address(self.config), authkey=control_key(self.config))
+                    self.connection.send((name, args, kwargs))
+                    result, self.params = self.connection.recv()
+                    break
+                except (OSError, EOFError) as e:
+                    # the daemon restarted since the last command
+                    self.connection = None
+                    result = "CHAMBER NOT CONNECTED: " + str(e)
+        if name != "metrics_snapshot":
+            self.state_changed()
+        return result
+
+
+class ChamberManager():
+    def __init__(self, configs, daemon=False):
+        # daemon: the chambers run in scripts.acquisition_daemon, this process only reads them. configs can be
+        # a function (load_chamber_config) called when the chambers are built, in the background with
+        # start(background=True); chambers and get() wait until they exist
+        self.configs = configs
+        self.daemon = daemon
+        self.chamber_dict = {}
+        self.default_chamber = None
+        self.built = threading.Event()
+        if not callable(configs):
+            self.build()
+
+    def build(self):
+        try:
+            configs = self.configs() if callable(self.configs) else self.configs
+            chamber_class = SharedChamber if self.daemon else ChamberProxy
+            self.chamber_dict = {config["name"]: chamber_class(config) for config in configs}
+            self.default_chamber = next(iter(self.chamber_dict), None)
+        finally:
+            self.built.set()
+
+    @property
+    def chambers(self):
+        self.built.wait()
+        return self.chamber_dict
+
+    def start(self, background=False):
+        # spawned children re-import the page modules, only the main process owns the workers
+        if multiprocessing.parent_process() is not None:
+            return
+        if background:
+            threading.Thread(target=self.start, name="chamber-manager", daemon=True).start()
+            return
+        if not self.built.is_set():
+            self.build()
+        for chamber in self.chambers.values():
+            chamber.start()
+
+    def get(self, name=None):
+        return self.chambers.get(name or self.default_chamber)
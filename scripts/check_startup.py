@@ -0,0 +1,87 @@
+import os
+import re
+import sys
+import json
+import time
+import base64
+import argparse
+import tempfile
+import subprocess
+import urllib.error
+import urllib.request
+from scripts.archive import MeasurementArchive
+from scripts.benchmark_parser import layout_only_fermentor
+from scripts.benchmark_query import fake_history
+
+# python -m scripts.check_startup [--days 180] [--interval 5] [--budget 3]
+# starts the web server (index.py, from the repository root) on a chamber with `days` of history and a
+# serial port that does not exist, and measures how long it takes until the landing page answers and until
+# the history is loaded. fails when the first response takes longer than the budget: the history and the
+# serial port are handled in the background and must not hold the server up, whatever their size or state
+
+
+def request(url, credentials):
+    headers = {"Authorization": "Basic " + base64.b64encode(":".join(credentials).encode()).decode()}
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=1) as response:
+            return response.status, response.read().decode()
+    except urllib.error.HTTPError as e:
+        return e.code, ""
+
+
+def wait_for(condition, start, timeout):
+    # seconds from `start` until the condition held, None when it did not within the timeout
+    while time.perf_counter() - start < timeout:
+        try:
+            if condition():
+                return time.perf_counter() - start
+        except OSError:
+            pass
+        time.sleep(0.05)
+    return None
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="time to first response of the web server")
+    parser.add_argument("--days", type=float, default=180)
+    parser.add_argument("--interval", type=float, default=5)
+    parser.add_argument("--budget", type=float, default=3)
+    parser.add_argument("--port", type=int, default=8071)
+    arguments = parser.parse_args(arguments)
+
+    from data.private import VALID_USERNAME_PASSWORD_PAIRS
+    credentials = next(iter(VALID_USERNAME_PASSWORD_PAIRS.items()))
+    with tempfile.TemporaryDirectory() as directory:
+        fermentor = layout_only_fermentor()
+        stop = int(time.time() * 1000000)
+        times, values = fake_history(fermentor, stop - int(arguments.days * 86400 * 1000000), stop, arguments.interval)
+        MeasurementArchive(os.path.join(directory, "data.bin"), fermentor.stored_names).append(times, values, sync=True)
+        config = os.path.join(directory, "chambers.json")
+        with open(config, "w", encoding="utf8") as f:
+            json.dump([{"name": "check", "serial_port_name": "/dev/nonexistent", "data_directory": directory}], f)
+
+        url = "http://127.0.0.1:{}".format(arguments.port)
+        start = time.perf_counter()
+        server = subprocess.Popen([sys.executable, "-c", "import index; index.app.run_server(port={})".format(arguments.port)],
+                                  env=dict(os.environ, FERMENTOR_CHAMBERS=config), stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL)
+        try:
+            first_response = wait_for(lambda: request(url + "/", credentials)[0] == 200, start, 60)
+            loaded = wait_for(lambda: re.search(r'chamber_loading\{chamber="check"\} 0',
+                                                request(url + "/metrics", credentials)[1]), start, 120)
+        finally:
+            server.terminate()
+            server.wait(timeout=10)
+
+    print("{} measurements ({:.0f} days), serial port missing".format(len(times), arguments.days))
+    print("first response   {}".format("none" if first_response is None else "{:.2f} s".format(first_response)))
+    print("history loaded   {}".format("none" if loaded is None else "{:.2f} s".format(loaded)))
+    if first_response is None or first_response > arguments.budget:
+        print("OVER BUDGET of {:.1f} s".format(arguments.budget))
+        return 1
+    print("within budget of {:.1f} s".format(arguments.budget))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+import numpy as np
+
+# channels computed from the device channels as batches arrive and stored right after them (segment log,
+# archive, day chunks, rollups, exports), so they are read, plotted and exported like any sensor without a
+# dashboard request ever computing them. a chamber lists them in order ("derived" in data/chambers.json),
+# later ones may use earlier ones:
+#   {"name": "t_avg", "function": "mean", "inputs": ["t0", "t1", "t2", "t3"]}
+# functions: "mean" and "spread" (max - min) over the inputs, missing (nan) inputs left out; "dew_point" of
+# [temperature in °C, relative humidity in %]; "rate" of change of the input per minute; "ewma" of the input
+# with a time constant of "tau" seconds. derived names carry an underscore, device channels never do
+
+FUNCTIONS = ["mean", "spread", "dew_point", "rate", "ewma"]
+MAGNUS_B = 17.62
+MAGNUS_C = 243.12
+
+
+def default_derived(in_names):
+    return [
+        {"name": "t_avg", "function": "mean", "inputs": in_names["temperature"]},
+        {"name": "t_spread", "function": "spread", "inputs": in_names["temperature"]},
+        {"name": "h_avg", "function": "mean", "inputs": in_names["humidity"]},
+        {"name": "h_spread", "function": "spread", "inputs": in_names["humidity"]},
+        {"name": "dew_point", "function": "dew_point", "inputs": ["t_avg", "h_avg"]},
+        {"name": "t_smooth", "function": "ewma", "inputs": ["t_avg"], "tau": 300},
+        {"name": "t_rate", "function": "rate", "inputs": ["t_smooth"]},
+    ]
+
+
+def is_derived(name):
+    return "_" in name
+
+
+class DerivedEngine():
+    # turns (times, values of the device channels) into (times, values of device + derived channels);
+    # rate and ewma carry their last sample from one batch to the next
+    def __init__(self, spec, input_names):
+        self.spec = [dict(x) for x in spec]
+        self.input_names = list(input_names)
+        self.names = [x["name"] for x in self.spec]
+        self.channels = self.input_names + self.names
+        self.index = {name: i for i, name in enumerate(self.channels)}
+        for i, x in enumerate(self.spec):
+            if x["function"] not in FUNCTIONS:
+                raise ValueError("derived channel {}: unknown function {}".format(x["name"], x["function"]))
+            if not is_derived(x["name"]):
+                raise ValueError("derived channel {}: names need an underscore".format(x["name"]))
+            missing = [name for name in x["inputs"] if self.index.get(name, len(self.channels)) >= len(self.input_names) + i]
+            if missing:
+                raise ValueError("derived channel {}: unknown inputs {}".format(x["name"], missing))
+        self.reset()
+
+    def reset(self):
+        # last (time, value) of every rate (its input) and ewma (its output)
+        self.last = {}
+
+    def prime(self, timestamp, row):
+        # carries on from a stored row (all channels), after a restart
+        for x in self.spec:
+            if x["function"] in ("rate", "ewma"):
+                name = x["inputs"][0] if x["function"] == "rate" else x["name"]
+                self.last[x["name"]] = (int(timestamp), float(row[self.index[name]]))
+
+    def compute(self, times, values):
+        times = np.asarray(times, dtype=np.int64)
+        output = np.empty((len(self.channels), len(times)), dtype=np.float32)
+        output[:len(self.input_names)] = values
+        if len(times) == 0:
+            return output
+        with np.errstate(invalid="ignore", divide="ignore"):
+            for i, x in enumerate(self.spec, len(self.input_names)):
+                inputs = output[[self.index[name] for name in x["inputs"]]].astype(np.float64)
+                output[i] = getattr(self, x["function"])(x, times, inputs)
+        return output
+
+    def mean(self, x, times, inputs):
+        valid = ~np.isnan(inputs)
+        count = valid.sum(axis=0)
+        return np.where(count > 0, np.where(valid, inputs, 0).sum(axis=0) / np.maximum(count, 1), np.nan)
+
+    def spread(self, x, times, inputs):
+        return np.fmax.reduce(inputs, axis=0) - np.fmin.reduce(inputs, axis=0)
+
+    def dew_point(self, x, times, inputs):
+        temperature, humidity = inputs
+        gamma = np.log(np.clip(humidity, 0, 100) / 100) + MAGNUS_B * temperature / (MAGNUS_C + temperature)
+        dew_point = MAGNUS_C * gamma / (MAGNUS_B - gamma)
+        return np.where(np.isfinite(dew_point), dew_point, np.nan)
+
+    def rate(self, x, times, inputs):
+        last_time, last_value = self.last.get(x["name"], (None, np.nan))
+        previous_times = np.concatenate(([times[0] if last_time is None else last_time], times[:-1]))
+        previous_values = np.concatenate(([last_value], inputs[0][:-1]))
+        self.last[x["name"]] = (int(times[-1]), float(inputs[0][-1]))
+        elapsed = (times - previous_times) / 60e6
+        return np.where(elapsed > 0, (inputs[0] - previous_values) / elapsed, np.nan)
+
+    def ewma(self, x, times, inputs):
+        last_time, value = self.last.get(x["name"], (None, np.nan))
+        previous_times = np.concatenate(([times[0] if last_time is None else last_time], times[:-1]))
+        weights = 1 - np.exp(-np.maximum(times - previous_times, 0) / (x["tau"] * 1e6))
+        output = np.empty(len(times))
+        for i, (sample, weight) in enumerate(zip(inputs[0].tolist(), weights.tolist())):
+            # a missing sample holds the mean, the first one starts it
+            if sample == sample:
+                value = sample if value != value else value + weight * (sample - value)
+            output[i] = value
+        self.last[x["name"]] = (int(times[-1]), float(value))
+        return output
+
+
+def convert_records(records, engine):
+    # (times, values of engine.channels) from archive records of another channel layout: device channels
+    # are copied (nan where the layout has none), derived ones computed again
+    names = records.dtype.names
+    raw = np.array([records[name] if name in names else np.full(len(records), np.nan, dtype=np.float32)
+                    for name in engine.input_names], dtype=np.float32).reshape(len(engine.input_names), len(records))
+    return records["time"].copy(), engine.compute(records["time"], raw)
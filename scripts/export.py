@@ -0,0 +1,148 @@
+import json
+import struct
+import numpy as np
+
+# exports of a time range and a subset of channels, streamed a block of rows at a time straight from the day
+# chunks and the memory stores (Fermentor.export_parts), so memory stays flat whatever the range.
+# csv: "time,<channel>,..." header, iso times, values as %.7g (nan where missing)
+# ndjson: one {"time": iso, "<channel>": value or null, ...} object per line
+# bin: columnar, MAGIC, HEADER (channels, block rows, total rows), the channel names comma separated (utf8,
+#      uint32 length first), then blocks of `block rows` rows, the last one shorter: times int64[n] (epoch
+#      microseconds) followed by float32[n] per channel, all little endian. the fixed block size lets a byte
+#      range be served starting at the block it falls into. read_export reads one back
+
+MAGIC = b"FERMEXP1"
+HEADER = struct.Struct("<IIQ")
+BLOCK_ROWS = 8192
+FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson", "bin": "application/octet-stream"}
+
+
+def blocks(parts, channel_index, block_rows=BLOCK_ROWS, skip=0, exact=False):
+    # (times, values of the channels) in blocks of exactly block_rows rows (the last one shorter), `skip`
+    # rows in. parts are (rows, load) as from Fermentor.export_parts, the skipped ones are never loaded.
+    # exact: a part that no longer loads the rows it was counted with (a chunk downsampled meanwhile) raises
+    carry = None
+    for rows, load in parts:
+        if skip >= rows:
+            skip -= rows
+            continue
+        times, values = load()
+        if exact and len(times) != rows:
+            raise ValueError("export part changed from {} to {} rows".format(rows, len(times)))
+        offset, skip = skip, 0
+        if carry is not None:
+            fill = min(block_rows - len(carry[0]), len(times))
+            carry = (np.concatenate((carry[0], times[:fill])),
+                     np.concatenate((carry[1], values[channel_index, :fill]), axis=1))
+            offset = fill
+            if len(carry[0]) < block_rows:
+                continue
+            yield carry
+            carry = None
+        while len(times) - offset >= block_rows:
+            yield times[offset:offset + block_rows], values[:, offset:offset + block_rows][channel_index]
+            offset += block_rows
+        if offset < len(times):
+            carry = times[offset:], values[:, offset:][channel_index]
+    if carry is not None:
+        yield carry
+
+
+def iso_times(times):
+    return np.datetime_as_string(times.view("datetime64[us]"))
+
+
+def csv_header(channels):
+    return "time," + ",".join(channels) + "\n"
+
+
+def csv_block(times, values):
+    columns = [iso_times(times)] + [np.char.mod("%.7g", column) for column in values]
+    return "".join(",".join(row) + "\n" for row in zip(*columns))
+
+
+def ndjson_block(channels, times, values):
+    template = '{"time": "%s"' + "".join(", {}: %s".format(json.dumps(name)) for name in channels) + "}\n"
+    columns = [iso_times(times)] + [np.where(np.isfinite(column), np.char.mod("%.7g", column), "null")
+                                    for column in values]
+    return "".join(template % row for row in zip(*columns))
+
+
+def bin_header(channels, rows, block_rows=BLOCK_ROWS):
+    names = ",".join(channels).encode("utf8")
+    return MAGIC + HEADER.pack(len(channels), block_rows, rows) + struct.pack("<I", len(names)) + names
+
+
+def bin_block(times, values):
+    return times.astype("<i8").tobytes() + values.astype("<f4").tobytes()
+
+
+def bin_size(channels, rows):
+    return len(bin_header(channels, rows)) + rows * (8 + 4 * len(channels))
+
+
+def stream_text(parts, channels, channel_index, format):
+    if format == "csv":
+        yield csv_header(channels)
+    for times, values in blocks(parts, channel_index):
+        yield csv_block(times, values) if format == "csv" else ndjson_block(channels, times, values)
+
+
+def stream_bin(parts, channels, channel_index, rows, first=0, last=None):
+    # bytes first..last (inclusive, None for the end) of the bin export, generated from the block holding `first`.
+    # parts must be the ones `rows` was counted from, a part that changed since cuts the body short
+    header = bin_header(channels, rows)
+    last = bin_size(channels, rows) - 1 if last is None else last
+    block_bytes = BLOCK_ROWS * (8 + 4 * len(channels))
+    if first < len(header):
+        yield header[first:last + 1]
+        block = 0
+    else:
+        block = (first - len(header)) // block_bytes
+    position = len(header) + block * block_bytes
+    for times, values in blocks(parts, channel_index, skip=block * BLOCK_ROWS, exact=True):
+        if position > last:
+            break
+        data = bin_block(times, values)
+        yield data[max(0, first - position):last + 1 - position]
+        position += len(data)
+
+
+def parse_range(header, size):
+    # (first, last) of a single "bytes=first-last" / "bytes=first-" / "bytes=-suffix" range, None to send it
+    # all (no or unsupported header), False when it is outside the export
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[len("bytes="):].strip().partition("-")
+    try:
+        if first == "":
+            first, last = max(0, size - int(last)), size - 1
+        else:
+            first, last = int(first), min(size - 1, int(last)) if last else size - 1
+    except ValueError:
+        return None
+    if first > last or first >= size:
+        return False
+    return first, last
+
+
+def read_export(path):
+    # (channels, times, values) of a bin export
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("not a fermentor export: " + path)
+    count, block_rows, rows = HEADER.unpack_from(data, len(MAGIC))
+    position = len(MAGIC) + HEADER.size
+    length = struct.unpack_from("<I", data, position)[0]
+    channels = data[position + 4:position + 4 + length].decode("utf8").split(",") if count else []
+    position += 4 + length
+    times = np.empty(rows, dtype=np.int64)
+    values = np.empty((count, rows), dtype=np.float32)
+    for start in range(0, rows, block_rows):
+        n = min(block_rows, rows - start)
+        times[start:start + n] = np.frombuffer(data, dtype="<i8", count=n, offset=position)
+        position += 8 * n
+        values[:, start:start + n] = np.frombuffer(data, dtype="<f4", count=count * n, offset=position).reshape(count, n)
+        position += 4 * count * n
+    return channels, times, values
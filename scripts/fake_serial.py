@@ -1,7 +1,159 @@
+import os
+import time
+import select
+import socket
+import threading
+from scripts.serial_engine import split_sequence
+try:
+    import fcntl
+    import termios
+except ImportError:
+    # windows: no pipe the loop can wait on and no FIONREAD, FakeSerial uses a socket pair instead
+    fcntl = None
+
+
 class FakeSerial():
-    def __init__(self):
+    # in memory stand-in for serial.Serial (the port is a pipe on posix so the engine waits on it like on a
+    # real one, a socket pair elsewhere). plays the arduino: says "Starting scheduler", answers every command
+    # with info|done and then writes what `messages` returns (str lines or bytes frames, None ends the stream)
+    # at `rate` messages per second, or as fast as the reader takes them when rate is None. commands are
+    # answered with their sequence number like the firmware does.
+    # write_times holds the epoch microseconds every message from `messages` was written at, in order.
+    def __init__(self, port=None, baudrate=9600, timeout=0, messages=None, rate=None, count=None, binary=False,
+                 autostart=True, chunk=64):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.messages = messages
+        self.rate = rate
+        self.count = count
+        self.binary = binary
+        self.chunk = chunk
+        self.pipe = fcntl is not None
+        if self.pipe:
+            self.read_fd, self.write_fd = os.pipe()
+            os.set_blocking(self.read_fd, False)
+        else:
+            self.reader, self.writer = socket.socketpair()
+            self.reader.setblocking(False)
+        self.replies = ["info|Starting scheduler"]
+        self.replies_lock = threading.Lock()
+        self.write_times = []
+        self.commands = []
+        self.sent = 0
+        self.closed = False
+        self.started = threading.Event()
+        self.finished = threading.Event()
+        self.thread = threading.Thread(target=self.play, daemon=True)
+        self.thread.start()
+        if autostart:
+            self.start()
+
+    def start(self):
+        self.started.set()
+
+    def encode(self, message):
+        return message if isinstance(message, bytes) else (message + "\r\n").encode()
+
+    def output(self, replies, messages):
+        timestamp = int(time.time() * 1000000)
+        self.write_times.extend([timestamp] * len(messages))
+        # blocks while the pipe is full, which is the back pressure of a slow reader
+        data = b"".join(self.encode(x) for x in replies + messages)
+        if self.pipe:
+            os.write(self.write_fd, data)
+        else:
+            self.writer.sendall(data)
+
+    def due(self, start):
+        # number of messages to write now, replies to commands always go first
+        if not self.started.is_set() or self.count is not None and self.sent >= self.count:
+            return 0
+        due = self.chunk
+        if self.rate is not None:
+            due = min(due, int((time.perf_counter() - start) * self.rate) + 1 - self.sent)
+        if self.count is not None:
+            due = min(due, self.count - self.sent)
+        return max(due, 0)
+
+    def play(self):
+        # the only writer of the pipe, so the engine never blocks on a full pipe when it sends a command
+        start = None
+        try:
+            while not self.closed:
+                if start is None and self.started.is_set():
+                    start = time.perf_counter()
+                with self.replies_lock:
+                    replies, self.replies = self.replies, []
+                batch = []
+                due = self.due(start)
+                for i in range(due):
+                    message = self.messages() if self.messages is not None else None
+                    if message is None:
+                        self.count = self.sent
+                        break
+                    batch.append(message)
+                    self.sent += 1
+                if replies or batch:
+                    self.output(replies, batch)
+                if self.count is not None and self.sent >= self.count:
+                    self.finished.set()
+                if not due:
+                    time.sleep(0.001 if self.rate is None else min(0.001, 1 / self.rate))
+        except OSError:
+            pass
+        finally:
+            self.finished.set()
+            if self.pipe:
+                os.close(self.write_fd)
+            else:
+                self.writer.close()
+
+    @property
+    def in_waiting(self):
+        if self.pipe:
+            return int.from_bytes(fcntl.ioctl(self.read_fd, termios.FIONREAD, b"\0\0\0\0"), "little")
+        try:
+            return len(self.reader.recv(1 << 16, socket.MSG_PEEK))
+        except BlockingIOError:
+            return 0
+
+    def fileno(self):
+        return self.read_fd if self.pipe else self.reader.fileno()
+
+    def read(self, size=1):
+        try:
+            if self.pipe:
+                return os.read(self.read_fd, size)
+            # the engine reads without a selectable port here, a timeout makes read wait like pyserial's
+            if self.timeout:
+                select.select([self.reader], [], [], self.timeout)
+            return self.reader.recv(size)
+        except BlockingIOError:
+            return b""
+
+    def write(self, data):
+        for line in data.decode().splitlines():
+            command, sequence = split_sequence(line)
+            self.commands.append(command)
+            with self.replies_lock:
+                if command.startswith("proto|"):
+                    self.replies.append("info|proto|bin" if self.binary else "info|proto|text")
+                self.replies.append("info|done" if sequence is None else "info|done|{}".format(sequence))
+        return len(data)
+
+    def flush(self):
         pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.pipe:
+            os.close(self.read_fd)
+        else:
+            self.reader.close()
+        self.thread.join(timeout=5)
+
     def close_serial(self):
-        pass
-    def flush(self):
-        pass
\ No newline at end of file
+        self.close()
@@ -1,19 +1,115 @@
 import numpy as np
 import threading
-import queue
 import time
 import datetime
 import pickle
-import serial
-import csv
 import os
-import json
+import shutil
+import collections
+import functools
+import serial
+from scripts.measurement_store import MeasurementStore, datetime_to_epoch_us
+from scripts.rollup import Rollup, rollup_columns
+from scripts.retention import ChunkStore, Retention, DAY_US, day_start
+from scripts.window_stats import StatsEngine
+from scripts.archive import MeasurementArchive, archive_channels, convert_csv
+from scripts.alarms import AlarmEngine
+from scripts.derived import DerivedEngine, default_derived, convert_records
+from scripts.segment_log import SegmentLog
+from scripts.parameter_store import ParameterStore
+from scripts.serial_engine import SerialEngine
+from scripts.batch_parser import BatchParser
+from scripts.binary_protocol import BinaryCodec, FrameDecoder, FRAME_DATA, layout_string
+from scripts.metrics import Registry, SamplingProfiler
 
 class Fermentor():
     def __init__(self, default_temperature_target=60, default_temperature_hysteresis=2,
                  default_humidity_target=10, default_humidity_hysteresis=1, serial_port_name="COM3",
-                 serial_baud_rate=9600, simulate_serial=True):
+                 serial_baud_rate=9600, simulate_serial=True, num_devices=None, data_directory="data",
+                 binary_protocol=False, serial_factory=serial.Serial, engine_factory=SerialEngine, capture_path=None,
+                 retention=None, derived=None, alarms=None, start_engine=True):
         self.simulate_serial = simulate_serial
+        self.binary_protocol = binary_protocol
+        self.serial_port_name = serial_port_name
+        self.serial_baud_rate = serial_baud_rate
+        self.data_directory = data_directory
+        self.init_layout(default_temperature_target, default_temperature_hysteresis,
+                         default_humidity_target, default_humidity_hysteresis, num_devices, derived)
+        self.init_metrics()
+        self.init_storage(retention)
+        self.init_alarms(alarms)
+        self.load_parameters()
+        # engine_factory=functools.partial(ReplayEngine, source=...) replays a recording instead of the port
+        self.engine = engine_factory(self.serial_port_name, self.serial_baud_rate, self.parse_lines, serial_factory,
+                                     framer=FrameDecoder({FRAME_DATA: self.codec.payload_size}), metrics=self.metrics)
+        self.metrics.counter("frame_crc_errors_total", "Binary frames dropped for a bad crc",
+                             lambda: self.engine.framer.crc_errors)
+        self.engine.on_command = self.command_changed
+        if capture_path is not None:
+            self.start_capture(capture_path)
+        # start_engine=False leaves it to the caller to attach its listeners first and call engine.start()
+        if start_engine:
+            self.engine.start()
+
+    def init_metrics(self):
+        self.metrics = Registry()
+        self.profiler = SamplingProfiler()
+        self.parsed_messages = self.metrics.counter("messages_parsed_total", "Messages parsed, by kind")
+        self.dropped_messages = self.metrics.counter("messages_dropped_total", "Messages that could not be parsed, by reason")
+        self.stored_rows = self.metrics.counter("stored_rows_total", "Measurements stored")
+        self.parse_seconds = self.metrics.histogram("parse_seconds", "Parsing and storing one batch of data messages")
+        self.ingest_latency = self.metrics.histogram("ingest_latency_seconds",
+                                                     "Receive to stored, oldest message of every batch")
+        self.flush_seconds = self.metrics.histogram("flush_seconds", "Writing unsaved measurements to the archive")
+
+    def init_storage(self, retention=None):
+        self.measurement_unsaved_count = 0
+        self.measurement_unsaved_limit = 100
+        # the parser thread flushes while storing, scripts and shutdown flush from their own threads
+        self.data_lock = threading.Lock()
+        os.makedirs(self.data_directory, exist_ok=True)
+        self.database_path = os.path.join(self.data_directory, "data.bin")
+        self.legacy_database_path = os.path.join(self.data_directory, "data.csv")
+        self.archive = None
+        self.log_path = os.path.join(self.data_directory, "log")
+        self.log_segment_size = 1 << 20
+        self.log_commit_every = 5
+        self.log_commit_interval = 10.0
+        self.log = None
+        self.parameters_path = os.path.join(self.data_directory, "parameters.json")
+        self.parameters_save_interval = 5.0
+        self.persisted_names = [name for key in ["temperature_target", "temperature_hysteresis", "humidity_target",
+                                                 "humidity_hysteresis", "state", "time_left"]
+                                for name in self.in_names[key]]
+        self.parameter_store = ParameterStore(self.parameters_path, self.parameters_save_interval)
+        self.init_retention(retention)
+        self.load_database(self.database_path)
+
+    def init_retention(self, retention=None):
+        # retention: {"hot_days": 2, "cold_after_days": 90, "cold_action": "downsample"|"delete"|"keep",
+        # "cold_resolution": 900, "compression": "zlib"|"lzma"}, see scripts.retention
+        self.retention = Retention(os.path.join(self.data_directory, "chunks"), self.stored_names,
+                                   **(retention or {}))
+        self.retention_interval = 3600.0
+        self.retention_checked = 0.0
+        self.metrics.gauge("warm_rows", "Measurements in compressed day chunks", lambda: len(self.retention.store))
+        self.metrics.counter("chunks_decompressed_total", "Day chunks read back from disk",
+                             lambda: self.retention.store.decompressed)
+
+    def init_alarms(self, alarms=None):
+        # alarms: {"hold_seconds": 60, "stale_seconds": 600, "heater_seconds": 3600, "tolerance":
+        # {"temperature": 5}, "disagreement": {"temperature": 10, "humidity": 15}}, see scripts.alarms
+        self.alarms = AlarmEngine(self.in_names, self.stored_index, self.data_directory, **(alarms or {}))
+        self.alarm_state = self.alarms.state()
+        self.alarm_listeners = []
+        # the ingest thread and the timer of check_silence both evaluate alarms
+        self.alarm_lock = threading.Lock()
+        self.alarm_events = self.metrics.counter("alarm_events_total", "Alarms raised and cleared, by alarm and event")
+        self.metrics.gauge("alarms_active", "Raised alarms, by level",
+                           lambda: dict(collections.Counter((("level", x["level"]),) for x in self.alarm_state["active"])))
+
+    def init_layout(self, default_temperature_target, default_temperature_hysteresis,
+                    default_humidity_target, default_humidity_hysteresis, num_devices=None, derived=None):
         self.params = {
             "temperature": {
                 "target": {
@@ -55,6 +151,8 @@ class Fermentor():
             "heater": 1,
             "moisturizer": 1,
         }
+        if num_devices is not None:
+            self.num_devices.update(num_devices)
         
         self.in_names = {
             "temperature": ["t" + str(i) for i in range(self.num_devices["temperature"])],
@@ -109,36 +207,35 @@ class Fermentor():
         self.info_functions = {
             "Starting scheduler": self.initialize_arduino,
             "done": self.disable_send_lock,
+            "proto": self.set_protocol,
         }
         self.state_functions = {
             "start": lambda x: self.start_fermentation(x),
             "pause": self.stop_fermentation,
             "stop": self.stop_fermentation
         }
-        self.measurements_unsaved = []
-        self.measurements = []
-
-        self.send_lock = threading.Lock()
-        self.initialized = False
-        self.sender_thread = None
-        self.receiver_thread = None
-        self.io_thread = None
-        self.io_active = False
-        self.receiver_serial = None
-        self.measurement_unsaved_count = 0
-        self.measurement_unsaved_limit = 100
-        self.save_every_nth_measurement = 5
-        self.parse_queue = queue.Queue()
-        self.send_queue = queue.Queue()
-        self.data_lock = threading.Lock()
-        self.database_path = "data/data.csv"
-        self.parameters_path = "data/parameters.json"
-        self.load_database(self.database_path)
-        self.load_parameters(self.parameters_path)
-        self.init_parser()
-        self.init_sender()
-        self.init_receiver()
-        self.init_io()
+        # what the device sends, followed by the channels derived from it (scripts.derived)
+        self.raw_names = [name for key in self.data_to_store for name in self.in_names[key]]
+        self.derived = DerivedEngine(default_derived(self.in_names) if derived is None else derived, self.raw_names)
+        self.stored_names = self.derived.channels
+        self.stored_index = {name: i for i, name in enumerate(self.stored_names)}
+        self.measurements_unsaved = MeasurementStore(self.stored_names)
+        self.measurements = MeasurementStore(self.stored_names)
+        self.rollup_resolutions = [60, 900, 3600, 21600]
+        self.rollups = Rollup(self.stored_names, self.rollup_resolutions)
+        self.data_version = 0
+        self.state_version = 0
+        self.changed = threading.Condition()
+        self.stats = StatsEngine({key: [self.stored_index[name] for name in self.in_names[key]]
+                                  for key in ["temperature", "humidity"]})
+        self.listeners = []
+        self.command_log = collections.OrderedDict()
+        self.command_log_size = 10
+        self.command_listeners = []
+        self.batch_parser = BatchParser(self.in_names_reversed, self.parse_functions, self.raw_names,
+                                        self.current_data)
+        self.codec = BinaryCodec(self.in_names, self.raw_names)
+        self.protocol = "text"
 
     def create_empty_data_block(self):
         data_block = {}
@@ -226,103 +323,79 @@ class Fermentor():
             body = "{}|{}|{:.2f}".format(body, i["name"], i["current"])
         return head+body
         
-    def init_io(self):
-        self.io_thread = threading.Thread(target=self.io_function, daemon=True)
-        self.io_thread.start()
-    
-    def io_function(self):
-        if not self.simulate_serial:
-            self.init_serial("COM3", 9600)
-        else:
-            self.init_serial("COM3", 9600)
-        while(1):
-            time.sleep(5)
-            if not self.io_active:
-                self.close_serial()
-                self.init_io()
-                break
-                
-    def init_serial(self, serial_port_name, serial_baud_rate):
-        while(1):
-            try:
-                self.receiver_serial = serial.Serial(port=serial_port_name, baudrate=serial_baud_rate)
-                print("Serial port " + serial_port_name + " opened | baud_rate: " + str(serial_baud_rate))
-                self.receiver_serial.flush()
-                self.io_active = True
-                break
-            except Exception as e:
-                print("can't connect to serial: exception=", e)
-            time.sleep(2)
-            
-    def close_serial(self):
-        self.receiver_serial.close()
-        
-    def init_receiver(self):
-        self.receiver_thread = threading.Thread(target=self.receiver_function, daemon=True)
-        self.receiver_thread.start()
-        print("receiver_thread_started")
-
-    def init_parser(self):
-        self.parser_thread = threading.Thread(target=self.parser_function, daemon=True)
-        self.parser_thread.start()
-        print("parser_thread_started")
-
-    def init_sender(self):
-        self.sender_thread = threading.Thread(target=self.sender_function, daemon=True)
-        self.sender_thread.start()
-        print("sender_thread_started")
-
-    def receiver_function(self):
-        while True:
-            try:
-                while self.io_active:
-                    if self.receiver_serial.in_waiting > 0:
-                        line = self.receiver_serial.readline().decode('utf-8').rstrip()
-                    else:
-                        line = None
-                    #line = self.generate_fake_message()
-                    if line is not None:
-                        self.parse_queue.put(line)
-                        print("received: ", line)
-                time.sleep(1)
-            except Exception as e:
-                print("receiver error", e)
-                self.clean_io()
-        print("receiver thread ended")
-
-
-    def parser_function(self):
-        while True:
-            try:
-                while(self.io_active):
-                    data = self.parse_queue.get()
-                    message_list = data.split('|')
-                    head = message_list.pop(0)
-                    try:
-                        parsed = self.parse_functions[head](message_list)
-                    except KeyError:
-                        print("KEY ERROR: head=", head)
-                time.sleep(1)
-            except Exception as e:
-                print("parser_error", e)
-                self.clean_io()
-                raise e
-        print("parser thread ended")
-
-    def sender_function(self):
-        while True:
+    def parse_line(self, data):
+        self.parse_lines([(datetime_to_epoch_us(datetime.datetime.utcnow()), data)])
+
+    def parse_lines(self, batch):
+        # consecutive data lines (or binary data frames) are parsed and stored together,
+        # everything else one by one in order
+        times = []
+        messages = []
+        for timestamp, message in batch:
+            binary = isinstance(message, bytes)
+            if binary and message[0] == FRAME_DATA or not binary and message.startswith("data|"):
+                if messages and isinstance(messages[0], bytes) != binary:
+                    self.store_messages(times, messages)
+                    times = []
+                    messages = []
+                times.append(timestamp)
+                messages.append(message)
+                continue
+            if messages:
+                self.store_messages(times, messages)
+                times = []
+                messages = []
+            if binary:
+                print("UNKNOWN FRAME: type=", message[0])
+                self.dropped_messages.inc(reason="unknown_frame")
+                continue
+            message_list = message.split('|')
+            head = message_list.pop(0)
             try:
-                while self.io_active and self.initialized:
-                    data = self.send_queue.get()
-                    self.enable_send_lock()
-                    self.receiver_serial.write(bytes(data, 'utf-8'))
-                    print("sent: " + data)
-                time.sleep(1)
-            except Exception as e:
-                print("sender error", e)
-                self.clean_io()
-        print("sender thread ended")
-
+                parsed = self.parse_functions[head](message_list)
+                self.parsed_messages.inc(kind=head)
+            except KeyError:
+                print("KEY ERROR: head=", head)
+                self.dropped_messages.inc(reason="unknown_head")
+        if messages:
+            self.store_messages(times, messages)
+
+    def store_messages(self, times, messages):
+        start = time.perf_counter()
+        if isinstance(messages[0], bytes):
+            values, current = self.codec.decode_data(messages)
+            self.current_data.update(current)
+        else:
+            values = self.batch_parser.parse(messages)
+        times = np.array(times, dtype=np.int64)
+        self.store_data(times, self.derived.compute(times, values))
+        self.parse_seconds.observe(time.perf_counter() - start)
+        self.ingest_latency.observe(time.time() - times[0] / 1000000)
+        self.parsed_messages.inc(len(messages), kind="frame" if isinstance(messages[0], bytes) else "data")
+        self.stored_rows.inc(len(messages))
+
+    def send(self, message, key=None):
+        return self.engine.send(message, key).sequence
+
+    def command_changed(self, command):
+        # called from the engine whenever a command was queued, sent, answered or given up
+        self.command_log[command.sequence] = command.summary()
+        self.command_log.move_to_end(command.sequence)
+        while len(self.command_log) > self.command_log_size:
+            self.command_log.popitem(last=False)
+        commands = list(self.command_log.values())
+        for listener in self.command_listeners:
+            listener(commands)
+        self.state_changed()
+
+    def command_status(self, count=3):
+        commands = list(self.command_log.values())[-count:]
+        return ", ".join("{} #{} {}".format(x["command"], x["sequence"], x["status"]) for x in reversed(commands))
+
+    def close(self):
+        self.engine.stop()
+        self.log.close()
+        self.parameter_store.flush()
 
     def generate_fake_message(self):
         temperature_string = ""
@@ -349,73 +422,323 @@ class Fermentor():
         return message
 
     def parse_function_data(self, message_list):
-        data_block = self.empty_data_block.copy()
-        data_block["time"] = datetime.datetime.utcnow()
-        for i in range(0, len(message_list), 2):
-            key = message_list[i]
-            value = message_list[i + 1]
-            if key in self.all_in_names:
-                try:
-                    self.current_data[key] = self.parse_functions[self.in_names_reversed[key]](value)
-                except KeyError:
-                    print("KEY ERROR: ", key)
-            else:
-                print("UNKNOWN KEY: ", key)
-        for key in self.data_to_store:
-            for name in self.in_names[key]:
-                data_block[name] = self.current_data[name]
-        self.measurements_unsaved.append(data_block)
-        self.measurement_unsaved_count += 1
-        self.save_parameters(self.parameters_path)
-        self.update_parameters(state=self.current_data[self.in_names["state"][0]], time_left=self.current_data[self.in_names["time_left"][0]])
-        if self.measurement_unsaved_count == self.measurement_unsaved_limit:
-            self.update_database(self.database_path, self.save_every_nth_measurement)
+        self.store_messages([datetime_to_epoch_us(datetime.datetime.utcnow())], ["|".join(["data"] + message_list)])
+
+    def store_data(self, times, values):
+        self.measurements_unsaved.extend(times, values)
+        self.index_data(times, values)
+        self.measurement_unsaved_count += len(times)
+        if self.measurement_unsaved_count >= self.measurement_unsaved_limit:
+            # the archive is synced right away, logging this batch first would only cost another fsync
+            self.update_database()
             self.measurement_unsaved_count = 0
-        return data_block
-        
+        else:
+            self.log.extend([record.tobytes() for record in self.archive.to_records(times, values)])
+        self.save_parameters()
+        self.update_parameters(state=self.current_data[self.in_names["state"][0]], time_left=self.current_data[self.in_names["time_left"][0]])
+        self.check_alarms(times, values)
+        for listener in self.listeners:
+            listener(times, values)
+
+    def check_alarms(self, times, values):
+        with self.alarm_lock:
+            events = self.alarms.update(times, values, self.params, self.current_data)
+        self.publish_alarms(events)
+
+    def check_silence(self):
+        # called on a timer, raises the stale and heater alarms while no rows arrive
+        with self.alarm_lock:
+            events = self.alarms.check_silence(datetime_to_epoch_us(datetime.datetime.utcnow()), self.params)
+        self.publish_alarms(events)
+
+    def publish_alarms(self, events):
+        if not events:
+            return
+        for event in events:
+            print("ALARM", event["alarm"], event["event"], event["value"])
+            self.alarm_events.inc(alarm=event["alarm"], event=event["event"])
+        self.alarm_state = self.alarms.state()
+        for listener in self.alarm_listeners:
+            listener(self.alarm_state)
+        self.state_changed()
+
     def parse_function_info(self, message_list):
         message = message_list[0]
         if message in self.info_functions.keys():
-            self.info_functions[message]()
+            self.info_functions[message](*message_list[1:])
 
     def load_database(self, path):
-        try:
-            with open(path, "r") as f:
-                reader = csv.reader(f, skipinitialspace=True)
-                header = next(reader)
-                for row in reader:
-                    data_block = self.empty_data_block.copy()
-                    for name, value in zip(header, row):
-                        data_block[name] = self.parse_functions[self.in_names_reversed[name]](value)
-                    self.measurements.append(data_block)
-        except IOError:
-            print("Database file missing")
-
-    def update_database(self, path, every_nth_measurement=1):
-        database_exists = os.path.isfile(path)
-        with open(path, 'a', encoding='utf8', newline='') as output_file:
-            fc = csv.DictWriter(output_file, fieldnames=self.measurements_unsaved[0].keys())
-            if not database_exists:
-                fc.writeheader()
-            for count, row in enumerate(self.measurements_unsaved):
-                if count % every_nth_measurement == 0:
-                    fc.writerow(self.process_row_before_saving(row))
-                    self.measurements.append(row)
-        self.measurements_unsaved = []
-
-    def save_parameters(self, path):
+        if not os.path.isfile(path) and os.path.isfile(self.legacy_database_path):
+            convert_csv(self.legacy_database_path, path, self.raw_names)
+        if os.path.isfile(path) and os.path.getsize(path) > 0 and archive_channels(path) != self.stored_names:
+            self.convert_history(path, archive_channels(path))
+        self.archive = MeasurementArchive(path, self.stored_names)
+        self.log = SegmentLog(self.log_path, self.log_segment_size, self.log_commit_every, self.log_commit_interval)
+        self.recover_log(self.archive, self.log)
+        # only the hot days are loaded, everything older is read from the day chunks when asked for
+        self.roll_history()
+        times, values = self.archive.columns()
+        self.measurements.extend(times, values)
+        self.index_data(times, values)
+        if len(times):
+            # rates and means carry on from the last stored row
+            self.derived.prime(times[-1], values[:, -1])
+
+    def convert_history(self, path, channels):
+        # history stored with another channel layout (derived channels added, removed or changed) is
+        # rewritten in the current one, oldest first so rates and means carry on from day to day
+        print("Converting history from {} to {}".format(channels, self.stored_names))
+        archive = MeasurementArchive(path, channels)
+        log = SegmentLog(self.log_path, self.log_segment_size, self.log_commit_every, self.log_commit_interval)
+        self.recover_log(archive, log)
+        log.close()
+        # its records are in the archive now and have the old layout
+        shutil.rmtree(self.log_path)
+        self.derived.reset()
+        chunks = self.retention.store.directory
+        old_store = ChunkStore(chunks, channels)
+        if old_store.load_index():
+            converted = chunks + ".convert"
+            if os.path.isdir(converted):
+                shutil.rmtree(converted)
+            store = ChunkStore(converted, self.stored_names, self.retention.store.compression)
+            for entry in old_store.entries:
+                times, values = convert_records(old_store.read_chunk(entry), self.derived)
+                records = np.empty(len(times), dtype=store.dtype)
+                records["time"] = times
+                for i, name in enumerate(self.stored_names):
+                    records[name] = values[i]
+                store.write_chunk(entry["day"], records, entry["resolution"])
+            store.save_index()
+            os.rename(chunks, chunks + ".old")
+            os.rename(converted, chunks)
+            shutil.rmtree(chunks + ".old")
+        temporary_path = path + ".convert"
+        if os.path.isfile(temporary_path):
+            os.remove(temporary_path)
+        converted = MeasurementArchive(temporary_path, self.stored_names)
+        for start in range(0, len(archive), 1 << 20):
+            converted.append(*convert_records(archive.records(start, start + (1 << 20)), self.derived))
+        os.replace(temporary_path, path)
+        self.derived.reset()
+
+    def index_data(self, times, values):
+        # everything kept up to date sample by sample next to the rows themselves
+        self.rollups.extend(times, values)
+        self.stats.extend(times, values)
+        with self.changed:
+            self.data_version += 1
+            self.changed.notify_all()
+
+    def state_changed(self):
+        # current data or parameters changed without new rows
+        with self.changed:
+            self.state_version += 1
+            self.changed.notify_all()
+
+    def versions(self):
+        return self.data_version, self.state_version
+
+    def wait_for_change(self, versions=None, timeout=None):
+        # blocks until data or state moved past `versions` (as returned by versions()) or the timeout passed
+        with self.changed:
+            self.changed.wait_for(lambda: self.versions() != versions, timeout)
+            return self.versions()
+
+    def window_stats(self, time_delta):
+        # {group: (min, max, mean) or None} over the last time_delta of data, O(1) once the window is tracked
+        window_us = time_delta // datetime.timedelta(microseconds=1)
+        with self.stats.lock:
+            if not self.stats.tracks(window_us):
+                self.track_window(window_us)
+            return self.stats.get(window_us)
+
+    def track_window(self, window_us):
+        # a new window starts from the coarsest rollup that is still finer than its buckets, raw rows otherwise
+        last_time = self.last_time()
+        start = None if last_time is None else last_time - window_us
+        bucket_us = self.stats.bucket_us(window_us)
+        tiers = [tier for tier in self.rollups.tiers if tier.resolution_us <= bucket_us]
+        if tiers:
+            times, minimum, maximum, total, count = self.tier_arrays(tiers[-1], start)
+            self.stats.track(window_us, times, minimum, maximum, total, count, last_time)
+            return
+        times = []
+        values = []
+        cold_end = self.cold_end(self.memory_start(), start)
+        if cold_end is not None:
+            cold_times, cold_values = self.retention.store.read(start, cold_end)
+            times.append(cold_times)
+            values.append(cold_values)
+        for part_times, part_values in self.snapshots():
+            first, stop = self.time_range(part_times, start, None)
+            times.append(part_times[first:stop])
+            values.append(part_values[:, first:stop])
+        values = np.concatenate(values, axis=1)
+        self.stats.track(window_us, np.concatenate(times), values, values, values, 1, last_time)
+
+    def recover_log(self, archive, log):
+        # measurements that were committed to the log but never made it to the archive before a crash
+        records = log.replay()
+        if records:
+            logged = np.frombuffer(b"".join(payload for sequence, payload in records), dtype=archive.dtype)
+            last_time = archive.last_time()
+            if last_time is not None:
+                logged = logged[logged["time"] > last_time]
+            if len(logged):
+                archive.append(logged["time"], np.array([logged[name] for name in archive.channels]), sync=True)
+                print("Recovered {} measurements from the segment log".format(len(logged)))
+        log.compact(log.sequence)
+
+    def snapshots(self):
+        # saved and unsaved rows are read until no flush moved rows between them in the meantime
+        while True:
+            saved = self.measurements.snapshot()
+            unsaved = self.measurements_unsaved.snapshot()
+            if len(self.measurements) == len(saved[0]):
+                return [saved, unsaved]
+
+    def last_time(self):
+        last_time = self.measurements_unsaved.last_time()
+        return self.measurements.last_time() if last_time is None else last_time
+
+    def time_range(self, times, start, end):
+        first = 0 if start is None else np.searchsorted(times, start, side="right")
+        stop = len(times) if end is None else np.searchsorted(times, end, side="right")
+        return first, stop
+
+    def select_resolution(self, start=None, end=None, max_points=None, bucket_points=1):
+        # None (raw rows) while the range holds at most max_points of them, else the rollup resolution to read;
+        # bucket_points: how many points a bucket is drawn with
+        if max_points is None:
+            return None
+        count = 0
+        first_time = None
+        last_time = None
+        cold_end = self.cold_end(self.memory_start(), start, end)
+        if cold_end is not None:
+            count, first_time = self.retention.store.count(start, cold_end)
+            last_time = cold_end
+        for times, values in self.snapshots():
+            first, stop = self.time_range(times, start, end)
+            count += stop - first
+            if stop > first:
+                first_time = times[first] if first_time is None else first_time
+                last_time = times[stop - 1]
+        if count <= max_points:
+            return None
+        span = datetime.timedelta(microseconds=int(last_time - first_time))
+        return self.rollups.select(span, max_points // bucket_points).resolution
+
+    def read(self, start=None, end=None, channels=None, resolution=None):
+        channels = self.stored_names if channels is None else channels
+        if resolution is not None:
+            tier = self.rollups.tier(resolution)
+            return rollup_columns(self.tier_arrays(tier, start, end), tier.channel_index, channels)
+        parts = []
+        cold_end = self.cold_end(self.memory_start(), start, end)
+        if cold_end is not None:
+            parts.append(self.retention.store.read(start, cold_end))
+        for times, values in self.snapshots():
+            first, stop = self.time_range(times, start, end)
+            parts.append((times[first:stop], values[:, first:stop]))
+        columns = {"time": np.concatenate([times for times, values in parts]).view("datetime64[us]")}
+        for name in channels:
+            i = self.stored_index[name]
+            columns[name] = np.concatenate([values[i] for times, values in parts])
+        return columns
+
+    def export_parts(self, start=None, end=None):
+        # (rows, load) of the rows with start < time <= end, oldest first, one day chunk or memory store at a
+        # time: load() returns their (times, values). day chunks entirely inside the range are counted from the
+        # index and only read when loaded. memory is taken first, rows moved out of it meanwhile are in a chunk
+        snapshots = self.snapshots()
+        firsts = [int(times[0]) for times, values in snapshots if len(times)]
+        cold_end = self.cold_end(firsts[0] if firsts else None, start, end)
+        if cold_end is not None:
+            store = self.retention.store
+            for entry in store.overlapping(start, cold_end):
+                if (start is None or entry["first"] > start) and entry["last"] <= cold_end:
+                    yield entry["rows"], functools.partial(store.read_entry, entry)
+                else:
+                    part = store.read_entry(entry, start, cold_end)
+                    yield len(part[0]), functools.partial(tuple, part)
+        for times, values in snapshots:
+            first, stop = self.time_range(times, start, end)
+            yield stop - first, functools.partial(tuple, (times[first:stop], values[:, first:stop]))
+
+    def query(self, start=None, end=None, channels=None, max_points=None):
+        # columns of the rows with start < time <= end (epoch microseconds or datetime, None is open), found
+        # by binary search so the cost follows the range and not the history; ranges with more than
+        # max_points rows come from the finest rollup tier that fits, with "<name>_min"/"<name>_max" added
+        start = self.to_epoch_us(start)
+        end = self.to_epoch_us(end)
+        return self.read(start, end, channels, self.select_resolution(start, end, max_points))
+
+    def to_epoch_us(self, value):
+        if isinstance(value, datetime.datetime):
+            return datetime_to_epoch_us(value)
+        return value
+
+    def update_database(self):
+        with self.data_lock, self.flush_seconds.time():
+            self.flush_database()
+
+    def flush_database(self):
+        times, values = self.measurements_unsaved.snapshot()
+        self.archive.append(times, values, sync=True)
+        self.log.compact(self.log.sequence)
+        self.measurements.extend(times, values)
+        self.measurements_unsaved.clear()
+        if time.time() - self.retention_checked > self.retention_interval:
+            self.roll_history()
+
+    def roll_history(self):
+        self.retention_checked = time.time()
+        moved = self.retention.roll(self.archive, self.archive.last_time())
+        self.trim_history()
+        return moved
+
+    def trim_history(self):
+        # memory keeps what the day chunks don't have, whole days are dropped once they are in a chunk
+        last_time = self.retention.store.last_time()
+        if last_time is None:
+            return
+        before = day_start(last_time) + DAY_US
+        self.measurements.trim(before)
+        self.rollups.trim(before)
+
+    def cold_end(self, memory_start, start=None, end=None):
+        # last time to read from the day chunks for start < time <= end, None when they have nothing of it
+        store_last = self.retention.store.last_time()
+        if store_last is None or start is not None and store_last <= start:
+            return None
+        cold_end = store_last if memory_start is None else min(store_last, memory_start - 1)
+        cold_end = cold_end if end is None else min(cold_end, end)
+        return None if start is not None and cold_end <= start else cold_end
+
+    def memory_start(self):
+        first_time = self.measurements.first_time()
+        return self.measurements_unsaved.first_time() if first_time is None else first_time
+
+    def tier_arrays(self, tier, start=None, end=None):
+        # rollup buckets of a tier from the day chunks (older than the tier in memory) and from memory
+        arrays = tier.arrays(start, end)
+        cold_end = self.cold_end(tier.first_time(), start, end)
+        if cold_end is None:
+            return arrays
+        cold = self.retention.store.rollup(start, cold_end, tier.resolution)
+        return tuple(np.concatenate((x, y), axis=-1) for x, y in zip(cold, arrays))
+
+    def save_parameters(self):
         data_block = {}
-        for name, value in self.current_data.items():
-            data_block[name] = self.encode_functions[self.in_names_reversed[name]](value)
-        jsonData = json.dumps(data_block)
-        with open(path, 'w', encoding='utf8') as output_file:
-            output_file.write(jsonData)
-
-    def load_parameters(self, path):
-        parameters_exist = os.path.isfile(path)
-        if parameters_exist:
-            with open(path, 'r', encoding='utf8') as jsonData:
-                decodedJson = json.load(jsonData)
+        for name in self.persisted_names:
+            data_block[name] = self.encode_functions[self.in_names_reversed[name]](self.current_data[name])
+        self.parameter_store.update(data_block)
+
+    def load_parameters(self):
+        decodedJson = self.parameter_store.load()
+        if decodedJson is not None:
             for name, value in decodedJson.items():
                 self.current_data[name] = self.parse_functions[self.in_names_reversed[name]](value)
             self.update_parameters(temperature_target=self.current_data[self.in_names["temperature_target"][0]],
@@ -428,13 +751,10 @@ class Fermentor():
         else:
             pass
 
-    def clean_io(self):
-        self.io_active = False
-        self.initialized = False
-
     def send_parameters(self):
         message = self.get_parameter_string()
-        self.send_queue.put(message)
+        # repeated updates that are still waiting in the queue are replaced by the latest one
+        self.send(message, key="params")
         return "PARAMETERS UPDATED!"
 
     def start_fermentation(self, n_minutes):
@@ -445,33 +765,57 @@ class Fermentor():
         except:
             return "Invalid fermentation time"
         message = "start|time|" + str(n_minutes)
-        self.send_queue.put(message)
+        self.send(message)
 
     def pause_fermentation(self, foo=None):
         message = "pause\n"
-        self.send_queue.put(message)
+        self.send(message)
 
     def stop_fermentation(self, foo=None):
         message = "stop\n"
-        self.send_queue.put(message)
+        self.send(message)
 
     def resume_fermentation(self, foo=None):
         message = "resume\n"
-        self.send_queue.put(message)
+        self.send(message)
 
     def initialize_arduino(self):
-        self.initialized = True
+        self.engine.set_initialized(True)
+        self.protocol = "text"
+        if self.binary_protocol:
+            # firmware without binary frames answers with info|done only and keeps sending text
+            self.send("proto|bin|" + layout_string(self.num_devices))
         self.send_parameters()
         self.state_functions[self.params["state"]["current"]](self.params["time_left"]["current"].seconds)
 
-    def enable_send_lock(self):
-        self.send_lock.acquire()
+    def start_profiler(self):
+        self.profiler.start()
+        return "profiler started"
 
-    def disable_send_lock(self):
-        self.send_lock.release()
+    def stop_profiler(self):
+        return self.profiler.stop()
 
-    def process_row_before_saving(self, row):
-        data_block = self.empty_data_block.copy()
-        for name, value in row.items():
-            data_block[name] = self.encode_functions[self.in_names_reversed[name]](value)
-        return data_block
+    def metrics_snapshot(self):
+        return self.metrics.snapshot()
+
+    def start_capture(self, path):
+        self.engine.start_capture(path)
+        return "capturing to " + path
+
+    def stop_capture(self):
+        self.engine.stop_capture()
+        return "capture stopped"
+
+    def control_replay(self, action, *args):
+        # pause, resume, seek(recorded epoch us) or set_speed(speed, None = max) of a replaying engine
+        if action not in ["pause", "resume", "seek", "set_speed", "status"]:
+            return "UNKNOWN REPLAY ACTION"
+        result = getattr(self.engine, action)(*args)
+        return self.engine.status() if result is None else result
+
+    def set_protocol(self, protocol="text"):
+        self.protocol = protocol
+        print("arduino protocol:", protocol)
+
+    def disable_send_lock(self, sequence=None):
+        self.engine.acknowledge(sequence)
@@ -0,0 +1,103 @@
+import threading
+import datetime
+import numpy as np
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def datetime_to_epoch_us(value):
+    return (value - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def epoch_us_to_datetime(value):
+    return EPOCH + datetime.timedelta(microseconds=int(value))
+
+
+class MeasurementStore():
+    # time is stored as int64 microseconds since the unix epoch (naive utc, same as datetime.utcnow()),
+    # every channel is a float32 row of self.values so a single channel is one contiguous array
+    def __init__(self, channels, capacity=1024):
+        self.channels = list(channels)
+        self.channel_index = {name: i for i, name in enumerate(self.channels)}
+        self.size = 0
+        self.time = np.zeros(capacity, dtype=np.int64)
+        self.values = np.zeros((len(self.channels), capacity), dtype=np.float32)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.size
+
+    def reserve(self, capacity):
+        if capacity <= self.time.shape[0]:
+            return
+        new_capacity = max(capacity, 2 * self.time.shape[0])
+        time = np.zeros(new_capacity, dtype=np.int64)
+        values = np.zeros((len(self.channels), new_capacity), dtype=np.float32)
+        time[:self.size] = self.time[:self.size]
+        values[:, :self.size] = self.values[:, :self.size]
+        # readers may still hold views of the old buffers, so they are replaced and never written to again
+        self.time = time
+        self.values = values
+
+    def append(self, timestamp, values):
+        with self.lock:
+            if self.size == self.time.shape[0]:
+                self.reserve(self.size + 1)
+            self.time[self.size] = timestamp
+            self.values[:, self.size] = values
+            self.size += 1
+
+    def extend(self, times, values):
+        count = len(times)
+        if count == 0:
+            return
+        with self.lock:
+            self.reserve(self.size + count)
+            self.time[self.size:self.size + count] = times
+            self.values[:, self.size:self.size + count] = values
+            self.size += count
+
+    def clear(self):
+        with self.lock:
+            self.time = np.zeros_like(self.time)
+            self.values = np.zeros_like(self.values)
+            self.size = 0
+
+    def trim(self, before):
+        # drops the rows older than `before`, into new buffers so views handed out earlier stay valid
+        with self.lock:
+            first = int(np.searchsorted(self.time[:self.size], before, side="left"))
+            if first == 0:
+                return 0
+            self.time = self.time[first:].copy()
+            self.values = self.values[:, first:].copy()
+            self.size -= first
+            return first
+
+    def snapshot(self):
+        # views only cover rows that are already written, appends never touch them
+        with self.lock:
+            return self.time[:self.size], self.values[:, :self.size]
+
+    def column(self, name):
+        times, values = self.snapshot()
+        return values[self.channel_index[name]]
+
+    def first_time(self):
+        with self.lock:
+            if self.size == 0:
+                return None
+            return int(self.time[0])
+
+    def last_time(self):
+        with self.lock:
+            if self.size == 0:
+                return None
+            return int(self.time[self.size - 1])
+
+    def to_columns(self):
+        times, values = self.snapshot()
+        columns = {"time": times.view("datetime64[us]")}
+        for name, i in self.channel_index.items():
+            columns[name] = values[i]
+        return columns
@@ -0,0 +1,219 @@
+import os
+import sys
+import time
+import threading
+from collections import Counter as StackCounter
+
+# counters, gauges and histograms with labels, exposed in the prometheus text format. a registry can be
+# snapshotted into plain lists (picklable, so chamber workers can send theirs to the web process) and
+# snapshots of several registries are rendered together with extra labels such as the chamber name
+
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+SIZE_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Metric():
+    def __init__(self, name, help, kind, function=None):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.function = function
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def samples(self):
+        # [(name suffix, labels, value)]
+        if self.function is not None:
+            value = self.function()
+            values = value if isinstance(value, dict) else {(): value}
+            return [("", dict(labels), float(x)) for labels, x in values.items()]
+        with self.lock:
+            return [("", dict(labels), value) for labels, value in self.values.items()]
+
+
+class Counter(Metric):
+    def __init__(self, name, help, function=None):
+        Metric.__init__(self, name, help, "counter", function)
+
+    def inc(self, value=1, **labels):
+        key = label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    def __init__(self, name, help, function=None):
+        Metric.__init__(self, name, help, "gauge", function)
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[label_key(labels)] = value
+
+
+class Histogram(Metric):
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, help, "histogram")
+        self.buckets = list(buckets)
+
+    def observe(self, value, **labels):
+        key = label_key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][i] += 1
+                    break
+            counts[1] += value
+            counts[2] += 1
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                labels = dict(key)
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    samples.append(("_bucket", dict(labels, le=repr(float(bound))), cumulative))
+                samples.append(("_bucket", dict(labels, le="+Inf"), count))
+                samples.append(("_sum", labels, total))
+                samples.append(("_count", labels, count))
+        return samples
+
+
+class Timer():
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Registry():
+    def __init__(self, prefix="fermentor_"):
+        self.prefix = prefix
+        self.metrics = {}
+
+    def add(self, metric):
+        metric.name = self.prefix + metric.name
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, function=None):
+        return self.add(Counter(name, help, function))
+
+    def gauge(self, name, help, function=None):
+        return self.add(Gauge(name, help, function))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, buckets))
+
+    def snapshot(self):
+        snapshot = []
+        for metric in self.metrics.values():
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                print("metric", metric.name, "failed:", e)
+                continue
+            snapshot.append((metric.name, metric.kind, metric.help, samples))
+        return snapshot
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = ['{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+               for key, value in sorted(labels.items())]
+    return "{" + ",".join(escaped) + "}"
+
+
+def format_value(value):
+    if value != value:
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(snapshots):
+    # snapshots: [(extra labels, snapshot)], samples of the same metric are written under one header
+    families = {}
+    for extra_labels, snapshot in snapshots:
+        for name, kind, help, samples in snapshot:
+            family = families.setdefault(name, (kind, help, []))
+            family[2].extend((suffix, dict(labels, **extra_labels), value) for suffix, labels, value in samples)
+    lines = []
+    for name, (kind, help, samples) in families.items():
+        lines.append("# HELP {} {}".format(name, help))
+        lines.append("# TYPE {} {}".format(name, kind))
+        for suffix, labels, value in samples:
+            lines.append("{}{}{} {}".format(name, suffix, format_labels(labels), format_value(value)))
+    return "\n".join(lines) + "\n"
+
+
+class SamplingProfiler():
+    # samples the stacks of every other thread each `interval` seconds while running, cheap enough to switch
+    # on under real load. report() gives collapsed stacks ("thread;outer;...;inner count" per line, what
+    # flamegraph tools read), hottest first
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = StackCounter()
+        self.samples = 0
+        self.thread = None
+        self.running = False
+        self.started = None
+
+    def start(self):
+        if self.running:
+            return
+        self.stacks.clear()
+        self.samples = 0
+        self.running = True
+        self.started = time.time()
+        self.thread = threading.Thread(target=self.sample, name="sampling-profiler", daemon=True)
+        self.thread.start()
+
+    def sample(self):
+        own = threading.get_ident()
+        while self.running:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename),
+                                                     code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        return self.report()
+
+    def report(self):
+        duration = 0 if self.started is None else time.time() - self.started
+        lines = ["# {} samples every {} s over {:.1f} s".format(self.samples, self.interval, duration)]
+        lines += ["{} {}".format(stack, count) for stack, count in self.stacks.most_common()]
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,71 @@
+import os
+import json
+import time
+import threading
+
+
+class ParameterStore():
+    # keeps the last persisted values and rewrites the json file only when they change,
+    # at most once per `interval` seconds, through a temporary file and an atomic rename
+    def __init__(self, path, interval=5.0):
+        self.path = path
+        self.interval = interval
+        self.persisted = None
+        self.pending = None
+        self.last_write = 0.0
+        self.timer = None
+        self.writes = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return None
+        try:
+            with open(self.path, "r", encoding="utf8") as f:
+                values = json.load(f)
+        except (ValueError, OSError) as e:
+            print("Can't read parameters from", self.path, e)
+            return None
+        self.persisted = values
+        return values
+
+    def update(self, values):
+        with self.lock:
+            if values == self.pending:
+                return
+            if values == self.persisted:
+                # reverted before the pending values were written, nothing left to write
+                self.pending = None
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                return
+            self.pending = values
+            wait = self.last_write + self.interval - time.monotonic()
+            if wait <= 0:
+                self.write()
+            elif self.timer is None:
+                self.timer = threading.Timer(wait, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            self.write()
+
+    def write(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.pending is None:
+            return
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w", encoding="utf8") as f:
+            f.write(json.dumps(self.pending))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.path)
+        self.persisted = self.pending
+        self.pending = None
+        self.last_write = time.monotonic()
+        self.writes += 1
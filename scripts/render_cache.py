@@ -0,0 +1,47 @@
+import threading
+
+
+class RenderCache():
+    # results shared by every client that shows the same view. entries live in a scope (a chamber) at the
+    # data version they were computed for and are dropped as soon as a newer version of that scope is asked
+    # for; concurrent requests for the same entry wait for the first one to compute it
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.versions = {}
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, scope, version, key, compute):
+        while True:
+            with self.lock:
+                if self.versions.get(scope) != version:
+                    self.versions[scope] = version
+                    self.entries = {k: v for k, v in self.entries.items() if k[0] != scope}
+                entry = self.entries.get((scope, key))
+                owner = entry is None
+                if owner:
+                    entry = self.entries[(scope, key)] = {"done": threading.Event(), "failed": False}
+                    self.misses += 1
+                else:
+                    self.hits += 1
+            if owner:
+                try:
+                    entry["value"] = compute()
+                except Exception:
+                    entry["failed"] = True
+                    with self.lock:
+                        if self.entries.get((scope, key)) is entry:
+                            del self.entries[(scope, key)]
+                    raise
+                finally:
+                    entry["done"].set()
+                return entry["value"]
+            entry["done"].wait()
+            if not entry["failed"]:
+                return entry["value"]
+
+    def clear(self):
+        with self.lock:
+            self.versions = {}
+            self.entries = {}
@@ -0,0 +1,280 @@
+import os
+import sys
+import csv
+import time
+import argparse
+import tempfile
+import threading
+import functools
+import numpy as np
+from scripts.archive import MeasurementArchive, archive_channels, read_csv_columns
+from scripts.derived import is_derived
+from scripts.metrics import Registry
+from scripts.serial_engine import Command, parse_capture
+
+# python -m scripts.replay SOURCE [--speed 1|100|max] [--anchor now|original] [--data-directory DIR]
+# feeds recorded traffic back through a whole Fermentor (parser, segment log, archive, rollups, stats) in
+# place of the serial port and reports how fast it went. SOURCE is a data.bin archive, a legacy data.csv
+# or a capture written by SerialEngine.start_capture (one "<receive epoch us>\t<line>" per message,
+# binary frames as "#<hex>"). without --data-directory the replay goes into a temporary directory.
+# a chamber replays instead of opening its port with "replay": {"source": ..., "speed": 100} in
+# data/chambers.json, which also takes the dashboard and update_graphs along; "capture_path" records one.
+
+class MeasurementSource():
+    # rows of an archive or a csv, turned into data lines a batch at a time
+    def __init__(self, times, values, channels):
+        # derived channels are computed again by the fermentor, only the device channels are sent
+        keep = [i for i, name in enumerate(channels) if not is_derived(name)]
+        self.times = times
+        self.values = values[keep]
+        self.channels = [channels[i] for i in keep]
+        self.template = "data" + "".join("|{}|{{:.2f}}".format(name) for name in self.channels)
+
+    def messages(self, start, stop):
+        return [self.template.format(*row) for row in self.values[:, start:stop].T.tolist()]
+
+
+class CaptureSource():
+    def __init__(self, path):
+        with open(path, "r", encoding="utf8") as f:
+            records = [parse_capture(line) for line in f if line.strip()]
+        self.times = np.array([timestamp for timestamp, message in records], dtype=np.int64)
+        self.records = [message for timestamp, message in records]
+        self.binary = any(isinstance(message, bytes) for message in self.records)
+
+    def messages(self, start, stop):
+        return self.records[start:stop]
+
+
+def open_source(path):
+    if path.endswith(".bin"):
+        archive = MeasurementArchive(path, archive_channels(path))
+        times, values = archive.columns()
+        return MeasurementSource(times, values, archive.channels)
+    if path.endswith(".csv"):
+        with open(path, "r") as f:
+            header = next(csv.reader(f, skipinitialspace=True))
+        channels = [name for name in header if name != "time"]
+        times, values = read_csv_columns(path, channels)
+        return MeasurementSource(times, values, channels)
+    return CaptureSource(path)
+
+
+class ReplayEngine():
+    # stands in for SerialEngine: hands the messages of a recording to on_lines in batches of
+    # (timestamp, message), paced by the recorded receive times at `speed` (None = as fast as on_lines
+    # takes them). anchor "now" moves the recording to start at the moment replay starts, "original" keeps
+    # its timestamps. timestamps handed out only ever increase, also across seeks. commands sent by the
+    # fermentor are answered like the arduino does, with info|done and their sequence number
+    def __init__(self, port_name, baud_rate, on_lines, serial_factory=None, framer=None, metrics=None,
+                 source=None, speed=1.0, anchor="now", batch_size=1000, loop=False):
+        self.port_name = port_name
+        self.baud_rate = baud_rate
+        self.on_lines = on_lines
+        self.framer = framer
+        self.verbose = False
+        self.source = open_source(source) if isinstance(source, str) else source
+        self.speed = speed
+        self.anchor = anchor
+        self.batch_size = batch_size
+        self.loop = loop
+        self.position = 0
+        self.offset = None
+        self.last_output = None
+        self.pace = None
+        self.paused = False
+        self.running = False
+        self.connected = False
+        self.initialized = False
+        self.reconnects = 0
+        self.replies = ["info|Starting scheduler"]
+        self.commands = {}
+        self.on_command = None
+        self.lock = threading.Condition()
+        self.thread = None
+        self.finished = threading.Event()
+        self.init_metrics(metrics if metrics is not None else Registry())
+
+    def init_metrics(self, metrics):
+        self.metrics = metrics
+        self.replayed_messages = metrics.counter("replay_messages_total", "Recorded messages replayed")
+        metrics.gauge("replay_position", "Messages of the recording replayed so far", lambda: self.position)
+        metrics.gauge("replay_length", "Messages in the recording", lambda: len(self.source.times))
+        metrics.gauge("replay_speed", "Replay speed, 0 for as fast as possible", lambda: self.speed or 0)
+        metrics.gauge("serial_connected", "1 while the serial port is open", lambda: int(self.connected))
+
+    def start(self):
+        self.running = True
+        self.connected = True
+        self.thread = threading.Thread(target=self.run, name="replay", daemon=True)
+        self.thread.start()
+        print("replay engine started:", len(self.source.times), "messages at",
+              "max" if self.speed is None else self.speed, "x")
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.lock.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+        self.connected = False
+
+    def send(self, message, key=None):
+        command = Command(message, key)
+        with self.lock:
+            self.commands[command.sequence] = command
+            if command.name == "proto":
+                self.replies.append("info|proto|bin" if getattr(self.source, "binary", False) else "info|proto|text")
+            self.replies.append("info|done|{}".format(command.sequence))
+            command.status = "sent"
+            command.attempts = 1
+            command.sent_at = time.time()
+            self.lock.notify_all()
+        self.report(command)
+        return command
+
+    def report(self, command):
+        if self.on_command is not None:
+            self.on_command(command)
+
+    def acknowledge(self, sequence=None):
+        with self.lock:
+            command = self.commands.pop(int(sequence), None) if str(sequence).isdigit() else None
+        if command is not None:
+            command.status = "done"
+            self.report(command)
+
+    def set_initialized(self, initialized):
+        self.initialized = initialized
+
+    def pause(self):
+        with self.lock:
+            self.paused = True
+
+    def resume(self):
+        with self.lock:
+            self.paused = False
+            self.pace = None
+            self.lock.notify_all()
+
+    def set_speed(self, speed):
+        with self.lock:
+            self.speed = speed
+            self.pace = None
+            self.lock.notify_all()
+
+    def seek(self, timestamp):
+        # recorded epoch microseconds, the replay continues with the first message at or after it
+        with self.lock:
+            self.position = int(np.searchsorted(self.source.times, timestamp))
+            self.pace = None
+            self.finished.clear()
+            self.lock.notify_all()
+
+    def status(self):
+        return {"position": self.position, "length": len(self.source.times), "speed": self.speed,
+                "paused": self.paused, "finished": self.finished.is_set()}
+
+    def next_batch(self):
+        # replies to hand out and the range of recorded messages that is due now
+        times = self.source.times
+        replies, self.replies = self.replies, []
+        if self.paused or self.position >= len(times):
+            return replies, self.position, self.position
+        first = self.position
+        stop = min(first + self.batch_size, len(times))
+        if self.speed is not None:
+            if self.pace is None:
+                self.pace = (time.perf_counter(), int(times[first]))
+            wall, recorded = self.pace
+            due = recorded + (time.perf_counter() - wall) * self.speed * 1000000
+            stop = first + int(np.searchsorted(times[first:stop], due, side="right"))
+        return replies, first, stop
+
+    def timestamps(self, first, stop):
+        recorded = self.source.times[first:stop]
+        if self.offset is None:
+            self.offset = int(time.time() * 1000000) - int(recorded[0]) if self.anchor == "now" else 0
+        if self.last_output is not None and int(recorded[0]) + self.offset <= self.last_output:
+            # after a seek backwards (or unordered recordings) the rewritten time carries on from where it was
+            self.offset = self.last_output + 1 - int(recorded[0])
+        output = np.maximum.accumulate(recorded + self.offset)
+        self.last_output = int(output[-1])
+        return output.tolist()
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.running:
+                    break
+                replies, first, stop = self.next_batch()
+                if first < stop:
+                    messages = self.source.messages(first, stop)
+                    batch = list(zip(self.timestamps(first, stop), messages))
+                    self.position = stop
+                else:
+                    batch = []
+                if not replies and not batch:
+                    if self.position >= len(self.source.times) and not self.paused:
+                        if self.loop:
+                            self.position = 0
+                            self.pace = None
+                            continue
+                        if not self.finished.is_set():
+                            print("replay finished:", self.position, "messages")
+                            self.finished.set()
+                    self.lock.wait(0.001 if self.speed is not None and not self.paused else 0.1)
+                    continue
+            now = int(time.time() * 1000000)
+            batch = [(now, message) for message in replies] + batch
+            if self.verbose:
+                for timestamp, message in batch:
+                    print("received: ", message)
+            try:
+                self.on_lines(batch)
+            except Exception as e:
+                print("parser_error", e)
+            self.replayed_messages.inc(len(batch) - len(replies))
+
+
+def num_devices_for(channels):
+    return {key: len([name for name in channels if name.rstrip("0123456789") == prefix])
+            for key, prefix in [("temperature", "t"), ("humidity", "h")]}
+
+
+def main(arguments=None):
+    from scripts.fermentor import Fermentor
+    parser = argparse.ArgumentParser(description="replay recorded traffic through the whole ingest path")
+    parser.add_argument("source")
+    parser.add_argument("--speed", default="max")
+    parser.add_argument("--anchor", default="now", choices=["now", "original"])
+    parser.add_argument("--data-directory")
+    arguments = parser.parse_args(arguments)
+
+    source = open_source(arguments.source)
+    if isinstance(source, MeasurementSource):
+        num_devices = num_devices_for(source.channels)
+    else:
+        num_devices = None
+    speed = None if arguments.speed == "max" else float(arguments.speed)
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        data_directory = arguments.data_directory or temporary_directory
+        os.makedirs(data_directory, exist_ok=True)
+        factory = functools.partial(ReplayEngine, source=source, speed=speed, anchor=arguments.anchor)
+        start = time.perf_counter()
+        fermentor = Fermentor(serial_port_name="replay", data_directory=data_directory, num_devices=num_devices,
+                              binary_protocol=getattr(source, "binary", False), engine_factory=factory)
+        fermentor.engine.finished.wait()
+        fermentor.update_database()
+        duration = time.perf_counter() - start
+        stored = len(fermentor.measurements) + len(fermentor.measurements_unsaved)
+        fermentor.close()
+    recorded = (source.times[-1] - source.times[0]) / 1000000 if len(source.times) else 0
+    print("{} messages ({:.0f} s recorded) replayed in {:.1f} s: {:.0f} messages/s, {:.0f}x real time, "
+          "{} rows stored".format(len(source.times), recorded, duration, len(source.times) / duration,
+                                  recorded / duration, stored))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,239 @@
+import os
+import json
+import zlib
+import lzma
+import threading
+import collections
+import numpy as np
+from scripts.archive import record_dtype
+from scripts.rollup import RollupTier
+
+# history older than the hot window leaves data.bin (and memory) a day at a time: every utc day becomes one
+# compressed file of archive records in <data directory>/chunks, listed in chunks/index.json with its time
+# range and row count, so a read only decompresses the days it covers. days older than cold_after_days are
+# downsampled to bucket means (cold_action "downsample"), deleted ("delete") or kept as they are ("keep")
+
+DAY_US = 86400 * 1000000
+COMPRESSION = {
+    "zlib": (".zz", lambda data: zlib.compress(data, 6), zlib.decompress),
+    "lzma": (".xz", lambda data: lzma.compress(data, preset=6), lzma.decompress),
+}
+
+
+def day_start(timestamp):
+    return timestamp - timestamp % DAY_US
+
+
+def day_name(day):
+    return str(np.datetime64(int(day), "us").astype("datetime64[D]"))
+
+
+class ChunkStore():
+    def __init__(self, directory, channels, compression="zlib", cache_size=256):
+        self.directory = directory
+        self.channels = list(channels)
+        self.dtype = record_dtype(self.channels)
+        self.compression = compression
+        self.index_path = os.path.join(directory, "index.json")
+        self.entries = []
+        self.index_mtime = None
+        # rollup tiers of recently read chunks, by (file, rows, resolution)
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.decompressed = 0
+        self.lock = threading.RLock()
+
+    def load_index(self):
+        # the chamber worker writes, the web process only reads and picks up a new index when it changed
+        try:
+            mtime = os.stat(self.index_path).st_mtime_ns
+        except FileNotFoundError:
+            self.entries = []
+            return self.entries
+        if mtime != self.index_mtime:
+            with open(self.index_path, "r", encoding="utf8") as f:
+                index = json.load(f)
+            if index["channels"] != self.channels:
+                raise ValueError("chunk channels {} do not match {}".format(index["channels"], self.channels))
+            self.entries = index["chunks"]
+            self.index_mtime = mtime
+        return self.entries
+
+    def save_index(self):
+        os.makedirs(self.directory, exist_ok=True)
+        temporary_path = self.index_path + ".tmp"
+        with open(temporary_path, "w", encoding="utf8") as f:
+            json.dump({"channels": self.channels, "chunks": self.entries}, f, indent=1)
+        os.replace(temporary_path, self.index_path)
+        self.index_mtime = os.stat(self.index_path).st_mtime_ns
+
+    def __len__(self):
+        with self.lock:
+            return sum(entry["rows"] for entry in self.load_index())
+
+    def entry(self, day):
+        for entry in self.entries:
+            if entry["day"] == day:
+                return entry
+        return None
+
+    def overlapping(self, start=None, end=None):
+        # chunks holding rows with start < time <= end
+        with self.lock:
+            return [entry for entry in self.load_index() if (start is None or entry["last"] > start)
+                    and (end is None or entry["first"] <= end)]
+
+    def last_time(self):
+        with self.lock:
+            entries = self.load_index()
+            return entries[-1]["last"] if entries else None
+
+    def count(self, start=None, end=None):
+        # rows of the chunks in the range, whole chunks are counted
+        entries = self.overlapping(start, end)
+        return sum(entry["rows"] for entry in entries), entries[0]["first"] if entries else None
+
+    def read_chunk(self, entry):
+        extension, compress, decompress = COMPRESSION[entry["compression"]]
+        with open(os.path.join(self.directory, entry["file"]), "rb") as f:
+            data = decompress(f.read())
+        self.decompressed += 1
+        return np.frombuffer(data, dtype=self.dtype)
+
+    def write_chunk(self, day, records, resolution=None):
+        extension, compress, decompress = COMPRESSION[self.compression]
+        name = day_name(day) + extension
+        data = compress(records.tobytes())
+        os.makedirs(self.directory, exist_ok=True)
+        temporary_path = os.path.join(self.directory, name + ".tmp")
+        with open(temporary_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, os.path.join(self.directory, name))
+        old = self.entry(day)
+        if old is not None and old["file"] != name:
+            os.remove(os.path.join(self.directory, old["file"]))
+        entry = {"day": int(day), "file": name, "first": int(records["time"][0]), "last": int(records["time"][-1]),
+                 "rows": len(records), "bytes": len(data), "compression": self.compression, "resolution": resolution}
+        self.entries = sorted([x for x in self.entries if x["day"] != day] + [entry], key=lambda x: x["day"])
+
+    def add(self, records):
+        # records sorted by time, days that already have a chunk (a roll interrupted by a crash) are merged
+        if len(records) == 0:
+            return
+        with self.lock:
+            self.load_index()
+            days = records["time"] - records["time"] % DAY_US
+            starts = np.flatnonzero(np.concatenate(([True], days[1:] != days[:-1])))
+            for first, stop in zip(starts, np.append(starts[1:], len(records))):
+                day = int(days[first])
+                part = np.array(records[first:stop])
+                old = self.entry(day)
+                if old is not None:
+                    part = np.concatenate((self.read_chunk(old), part))
+                    part = part[np.argsort(part["time"], kind="stable")]
+                    keep = np.ones(len(part), dtype=bool)
+                    keep[1:] = part[1:] != part[:-1]
+                    part = part[keep]
+                self.write_chunk(day, part, None if old is None else old["resolution"])
+            self.save_index()
+
+    def expire(self, before, action, resolution):
+        # chunks of days before `before`: downsampled to bucket means, deleted or kept
+        if action == "keep":
+            return 0
+        changed = 0
+        with self.lock:
+            for entry in list(self.load_index()):
+                if entry["day"] >= before:
+                    break
+                if action == "delete":
+                    os.remove(os.path.join(self.directory, entry["file"]))
+                    self.entries.remove(entry)
+                elif entry["resolution"] is None or entry["resolution"] < resolution:
+                    tier = self.tier(entry, resolution)
+                    records = np.zeros(len(tier), dtype=self.dtype)
+                    records["time"] = tier.time[:tier.size]
+                    for i, name in enumerate(self.channels):
+                        records[name] = tier.total[i, :tier.size] / tier.count[:tier.size]
+                    self.write_chunk(entry["day"], records, resolution)
+                else:
+                    continue
+                changed += 1
+            if changed:
+                self.save_index()
+        return changed
+
+    def tier(self, entry, resolution):
+        key = (entry["file"], entry["rows"], resolution)
+        with self.lock:
+            tier = self.cache.get(key)
+            if tier is not None:
+                self.cache.move_to_end(key)
+                return tier
+        records = self.read_chunk(entry)
+        tier = RollupTier(self.channels, resolution, len(records))
+        tier.extend(records["time"], np.array([records[name] for name in self.channels]))
+        with self.lock:
+            self.cache[key] = tier
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return tier
+
+    def read(self, start=None, end=None):
+        # (times, values) of the rows with start < time <= end
+        parts = [self.read_entry(entry, start, end) for entry in self.overlapping(start, end)]
+        if not parts:
+            return np.zeros(0, dtype=np.int64), np.zeros((len(self.channels), 0), dtype=np.float32)
+        return np.concatenate([part[0] for part in parts]), np.concatenate([part[1] for part in parts], axis=1)
+
+    def read_entry(self, entry, start=None, end=None):
+        # (times, values) of one chunk's rows with start < time <= end
+        records = self.read_chunk(entry)
+        first = 0 if start is None else np.searchsorted(records["time"], start, side="right")
+        stop = len(records) if end is None else np.searchsorted(records["time"], end, side="right")
+        records = records[first:stop]
+        return records["time"].copy(), np.array([records[name] for name in self.channels], dtype=np.float32)
+
+    def rollup(self, start=None, end=None, resolution=60):
+        # (time, minimum, maximum, total, count) of the buckets with start < time <= end, a day at a time
+        parts = [self.tier(entry, resolution).arrays(start, end) for entry in self.overlapping(start, end)]
+        if not parts:
+            return RollupTier(self.channels, resolution, 0).arrays()
+        return tuple(np.concatenate([part[i] for part in parts], axis=-1) for i in range(5))
+
+
+class Retention():
+    def __init__(self, directory, channels, hot_days=2, cold_after_days=90, cold_action="downsample",
+                 cold_resolution=900, compression="zlib"):
+        self.store = ChunkStore(directory, channels, compression)
+        self.hot_days = hot_days
+        self.cold_after_days = cold_after_days
+        self.cold_action = cold_action
+        self.cold_resolution = cold_resolution
+
+    def cutoff(self, last_time):
+        # rows before the start of the oldest hot day are moved out
+        return day_start(last_time) - self.hot_days * DAY_US
+
+    def roll(self, archive, last_time):
+        # moves the rows of whole days before the cutoff from the archive into chunks, returns how many
+        if last_time is None:
+            return 0
+        cutoff = self.cutoff(last_time)
+        records = archive.records()
+        moved = int(np.searchsorted(records["time"], cutoff, side="left"))
+        if moved:
+            # a day at a time, a year old data.bin never has to fit in memory at once
+            days = records["time"][:moved] - records["time"][:moved] % DAY_US
+            starts = np.flatnonzero(np.concatenate(([True], days[1:] != days[:-1])))
+            for first, stop in zip(starts, np.append(starts[1:], moved)):
+                self.store.add(records[first:stop])
+            del records
+            archive.drop_before(cutoff)
+            print("Moved {} measurements older than {} to {}".format(moved, day_name(cutoff), self.store.directory))
+        expired = self.store.expire(day_start(last_time) - self.cold_after_days * DAY_US, self.cold_action, self.cold_resolution)
+        if expired:
+            print("Cold history: {} {} days".format(self.cold_action, expired))
+        return moved
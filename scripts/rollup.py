@@ -0,0 +1,186 @@
+import threading
+import numpy as np
+
+
+class RollupTier():
+    # fixed width time buckets holding min/max/sum/count of every channel, updated one sample at a time
+    def __init__(self, channels, resolution, capacity=256):
+        self.channels = list(channels)
+        self.channel_index = {name: i for i, name in enumerate(self.channels)}
+        self.resolution = resolution
+        self.resolution_us = int(resolution * 1000000)
+        self.size = 0
+        self.time = np.zeros(capacity, dtype=np.int64)
+        self.count = np.zeros(capacity, dtype=np.int64)
+        self.minimum = np.zeros((len(self.channels), capacity), dtype=np.float32)
+        self.maximum = np.zeros((len(self.channels), capacity), dtype=np.float32)
+        self.total = np.zeros((len(self.channels), capacity), dtype=np.float64)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.size
+
+    def reserve(self, capacity):
+        if capacity <= self.time.shape[0]:
+            return
+        new_capacity = max(capacity, 2 * self.time.shape[0])
+        for name in ["time", "count", "minimum", "maximum", "total"]:
+            old = getattr(self, name)
+            new = np.zeros(old.shape[:-1] + (new_capacity,), dtype=old.dtype)
+            new[..., :self.size] = old[..., :self.size]
+            setattr(self, name, new)
+
+    def add(self, timestamp, values):
+        bucket = timestamp - timestamp % self.resolution_us
+        with self.lock:
+            last = self.size - 1
+            if self.size and self.time[last] == bucket:
+                np.minimum(self.minimum[:, last], values, out=self.minimum[:, last])
+                np.maximum(self.maximum[:, last], values, out=self.maximum[:, last])
+                self.total[:, last] += values
+                self.count[last] += 1
+            elif self.size == 0 or self.time[last] < bucket:
+                self.reserve(self.size + 1)
+                self.time[self.size] = bucket
+                self.minimum[:, self.size] = values
+                self.maximum[:, self.size] = values
+                self.total[:, self.size] = values
+                self.count[self.size] = 1
+                self.size += 1
+            else:
+                # older than the newest bucket (clock jumps)
+                values = np.asarray(values).reshape(-1, 1)
+                self.merge(np.array([bucket]), np.ones(1, dtype=np.int64), values, values, values.astype(np.float64))
+
+    def extend(self, times, values):
+        if len(times) == 0:
+            return
+        buckets = times - times % self.resolution_us
+        if np.any(buckets[1:] < buckets[:-1]):
+            order = np.argsort(buckets, kind="stable")
+            buckets, values = buckets[order], values[:, order]
+        starts = np.flatnonzero(np.concatenate(([True], buckets[1:] != buckets[:-1])))
+        bucket_time = buckets[starts]
+        count = np.diff(starts, append=len(times))
+        minimum = np.minimum.reduceat(values, starts, axis=1)
+        maximum = np.maximum.reduceat(values, starts, axis=1)
+        total = np.add.reduceat(values.astype(np.float64), starts, axis=1)
+        with self.lock:
+            if self.size and self.time[self.size - 1] > bucket_time[0]:
+                self.merge(bucket_time, count, minimum, maximum, total)
+                return
+            if self.size and self.time[self.size - 1] == bucket_time[0]:
+                last = self.size - 1
+                np.minimum(self.minimum[:, last], minimum[:, 0], out=self.minimum[:, last])
+                np.maximum(self.maximum[:, last], maximum[:, 0], out=self.maximum[:, last])
+                self.total[:, last] += total[:, 0]
+                self.count[last] += count[0]
+                bucket_time, count = bucket_time[1:], count[1:]
+                minimum, maximum, total = minimum[:, 1:], maximum[:, 1:], total[:, 1:]
+            n = len(bucket_time)
+            self.reserve(self.size + n)
+            self.time[self.size:self.size + n] = bucket_time
+            self.count[self.size:self.size + n] = count
+            self.minimum[:, self.size:self.size + n] = minimum
+            self.maximum[:, self.size:self.size + n] = maximum
+            self.total[:, self.size:self.size + n] = total
+            self.size += n
+
+    def merge(self, bucket_time, count, minimum, maximum, total):
+        # sorted buckets reaching back before the newest one (a replay, a recovered segment), called with the
+        # lock held: folded into the buckets the tier already has, the others inserted in time order into new
+        # buffers, since readers may hold views of the old ones
+        n = self.size
+        position = np.searchsorted(self.time[:n], bucket_time)
+        found = position < n
+        found[found] = self.time[position[found]] == bucket_time[found]
+        index = position[found]
+        self.minimum[:, index] = np.minimum(self.minimum[:, index], minimum[:, found])
+        self.maximum[:, index] = np.maximum(self.maximum[:, index], maximum[:, found])
+        self.total[:, index] += total[:, found]
+        self.count[index] += count[found]
+        new = ~found
+        if not new.any():
+            return
+        order = np.argsort(np.concatenate((self.time[:n], bucket_time[new])), kind="stable")
+        for name, added in [("time", bucket_time), ("count", count), ("minimum", minimum), ("maximum", maximum),
+                            ("total", total)]:
+            setattr(self, name, np.concatenate((getattr(self, name)[..., :n], added[..., new]), axis=-1)[..., order])
+        self.size = len(order)
+
+    def clear(self):
+        with self.lock:
+            self.size = 0
+
+    def trim(self, before):
+        # drops the buckets older than `before`, into new buffers since readers may hold views of the old ones
+        with self.lock:
+            first = int(np.searchsorted(self.time[:self.size], before, side="left"))
+            if first == 0:
+                return
+            for name in ["time", "count", "minimum", "maximum", "total"]:
+                setattr(self, name, getattr(self, name)[..., first:self.size].copy())
+            self.size -= first
+
+    def first_time(self):
+        with self.lock:
+            return int(self.time[0]) if self.size else None
+
+    def arrays(self, since=None, until=None):
+        # copies of (time, minimum, maximum, total, count) of the buckets with since < time <= until
+        with self.lock:
+            n = self.size
+            start = 0 if since is None else np.searchsorted(self.time[:n], since, side="right")
+            stop = n if until is None else np.searchsorted(self.time[:n], until, side="right")
+            return (self.time[start:stop].copy(), self.minimum[:, start:stop].copy(),
+                    self.maximum[:, start:stop].copy(), self.total[:, start:stop].copy(), self.count[start:stop].copy())
+
+    def to_columns(self, since=None, until=None, channels=None):
+        return rollup_columns(self.arrays(since, until), self.channel_index,
+                              self.channels if channels is None else channels)
+
+
+def rollup_columns(arrays, channel_index, channels):
+    # "<name>" is the bucket mean, "<name>_min"/"<name>_max" keep the extremes a plain mean would hide
+    time, minimum, maximum, total, count = arrays
+    columns = {"time": time.view("datetime64[us]")}
+    for name in channels:
+        i = channel_index[name]
+        columns[name] = (total[i] / count).astype(np.float32)
+        columns[name + "_min"] = minimum[i]
+        columns[name + "_max"] = maximum[i]
+    return columns
+
+
+class Rollup():
+    def __init__(self, channels, resolutions):
+        self.tiers = [RollupTier(channels, resolution) for resolution in sorted(resolutions)]
+
+    def add(self, timestamp, values):
+        for tier in self.tiers:
+            tier.add(timestamp, values)
+
+    def extend(self, times, values):
+        for tier in self.tiers:
+            tier.extend(times, values)
+
+    def clear(self):
+        for tier in self.tiers:
+            tier.clear()
+
+    def trim(self, before):
+        for tier in self.tiers:
+            tier.trim(before)
+
+    def tier(self, resolution):
+        for tier in self.tiers:
+            if tier.resolution == resolution:
+                return tier
+        return None
+
+    def select(self, time_delta, max_points):
+        # finest tier with at most max_points buckets over time_delta, the coarsest one if none is that coarse
+        for tier in self.tiers:
+            if time_delta.total_seconds() // tier.resolution + 1 <= max_points:
+                return tier
+        return self.tiers[-1]
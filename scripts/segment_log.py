@@ -0,0 +1,157 @@
+import os
+import time
+import zlib
+import struct
+import threading
+
+# every record: payload length, crc32 of sequence + payload, sequence number, payload
+RECORD_HEADER = struct.Struct("<IIQ")
+SEGMENT_SUFFIX = ".seg"
+
+
+class SegmentLog():
+    # append-only log split into fixed-size segment files, records are made durable in groups:
+    # one write + fsync after commit_every records or commit_interval seconds, whichever comes first
+    def __init__(self, directory, segment_size=1 << 20, commit_every=5, commit_interval=10.0):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.pending = []
+        self.commit_timer = None
+        self.lock = threading.RLock()
+        self.sequence = 0
+        self.fsync_count = 0
+        self.fsync_time = 0.0
+        self.fsync_max_time = 0.0
+        self.committed_records = 0
+        os.makedirs(directory, exist_ok=True)
+        self.segments = self.list_segments()
+        if self.segments:
+            self.sequence = self.segment_first_sequence(self.segments[-1]) - 1
+        self.file = None
+
+    def list_segments(self):
+        names = sorted(x for x in os.listdir(self.directory) if x.endswith(SEGMENT_SUFFIX))
+        return [os.path.join(self.directory, x) for x in names]
+
+    def segment_path(self, first_sequence):
+        return os.path.join(self.directory, "{:016d}{}".format(first_sequence, SEGMENT_SUFFIX))
+
+    def segment_first_sequence(self, path):
+        return int(os.path.basename(path)[:-len(SEGMENT_SUFFIX)])
+
+    def read_segment(self, path):
+        records = []
+        with open(path, "rb") as f:
+            data = f.read()
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(data):
+            length, crc, sequence = RECORD_HEADER.unpack_from(data, offset)
+            end = offset + RECORD_HEADER.size + length
+            payload = data[offset + RECORD_HEADER.size:end]
+            if end > len(data) or zlib.crc32(payload, zlib.crc32(struct.pack("<Q", sequence))) != crc:
+                break
+            records.append((sequence, payload))
+            offset = end
+        return records, offset, len(data)
+
+    def replay(self):
+        # everything up to the first torn or corrupted record was durable, the rest is cut off
+        records = []
+        for path in self.segments:
+            segment_records, valid_size, size = self.read_segment(path)
+            if valid_size != size:
+                print("Segment log: dropping {} damaged bytes from {}".format(size - valid_size, path))
+                with open(path, "r+b") as f:
+                    f.truncate(valid_size)
+            records.extend(segment_records)
+        if records:
+            self.sequence = max(self.sequence, records[-1][0])
+        return records
+
+    def open_segment(self, first_sequence):
+        if self.file is None:
+            if self.segments and os.path.getsize(self.segments[-1]) < self.segment_size:
+                path = self.segments[-1]
+            else:
+                path = self.segment_path(first_sequence)
+                self.segments.append(path)
+            self.file = open(path, "ab")
+        return self.file
+
+    def append(self, payload):
+        with self.lock:
+            self.sequence += 1
+            header = RECORD_HEADER.pack(len(payload), zlib.crc32(payload, zlib.crc32(struct.pack("<Q", self.sequence))),
+                                        self.sequence)
+            self.pending.append(header + payload)
+            if len(self.pending) >= self.commit_every:
+                self.commit()
+            elif self.commit_timer is None:
+                self.commit_timer = threading.Timer(self.commit_interval, self.commit)
+                self.commit_timer.daemon = True
+                self.commit_timer.start()
+            return self.sequence
+
+    def extend(self, payloads):
+        with self.lock:
+            for payload in payloads:
+                self.sequence += 1
+                header = RECORD_HEADER.pack(len(payload), zlib.crc32(payload, zlib.crc32(struct.pack("<Q", self.sequence))),
+                                            self.sequence)
+                self.pending.append(header + payload)
+            if len(self.pending) >= self.commit_every:
+                self.commit()
+            elif self.pending and self.commit_timer is None:
+                self.commit_timer = threading.Timer(self.commit_interval, self.commit)
+                self.commit_timer.daemon = True
+                self.commit_timer.start()
+            return self.sequence
+
+    def commit(self):
+        with self.lock:
+            if self.commit_timer is not None:
+                self.commit_timer.cancel()
+                self.commit_timer = None
+            if not self.pending:
+                return
+            f = self.open_segment(self.sequence - len(self.pending) + 1)
+            f.write(b"".join(self.pending))
+            f.flush()
+            start = time.perf_counter()
+            os.fsync(f.fileno())
+            duration = time.perf_counter() - start
+            self.fsync_count += 1
+            self.fsync_time += duration
+            self.fsync_max_time = max(self.fsync_max_time, duration)
+            self.committed_records += len(self.pending)
+            self.pending = []
+            if f.tell() >= self.segment_size:
+                self.rotate()
+
+    def rotate(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            self.segments.append(self.segment_path(self.sequence + 1))
+            self.file = open(self.segments[-1], "ab")
+
+    def compact(self, sequence):
+        # sealed segments whose records are all at or below `sequence` are stored elsewhere and can go
+        with self.lock:
+            while len(self.segments) > 1 and self.segment_first_sequence(self.segments[1]) <= sequence + 1:
+                os.remove(self.segments.pop(0))
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def fsync_cost_per_sample(self):
+        if self.committed_records == 0:
+            return 0.0
+        return self.fsync_time / self.committed_records
@@ -0,0 +1,399 @@
+import os
+import time
+import asyncio
+import itertools
+import threading
+import collections
+import concurrent.futures
+import serial
+from scripts.metrics import Registry, SIZE_BUCKETS
+
+CAPTURE_FRAME = "#"
+SEQUENCE_KEY = "seq"
+sequence_numbers = itertools.count(1)
+
+
+def format_capture(timestamp, message):
+    if isinstance(message, bytes):
+        message = CAPTURE_FRAME + message.hex()
+    return "{}\t{}\n".format(timestamp, message)
+
+
+def parse_capture(line):
+    timestamp, message = line.rstrip("\r\n").split("\t", 1)
+    if message.startswith(CAPTURE_FRAME):
+        message = bytes.fromhex(message[len(CAPTURE_FRAME):])
+    return int(timestamp), message
+
+
+def split_sequence(line):
+    # "params|temp_tar|60|seq|12" -> ("params|temp_tar|60", 12), lines without a number -> (line, None)
+    line = line.strip()
+    head, separator, sequence = line.rpartition("|" + SEQUENCE_KEY + "|")
+    if not separator or not sequence.isdigit():
+        return line, None
+    return head, int(sequence)
+
+
+class Command():
+    # one command on its way to the arduino. status: queued, sent, done, superseded (a newer command with
+    # the same key was queued before this one went out), failed (no info|done after every retransmit)
+    def __init__(self, message, key=None):
+        self.sequence = next(sequence_numbers)
+        self.message = message.strip()
+        self.name = self.message.split("|", 1)[0]
+        self.key = key
+        self.status = "queued"
+        self.attempts = 0
+        self.sent_at = None
+        self.deadline = None
+        self.created = time.time()
+
+    def line(self, numbered=True):
+        if not numbered:
+            return self.message + "\n"
+        return "{}|{}|{}\n".format(self.message, SEQUENCE_KEY, self.sequence)
+
+    def summary(self):
+        return {"sequence": self.sequence, "command": self.name, "status": self.status, "attempts": self.attempts,
+                "created": self.created}
+
+
+class LineFramer():
+    # splits the received byte stream into text lines, keeping an unfinished line for the next chunk
+    def __init__(self, max_line_length=4096):
+        self.buffer = bytearray()
+        self.max_line_length = max_line_length
+        self.dropped_bytes = 0
+
+    def feed(self, data):
+        self.buffer += data
+        if b"\n" not in data:
+            if len(self.buffer) > self.max_line_length:
+                print("LINE TOO LONG, dropped", len(self.buffer), "bytes")
+                self.dropped_bytes += len(self.buffer)
+                self.buffer.clear()
+            return []
+        *lines, rest = self.buffer.split(b"\n")
+        self.buffer = bytearray(rest)
+        return [line.decode("utf-8", errors="replace").rstrip() for line in lines if line.strip()]
+
+    def clear(self):
+        self.buffer.clear()
+
+
+class SerialEngine():
+    # one asyncio loop (in one daemon thread) owns the serial port: it reads as soon as bytes arrive,
+    # frames them into lines, hands everything queued so far to on_lines as one batch of
+    # (receive time in epoch microseconds, line), writes queued messages and reconnects with backoff.
+    # on_lines runs in a single parser thread, so parsing and storing (archive flushes and fsyncs
+    # included) never hold up reads and the next batch collects everything that arrived meanwhile.
+    # commands carry a sequence number the arduino echoes in its info|done, up to `window` of them are on
+    # the wire at once, each is retransmitted after `command_timeout` seconds without an answer and given up
+    # after `retries` retransmits. firmware that answers info|done without a number gets one at a time
+    def __init__(self, port_name, baud_rate, on_lines, serial_factory=serial.Serial,
+                 reconnect_delay=0.5, reconnect_delay_max=30.0, framer=None, metrics=None, window=4,
+                 command_timeout=10.0, retries=2):
+        self.port_name = port_name
+        self.baud_rate = baud_rate
+        self.on_lines = on_lines
+        self.verbose = True
+        self.serial_factory = serial_factory
+        self.reconnect_delay = reconnect_delay
+        self.reconnect_delay_max = reconnect_delay_max
+        self.serial = None
+        self.connected = False
+        self.initialized = False
+        self.reconnects = 0
+        self.framer = framer if framer is not None else LineFramer()
+        self.loop = None
+        self.thread = None
+        self.parser = None
+        self.main_task = None
+        self.parse_queue = asyncio.Queue()
+        self.ready = asyncio.Event()
+        self.window = window
+        self.command_timeout = command_timeout
+        self.retries = retries
+        self.numbered = True
+        self.pending = collections.deque()
+        self.in_flight = collections.OrderedDict()
+        self.commands_changed = asyncio.Event()
+        self.on_command = None
+        self.capture = None
+        self.init_metrics(metrics if metrics is not None else Registry())
+
+    def init_metrics(self, metrics):
+        self.metrics = metrics
+        self.received_bytes = metrics.counter("serial_received_bytes_total", "Bytes read from the serial port")
+        self.received_messages = metrics.counter("serial_received_messages_total",
+                                                 "Lines and frames read from the serial port")
+        self.sent_messages = metrics.counter("serial_sent_messages_total", "Commands written to the serial port")
+        self.finished_commands = metrics.counter("commands_total", "Commands that got an answer or were given up, by status")
+        self.retransmits = metrics.counter("command_retransmits_total", "Commands written again after a timeout")
+        self.command_seconds = metrics.histogram("command_seconds", "First write of a command to its info|done")
+        self.parser_errors = metrics.counter("parser_errors_total", "Batches whose parsing raised, their messages are lost")
+        self.batch_size = metrics.histogram("parse_batch_size", "Messages handed to the parser at once", SIZE_BUCKETS)
+        metrics.counter("serial_reconnects_total", "Serial connections lost", lambda: self.reconnects)
+        metrics.counter("serial_dropped_bytes_total", "Bytes dropped by the framer (overlong or cut lines)",
+                        lambda: self.framer.dropped_bytes)
+        metrics.gauge("serial_connected", "1 while the serial port is open", lambda: int(self.connected))
+        metrics.gauge("parse_queue_depth", "Messages waiting for the parser", lambda: self.parse_queue.qsize())
+        metrics.gauge("send_queue_depth", "Commands waiting to be written", lambda: len(self.pending))
+        metrics.gauge("commands_in_flight", "Commands written and not answered yet", lambda: len(self.in_flight))
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self.parser = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="parser")
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        print("serial engine started")
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.main_task = self.loop.create_task(self.supervise())
+        try:
+            self.loop.run_until_complete(self.main_task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.close_serial()
+            self.stop_capture()
+            self.loop.close()
+            self.parser.shutdown(wait=True)
+        print("serial engine stopped")
+
+    def stop(self):
+        if self.loop is not None and self.main_task is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.main_task.cancel)
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+
+    def call(self, function, *args):
+        # run on the engine loop, safe to call from any thread
+        if self.loop is None or self.loop.is_closed():
+            function(*args)
+        elif self.thread is threading.current_thread():
+            function(*args)
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
+    def send(self, message, key=None):
+        # a queued command with the same key is replaced, so only the latest parameters go out
+        command = Command(message, key)
+        self.call(self.enqueue, command)
+        return command
+
+    def enqueue(self, command):
+        if command.key is not None:
+            for queued in [x for x in self.pending if x.key == command.key]:
+                self.pending.remove(queued)
+                self.finish(queued, "superseded")
+        self.pending.append(command)
+        self.report(command)
+        self.commands_changed.set()
+
+    def report(self, command):
+        if self.on_command is not None:
+            try:
+                self.on_command(command)
+            except Exception as e:
+                print("command listener failed:", e)
+
+    def finish(self, command, status):
+        command.status = status
+        self.finished_commands.inc(status=status)
+        if status == "done" and command.sent_at is not None:
+            self.command_seconds.observe(time.time() - command.sent_at)
+        self.report(command)
+
+    def acknowledge(self, sequence=None):
+        self.call(self.complete, sequence)
+
+    def complete(self, sequence):
+        if sequence is None or not str(sequence).isdigit():
+            if self.numbered:
+                print("firmware answers without sequence numbers, one command at a time")
+                self.numbered = False
+            command = next(iter(self.in_flight.values()), None)
+        else:
+            command = self.in_flight.get(int(sequence))
+        if command is None:
+            # the answer to a retransmit whose first answer was late, or to a command sent before a reconnect
+            return
+        del self.in_flight[command.sequence]
+        self.finish(command, "done")
+        self.commands_changed.set()
+
+    def start_capture(self, path):
+        # every received line and frame is appended to `path` with its receive time, for scripts.replay
+        def start():
+            self.stop_capture()
+            self.capture = open(path, "a", encoding="utf8")
+            print("capturing serial traffic to", path)
+        self.call(start)
+
+    def stop_capture(self):
+        def stop():
+            if self.capture is not None:
+                self.capture.close()
+                self.capture = None
+        self.call(stop)
+
+    def set_initialized(self, initialized):
+        def update():
+            self.initialized = initialized
+            if initialized:
+                self.ready.set()
+            else:
+                self.ready.clear()
+        self.call(update)
+
+    async def supervise(self):
+        delay = self.reconnect_delay
+        while True:
+            try:
+                self.open_serial()
+            except Exception as e:
+                print("can't connect to serial: exception=", e)
+                await asyncio.sleep(delay)
+                delay = min(2 * delay, self.reconnect_delay_max)
+                continue
+            delay = self.reconnect_delay
+            tasks = [asyncio.ensure_future(x) for x in [self.read_serial(), self.parse_lines(), self.send_messages()]]
+            try:
+                done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        print("serial io error", task.exception())
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                self.close_serial()
+                self.reconnects += 1
+
+    def open_serial(self):
+        self.serial = self.serial_factory(port=self.port_name, baudrate=self.baud_rate, timeout=0)
+        print("Serial port " + self.port_name + " opened | baud_rate: " + str(self.baud_rate))
+        self.serial.flush()
+        self.framer.clear()
+        self.connected = True
+
+    def close_serial(self):
+        self.connected = False
+        self.initialized = False
+        self.ready.clear()
+        # whatever was on the wire goes out again once the arduino has started
+        for command in reversed(self.in_flight.values()):
+            command.status = "queued"
+            self.pending.appendleft(command)
+        self.in_flight.clear()
+        if self.serial is not None:
+            try:
+                self.serial.close()
+            except Exception as e:
+                print("can't close serial: exception=", e)
+            self.serial = None
+
+    def receive(self, data):
+        timestamp = int(time.time() * 1000000)
+        self.received_bytes.inc(len(data))
+        lines = self.framer.feed(data)
+        for line in lines:
+            self.parse_queue.put_nowait((timestamp, line))
+        if lines:
+            self.received_messages.inc(len(lines))
+            if self.capture is not None:
+                self.capture.write("".join(format_capture(timestamp, line) for line in lines))
+
+    async def read_serial(self):
+        try:
+            fd = self.serial.fileno()
+        except Exception:
+            fd = None
+        if fd is None or os.name != "posix":
+            await self.read_serial_blocking()
+            return
+        # the loop wakes up when the port becomes readable instead of polling in_waiting
+        lost = self.loop.create_future()
+
+        def readable():
+            try:
+                data = self.serial.read(self.serial.in_waiting or 1)
+                if data:
+                    self.receive(data)
+            except Exception as e:
+                if not lost.done():
+                    lost.set_exception(e)
+        self.loop.add_reader(fd, readable)
+        try:
+            await lost
+        finally:
+            self.loop.remove_reader(fd)
+
+    async def read_serial_blocking(self):
+        # ports without a selectable file descriptor (windows) block in a worker thread instead
+        self.serial.timeout = 0.5
+        while True:
+            data = await self.loop.run_in_executor(None, lambda: self.serial.read(self.serial.in_waiting or 1))
+            if data:
+                self.receive(data)
+
+    async def parse_lines(self):
+        while True:
+            batch = [await self.parse_queue.get()]
+            while not self.parse_queue.empty():
+                batch.append(self.parse_queue.get_nowait())
+            if self.verbose:
+                for timestamp, line in batch:
+                    print("received: ", line)
+            self.batch_size.observe(len(batch))
+            await self.loop.run_in_executor(self.parser, self.handle_lines, batch)
+
+    def handle_lines(self, batch):
+        try:
+            self.on_lines(batch)
+        except Exception as e:
+            self.parser_errors.inc()
+            print("parser_error", e)
+
+    def write_command(self, command):
+        line = command.line(self.numbered)
+        self.serial.write(bytes(line, 'utf-8'))
+        command.attempts += 1
+        if command.sent_at is None:
+            command.sent_at = time.time()
+        command.status = "sent"
+        command.deadline = time.monotonic() + self.command_timeout
+        self.sent_messages.inc()
+        self.report(command)
+        print("sent: " + line.rstrip())
+
+    async def send_messages(self):
+        while True:
+            await self.ready.wait()
+            self.commands_changed.clear()
+            now = time.monotonic()
+            for command in list(self.in_flight.values()):
+                if command.deadline > now:
+                    continue
+                if command.attempts > self.retries:
+                    print("command failed, no answer:", command.message)
+                    del self.in_flight[command.sequence]
+                    self.finish(command, "failed")
+                else:
+                    self.retransmits.inc()
+                    self.write_command(command)
+            window = self.window if self.numbered else 1
+            while self.pending and len(self.in_flight) < window:
+                command = self.pending.popleft()
+                self.in_flight[command.sequence] = command
+                self.write_command(command)
+            timeout = None
+            if self.in_flight:
+                timeout = max(0.0, min(x.deadline for x in self.in_flight.values()) - time.monotonic())
+            try:
+                await asyncio.wait_for(self.commands_changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
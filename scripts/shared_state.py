@@ -0,0 +1,149 @@
+import os
+import time
+import pickle
+import struct
+import numpy as np
+from multiprocessing import shared_memory
+
+# what one chamber publishes for any number of web workers: the newest rows in a ring buffer and the
+# current data / parameters / command log, in one shared memory block. the acquisition daemon is the only
+# writer; rows and state each sit behind a seqlock (the sequence is odd while a write is in progress, a
+# reader copies and retries when the sequence moved), so readers never block the writer.
+# layout: header | state (pickled, length prefixed) | ring times int64[capacity] | ring values f32[channels, capacity]
+
+HEADER = struct.Struct("<QQQQdII")  # rows sequence, rows written, state sequence, capacity, heartbeat, channels, state size
+STATE_SIZE = 1 << 16
+
+
+def shared_name(chamber):
+    return "fermentor-" + chamber
+
+
+class SharedRing():
+    def __init__(self, name, channels=0, capacity=65536, create=False, state_size=STATE_SIZE):
+        if create:
+            size = HEADER.size + state_size + capacity * 8 + channels * capacity * 4
+            try:
+                # left over by a daemon that was killed
+                old = shared_memory.SharedMemory(name=name)
+                old.close()
+                old.unlink()
+            except FileNotFoundError:
+                pass
+            self.memory = shared_memory.SharedMemory(name=name, create=True, size=size)
+            HEADER.pack_into(self.memory.buf, 0, 0, 0, 0, capacity, 0.0, channels, state_size)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+            if os.name == "posix":
+                # readers must not unlink the block when they exit, only the daemon owns it
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(self.memory._name, "shared_memory")
+        self.name = name
+        self.owner = create
+        self.header = np.ndarray((4,), dtype=np.uint64, buffer=self.memory.buf)
+        capacity, heartbeat, channels, state_size = HEADER.unpack_from(self.memory.buf, 0)[3:]
+        self.capacity = capacity
+        self.channels = channels
+        self.state_size = state_size
+        ring = HEADER.size + state_size
+        self.times = np.ndarray((capacity,), dtype=np.int64, buffer=self.memory.buf, offset=ring)
+        self.values = np.ndarray((channels, capacity), dtype=np.float32, buffer=self.memory.buf,
+                                 offset=ring + capacity * 8)
+
+    def close(self):
+        self.header = self.times = self.values = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+    # writer side
+
+    def publish(self, times, values):
+        count = len(times)
+        if count == 0:
+            return
+        self.header[0] += 1
+        if count > self.capacity:
+            self.header[1] += count - self.capacity
+            times, values = times[-self.capacity:], values[:, -self.capacity:]
+            count = self.capacity
+        start = int(self.header[1]) % self.capacity
+        first = min(count, self.capacity - start)
+        self.times[start:start + first] = times[:first]
+        self.values[:, start:start + first] = values[:, :first]
+        self.times[:count - first] = times[first:]
+        self.values[:, :count - first] = values[:, first:]
+        self.header[1] += count
+        self.header[0] += 1
+
+    def publish_state(self, state):
+        data = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) + 4 > self.state_size:
+            print("shared state too large:", len(data), "bytes")
+            return
+        self.header[2] += 1
+        struct.pack_into("<I", self.memory.buf, HEADER.size, len(data))
+        self.memory.buf[HEADER.size + 4:HEADER.size + 4 + len(data)] = data
+        self.header[2] += 1
+
+    def beat(self):
+        struct.pack_into("<d", self.memory.buf, 32, time.time())
+
+    # reader side
+
+    def heartbeat(self):
+        return struct.unpack_from("<d", self.memory.buf, 32)[0]
+
+    def written(self):
+        return int(self.header[1])
+
+    def read_since(self, position):
+        # (times, values, new position) of the rows written after `position` (a previous new position, 0 at
+        # first), the oldest still in the ring when the reader fell more than `capacity` rows behind
+        while True:
+            sequence = int(self.header[0])
+            if sequence % 2:
+                time.sleep(0)
+                continue
+            written = int(self.header[1])
+            first = max(position, written - self.capacity)
+            indices = np.arange(first, written) % self.capacity
+            times = self.times[indices]
+            values = self.values[:, indices]
+            if int(self.header[0]) == sequence:
+                return times, values, written
+
+    def state_version(self):
+        return int(self.header[2])
+
+    def read_state(self):
+        # (state, version), state None before the first publish
+        while True:
+            sequence = int(self.header[2])
+            if sequence % 2:
+                time.sleep(0)
+                continue
+            if sequence == 0:
+                return None, 0
+            length = struct.unpack_from("<I", self.memory.buf, HEADER.size)[0]
+            data = bytes(self.memory.buf[HEADER.size + 4:HEADER.size + 4 + length])
+            if int(self.header[2]) == sequence:
+                return pickle.loads(data), sequence
+
+
+def control_address(config):
+    # the daemon's command socket of one chamber
+    if os.name == "nt":
+        return r"\\.\pipe\fermentor-" + config["name"]
+    return os.path.join(config["data_directory"], "control.sock")
+
+
+def control_key(config, create=False):
+    # shared secret of the command socket, readable only by the user running the daemon and the web server
+    path = os.path.join(config["data_directory"], "control.key")
+    if create:
+        os.makedirs(config["data_directory"], exist_ok=True)
+        with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as f:
+            f.write(os.urandom(32))
+    with open(path, "rb") as f:
+        return f.read()
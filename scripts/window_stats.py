@@ -0,0 +1,117 @@
+import threading
+from collections import deque
+import numpy as np
+
+
+class WindowStats():
+    # min/max/mean of one value stream over the last `window_us` microseconds of data. samples fall into
+    # window_us / buckets wide buckets: the min and max deques are monotonic with at most one entry per bucket
+    # and the sums are kept per bucket, so adding a sample and reading the stats are O(1) amortized and the
+    # window edge moves one bucket at a time
+    def __init__(self, window_us, buckets=256):
+        self.window_us = window_us
+        self.bucket_us = max(1, window_us // buckets)
+        self.minimum = deque()
+        self.maximum = deque()
+        self.sums = deque()
+        self.total = 0.0
+        self.count = 0
+        self.last_time = None
+
+    def add(self, timestamp, minimum, maximum, total, count):
+        # one sample (minimum == maximum == total, count 1) or a pre aggregated bucket of them
+        if self.last_time is not None and timestamp <= self.last_time:
+            return
+        self.last_time = timestamp
+        bucket = timestamp - timestamp % self.bucket_us
+        while self.minimum and self.minimum[-1][1] >= minimum:
+            self.minimum.pop()
+        if not self.minimum or self.minimum[-1][0] != bucket:
+            self.minimum.append((bucket, minimum))
+        while self.maximum and self.maximum[-1][1] <= maximum:
+            self.maximum.pop()
+        if not self.maximum or self.maximum[-1][0] != bucket:
+            self.maximum.append((bucket, maximum))
+        if self.sums and self.sums[-1][0] == bucket:
+            self.sums[-1][1] += total
+            self.sums[-1][2] += count
+        else:
+            self.sums.append([bucket, total, count])
+        self.total += total
+        self.count += count
+        self.expire(bucket)
+
+    def expire(self, bucket):
+        cutoff = bucket - self.window_us
+        while self.minimum and self.minimum[0][0] <= cutoff:
+            self.minimum.popleft()
+        while self.maximum and self.maximum[0][0] <= cutoff:
+            self.maximum.popleft()
+        while self.sums and self.sums[0][0] <= cutoff:
+            bucket, total, count = self.sums.popleft()
+            self.total -= total
+            self.count -= count
+
+    def get(self):
+        if not self.count:
+            return None
+        return self.minimum[0][1], self.maximum[0][1], self.total / self.count
+
+
+class StatsEngine():
+    # one WindowStats per tracked window length and sensor group, fed with every new block of samples;
+    # a window is tracked from the first time somebody asks for it
+    def __init__(self, groups, buckets=256):
+        self.groups = groups
+        self.buckets = buckets
+        self.windows = {}
+        self.lock = threading.RLock()
+
+    def bucket_us(self, window_us):
+        return max(1, window_us // self.buckets)
+
+    def tracks(self, window_us):
+        return window_us in self.windows
+
+    def group_aggregates(self, minimum, maximum, total, count):
+        # extremes, sum and number of valid values over the channels of every group, per sample or per bucket
+        aggregates = {}
+        for group, rows in self.groups.items():
+            valid = ~np.isnan(total[rows])
+            with np.errstate(invalid="ignore"):
+                aggregates[group] = (np.fmin.reduce(minimum[rows], axis=0), np.fmax.reduce(maximum[rows], axis=0),
+                                     np.where(valid, total[rows], 0).sum(axis=0, dtype=np.float64),
+                                     valid.sum(axis=0) * count)
+        return aggregates
+
+    def add_aggregates(self, windows, times, aggregates):
+        for window in windows:
+            for group, (minimum, maximum, total, count) in aggregates.items():
+                stats = window[group]
+                for i in np.flatnonzero(count):
+                    stats.add(int(times[i]), float(minimum[i]), float(maximum[i]), float(total[i]), int(count[i]))
+
+    def track(self, window_us, times, minimum, maximum, total, count, last_time=None):
+        # starts a window from history, raw samples (minimum, maximum and total are the values, count is 1)
+        # or rollup buckets; samples up to last_time are already in there
+        with self.lock:
+            window = {group: WindowStats(window_us, self.buckets) for group in self.groups}
+            if len(times):
+                self.add_aggregates([window], times, self.group_aggregates(minimum, maximum, total, count))
+            if last_time is not None:
+                for stats in window.values():
+                    stats.last_time = last_time
+            self.windows[window_us] = window
+
+    def extend(self, times, values):
+        with self.lock:
+            if self.windows and len(times):
+                self.add_aggregates(self.windows.values(), times, self.group_aggregates(values, values, values, 1))
+
+    def clear(self):
+        with self.lock:
+            self.windows = {}
+
+    def get(self, window_us):
+        with self.lock:
+            return {group: stats.get() for group, stats in self.windows[window_us].items()}
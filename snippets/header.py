@@ -16,6 +16,12 @@ layout = \
                      className='header-button'),
             width=1
         ),
+        dbc.Col(
+            dcc.Link(html.H2(children="Overview",
+                             className="header-button text-center"),
+                    href='/overview',
+                    className='header-button'),
+            width=1),
         dbc.Col(
             dcc.Link(html.H2(children="Camera",
                              className="header-button text-center"),